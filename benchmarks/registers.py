@@ -0,0 +1,71 @@
+"""Compare the __slots__ register file of the MPU classes with the same
+attributes kept in an instance __dict__, as they were before.  Run it
+from the root of the repository, where py65 can be imported:
+
+    $ python -m benchmarks.registers
+"""
+
+import timeit
+import tracemalloc
+
+from py65.devices.mpu6502 import MPU
+
+
+def without_slots(cls):
+    """Return a class with the same methods and class attributes as cls
+    whose instances keep their attributes in a __dict__"""
+    namespace = {}
+    for klass in reversed(cls.__mro__[:-1]):
+        for name, value in vars(klass).items():
+            if name in ('__slots__', '__dict__', '__weakref__'):
+                continue
+            if name in getattr(klass, '__slots__', ()):
+                continue # a slot's member descriptor
+            namespace[name] = value
+    return type(cls.__name__, (), namespace)
+
+
+DictMPU = without_slots(MPU)
+
+
+def allocated(factory, count):
+    tracemalloc.start()
+    objects = [factory() for _ in range(count)]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size / count
+
+
+def access_time(obj, number=200000):
+    def registers():
+        obj.pc = (obj.pc + 1) & 0xFFFF
+        obj.a = obj.x ^ obj.y
+        obj.sp = (obj.sp - 1) & 0xFF
+        obj.processorCycles += obj.excycles + 2
+    return min(timeit.repeat(registers, number=number, repeat=5)) / number
+
+
+def creation_time(factory, number=20000):
+    return min(timeit.repeat(factory, number=number, repeat=5)) / number
+
+
+def main():
+    memory = [0] * 0x10000
+    count = 10000
+    print("bytes per instance (memory shared):")
+    print("  __dict__  %6.0f" %
+          allocated(lambda: DictMPU(memory=memory), count))
+    print("  __slots__ %6.0f" % allocated(lambda: MPU(memory=memory), count))
+    print("register access (ns per loop):")
+    print("  __dict__  %6.1f" % (access_time(DictMPU(memory=memory)) * 1e9))
+    print("  __slots__ %6.1f" % (access_time(MPU(memory=memory)) * 1e9))
+    print("creation (us):")
+    print("  __dict__  %6.2f" %
+          (creation_time(lambda: DictMPU(memory=memory)) * 1e6))
+    print("  __slots__ %6.2f" %
+          (creation_time(lambda: MPU(memory=memory)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
+from array import array
 from py65.utils.conversions import itoa
 from py65.utils.devices import make_instruction_decorator
+from py65.utils import alu, codegen
 
 
 class MPU:
@@ -23,6 +25,23 @@ class MPU:
     ADDR_WIDTH = 16
     ADDR_FORMAT = "%04x"
 
+    # reasons returned by run()
+    RUN_MAX_CYCLES = 1
+    RUN_MAX_INSTRUCTIONS = 2
+    RUN_STOP_PC = 3
+    RUN_STOP_OPCODE = 4
+
+    # instances only have these attributes, which saves memory and makes
+    # accessing them faster; subclasses list the attributes they add
+    __slots__ = ('name', 'byteMask', 'addrMask', 'addrHighMask', 'spBase',
+                 'pc', 'a', 'x', 'y', 'sp', '_p', '_nz',
+                 'excycles', 'addcycles', 'processorCycles', 'waiting',
+                 '_memory', '_read_pages', '_write_pages', '_page_bits',
+                 '_dirty_pages', '_dirty', 'start_pc', 'translator', 'trace',
+                 'profile', 'scheduler', 'interrupts', 'interrupt_pending',
+                 '_lazy_flags', '_cycle_exact', '_instruct', '_hooks',
+                 '__weakref__')
+
     def __init__(self, memory=None, pc=0x0000):
         # config
         self.name = '6502'
@@ -35,15 +54,212 @@ class MPU:
         self.excycles = 0
         self.addcycles = False
         self.processorCycles = 0
+        self.waiting = False
+        self.translator = None # see py65.translator
+        self.trace = None # see py65.trace
+        self.profile = None # see py65.profiler
+        self.scheduler = None # see py65.scheduler
+        self.interrupts = None # see py65.interrupts
+        self.interrupt_pending = 0 # if interrupts is to be serviced
+        self._lazy_flags = False
+        self._cycle_exact = True
+        self._nz = 1
+        self._dirty_pages = None
+        self._dirty = None
+        self._instruct = self.instruct # see _update_instructions()
+        self._hooks = {} # opcode: [callback, ...], see add_hook()
 
         if memory is None:
             memory = 0x10000 * [0x00]
-        self.memory = memory
+        self.memory = memory # after the options, see the setter
         self.start_pc = pc # if None, reset vector is used
 
         # init
         self.reset()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._NZ = alu.nz_table(cls.BYTE_WIDTH)
+        cls._NZVALUE = alu.nz_values(cls.BYTE_WIDTH)
+        # generate fused handlers for the subclass's own constants
+        # and instructions
+        if codegen.overrides_helpers(cls, MPU):
+            cls.instruct = codegen.unfuse_instructions(cls)
+        else:
+            cls.instruct = codegen.fuse_instructions(cls, cls.__bases__[0])
+
+    # The processor status is kept as _p and _nz.  Normally _p holds all
+    # of the flags and _nz is a value giving neither N nor Z.  With
+    # lazy_flags, _p holds the other flags and N and Z are computed from
+    # _nz, the value the last instruction setting them worked on.
+
+    @property
+    def p(self):
+        return self._p | self._NZ[self._nz]
+
+    @p.setter
+    def p(self, value):
+        if self._lazy_flags:
+            nz = value & (self.NEGATIVE | self.ZERO)
+            self._p = value ^ nz
+            self._nz = self._NZVALUE[nz]
+        else:
+            self._p = value
+
+    @property
+    def lazy_flags(self):
+        """If true, instructions only record the value that the N and Z
+        flags are computed from and the flags are computed when p is
+        read.  It can be changed at any time."""
+        return self._lazy_flags
+
+    @lazy_flags.setter
+    def lazy_flags(self, enabled):
+        p = self.p
+        self._lazy_flags = bool(enabled)
+        self._nz = 1
+        self.p = p
+        self._update_instructions()
+
+    @property
+    def cycle_exact(self):
+        """If false, step() and run() execute instructions with handlers
+        and a loop that do no cycle accounting at all: processorCycles,
+        excycles and addcycles are left as they are.  Everything else
+        behaves the same.  It can be changed at any time, e.g. to run
+        to a breakpoint quickly and continue from there counting cycles.
+        run() does not accept max_cycles, and the translator, the trace,
+        the profile and the scheduler are not used while it is false."""
+        return self._cycle_exact
+
+    @cycle_exact.setter
+    def cycle_exact(self, enabled):
+        self._cycle_exact = bool(enabled)
+        self.excycles = 0
+        self._update_instructions()
+
+    @property
+    def memory(self):
+        return self._memory
+
+    @memory.setter
+    def memory(self, memory):
+        # Memory with page tables (see py65.memory.PagedMemory) is
+        # accessed through them: read_pages[address >> page_bits] gives
+        # an object indexed by the offset of the address in its page.
+        # For other memory, the whole address space is a single page.
+        self._memory = memory
+        if hasattr(memory, 'read_pages'):
+            self._read_pages = memory.read_pages
+            self._write_pages = memory.write_pages
+            self._page_bits = memory.page_bits
+        else:
+            self._read_pages = self._write_pages = [memory]
+            self._page_bits = None
+        if self._dirty_pages is not None:
+            self._attach_dirty_pages()
+        self._update_instructions()
+
+    @property
+    def dirty_pages(self):
+        """A py65.memory.DirtyPages marking the pages written to, or
+        None (the default) for no tracking.  When one is assigned, the
+        generated handlers and the stack helpers mark the page of each
+        write, and memory with a dirty_pages attribute is given it too.
+        Writes by handlers that are not generated, in subclasses that
+        override the operation or addressing mode methods, are only
+        marked if the memory marks them."""
+        return self._dirty_pages
+
+    @dirty_pages.setter
+    def dirty_pages(self, dirty_pages):
+        memory = self._memory
+        if (self._dirty_pages is not None and
+                getattr(memory, 'dirty_pages', None) is self._dirty_pages):
+            memory.dirty_pages = None
+        self._dirty_pages = dirty_pages
+        if dirty_pages is None:
+            self._dirty = None
+        else:
+            self._attach_dirty_pages()
+        self._update_instructions()
+
+    def _attach_dirty_pages(self):
+        self._dirty = self._dirty_pages.bitmap
+        if hasattr(self._memory, 'dirty_pages'):
+            self._memory.dirty_pages = self._dirty_pages
+
+    def _update_instructions(self):
+        # the instructions executed are those of the table shared by the
+        # class unless an option needs handlers generated for it
+        if self._dirty_pages is None:
+            dirty_bits = None
+        else:
+            dirty_bits = self._dirty_pages.page_bits
+        if (self._lazy_flags or not self._cycle_exact or
+                self._page_bits is not None or dirty_bits is not None):
+            instruct = codegen.variant_instructions(
+                type(self), self._lazy_flags, self._cycle_exact,
+                self._page_bits, dirty_bits)
+        else:
+            instruct = self.instruct
+        if self._hooks:
+            # a copy of the table for this instance only, with the
+            # handlers of the hooked opcodes wrapped
+            instruct = list(instruct)
+            for opcode, callbacks in self._hooks.items():
+                instruct[opcode] = _hooked(instruct[opcode], opcode,
+                                           callbacks)
+        self._instruct = instruct
+
+    # Instrumentation hooks are installed in the instructions executed
+    # by this MPU, so that only the hooked opcodes pay for them
+
+    def add_hook(self, opcodes, callback):
+        """Call callback(mpu, address, opcode) before executing each
+        instruction with one of the opcodes, where address is the address
+        of the instruction, e.g. add_hook([0x20], on_jsr) or
+        add_hook(mpu.illegal_opcodes(), on_illegal).  The instructions
+        with other opcodes run as fast as without hooks.  A hook may
+        change the registers or raise an exception to stop run().  Hooks
+        added or removed by a hook take effect with the next call to
+        step() or run(), and those added or removed by the events of a
+        scheduler (see py65.scheduler) with the next instruction."""
+        for opcode in opcodes:
+            self._hooks.setdefault(opcode, []).append(callback)
+        self._update_instructions()
+
+    def remove_hook(self, callback, opcodes=None):
+        """Remove callback from the opcodes, or from all opcodes if they
+        are None.  When no hooks are left, the MPU executes the table of
+        instructions shared by its class again."""
+        if opcodes is None:
+            opcodes = list(self._hooks)
+        for opcode in opcodes:
+            callbacks = self._hooks.get(opcode, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+                if not callbacks:
+                    del self._hooks[opcode]
+        self._update_instructions()
+
+    def remove_hooks(self):
+        """Remove all hooks"""
+        self._hooks = {}
+        self._update_instructions()
+
+    @classmethod
+    def illegal_opcodes(cls):
+        """The opcodes that are not instructions of this MPU"""
+        return [opcode for opcode, (name, mode) in enumerate(cls.disassemble)
+                if name == '???']
+
+    def _page_shift_and_mask(self):
+        # for fetching with read_pages[pc >> shift][pc & mask]
+        if self._page_bits is None:
+            return self.ADDR_WIDTH, self.addrMask
+        return self._page_bits, (1 << self._page_bits) - 1
+
     def reprformat(self):
         return ("%s PC  AC XR YR SP NV-BDIZC\n"
                 "%s: %04x %02x %02x %02x %02x %s")
@@ -56,15 +272,259 @@ class MPU:
                                     self.x, self.y, self.sp, flags)
 
     def step(self):
-        instructCode = self.memory[self.pc]
+        if not self._cycle_exact:
+            return self._step_without_cycles()
+        if (self.trace is not None or self.profile is not None or
+                self.scheduler is not None):
+            self._run_instrumented(None, 1, None, None)
+            return self
+        if self.translator is not None:
+            return self.translator.step(self)
+
+        if self.interrupt_pending:
+            self.interrupts.service(self)
+            if self.waiting:
+                # an IRQ released before it was taken does not end WAI
+                self.processorCycles += 1
+                return self
+        instructCode = self._memory[self.pc]
         self.pc = (self.pc + 1) & self.addrMask
         self.excycles = 0
         self.addcycles = self.extracycles[instructCode]
-        self.instruct[instructCode](self)
+        self._instruct[instructCode](self)
         self.pc &= self.addrMask
         self.processorCycles += self.cycletime[instructCode] + self.excycles
         return self
 
+    def run(self, max_cycles=None, max_instructions=None, stop_pcs=None,
+            stop_opcodes=None):
+        """Execute instructions until a stop condition is reached and
+        return the reason (one of the RUN_* constants).
+
+        max_cycles and max_instructions are budgets relative to the start
+        of this call.  stop_pcs and stop_opcodes are checked after each
+        instruction, so at least one instruction is always executed unless
+        a budget is already exhausted.  This is equivalent to calling
+        step() in a loop, only faster.
+        """
+        if not self._cycle_exact:
+            if max_cycles is not None:
+                raise ValueError("max_cycles needs cycle_exact")
+            return self._run_without_cycles(max_instructions, stop_pcs,
+                                            stop_opcodes)
+        if (self.trace is not None or self.profile is not None or
+                self.scheduler is not None):
+            return self._run_instrumented(max_cycles, max_instructions,
+                                          stop_pcs, stop_opcodes)
+        if self.translator is not None:
+            return self.translator.run(self, max_cycles, max_instructions,
+                                       stop_pcs, stop_opcodes)
+
+        if max_cycles is None:
+            cycles_limit = None
+        else:
+            cycles_limit = self.processorCycles + max_cycles
+        if max_instructions is None:
+            max_instructions = -1
+        stop_pcs = frozenset(stop_pcs or ())
+        stop_opcodes = frozenset(stop_opcodes or ())
+
+        pages = self._read_pages
+        shift, offset = self._page_shift_and_mask()
+        instruct = self._instruct
+        cycletime = self.cycletime
+        extracycles = self.extracycles
+        addrMask = self.addrMask
+        cycles = self.processorCycles
+        count = 0
+
+        try:
+            while True:
+                if count == max_instructions:
+                    return self.RUN_MAX_INSTRUCTIONS
+                if cycles_limit is not None and cycles >= cycles_limit:
+                    return self.RUN_MAX_CYCLES
+                count += 1
+
+                if self.interrupt_pending:
+                    self.processorCycles = cycles
+                    self.interrupts.service(self)
+                    cycles = self.processorCycles
+                    # with any hooks it added or removed
+                    instruct = self._instruct
+
+                if self.waiting:
+                    cycles += 1
+                    continue
+
+                pc = self.pc
+                instructCode = pages[pc >> shift][pc & offset]
+                self.pc = (pc + 1) & addrMask
+                self.excycles = 0
+                self.addcycles = extracycles[instructCode]
+                instruct[instructCode](self)
+                pc = self.pc = self.pc & addrMask
+                cycles += cycletime[instructCode] + self.excycles
+
+                if (stop_opcodes and
+                        pages[pc >> shift][pc & offset] in stop_opcodes):
+                    return self.RUN_STOP_OPCODE
+                if pc in stop_pcs:
+                    return self.RUN_STOP_PC
+        finally:
+            self.processorCycles = cycles
+
+    # step() and run() with a trace, a profile or a scheduler, a copy of
+    # the loop of run() that records each instruction in the trace and
+    # the profile and calls the events that are due, so that the loop
+    # without them pays nothing
+
+    def _run_instrumented(self, max_cycles, max_instructions, stop_pcs,
+                          stop_opcodes):
+        if max_cycles is None:
+            cycles_limit = None
+        else:
+            cycles_limit = self.processorCycles + max_cycles
+        if max_instructions is None:
+            max_instructions = -1
+        stop_pcs = frozenset(stop_pcs or ())
+        stop_opcodes = frozenset(stop_opcodes or ())
+
+        pages = self._read_pages
+        shift, offset = self._page_shift_and_mask()
+        instruct = self._instruct
+        cycletime = self.cycletime
+        extracycles = self.extracycles
+        addrMask = self.addrMask
+        NZ = self._NZ
+        cycles = self.processorCycles
+        count = recorded = 0
+
+        trace = self.trace
+        if trace is not None:
+            pack_into = trace.RECORD.pack_into
+            buffer = trace.buffer
+            record_size = trace.RECORD.size
+            end = len(buffer)
+            position = (trace.count % trace.size) * record_size
+
+        profile = self.profile
+        if profile is not None:
+            pc_instructions, pc_cycles = profile.counters(self)
+            executed = profile.executed
+
+        scheduler = self.scheduler
+
+        try:
+            while True:
+                if count == max_instructions:
+                    return self.RUN_MAX_INSTRUCTIONS
+                if cycles_limit is not None and cycles >= cycles_limit:
+                    return self.RUN_MAX_CYCLES
+                count += 1
+
+                if scheduler is not None:
+                    # kept up to date for the devices scheduling events
+                    self.processorCycles = cycles
+                    if cycles >= scheduler.deadline:
+                        scheduler.service(self)
+                        cycles = self.processorCycles
+                        # with any hooks the events added or removed
+                        instruct = self._instruct
+
+                if self.interrupt_pending:
+                    self.processorCycles = cycles
+                    self.interrupts.service(self)
+                    cycles = self.processorCycles
+                    instruct = self._instruct
+
+                if self.waiting:
+                    cycles += 1
+                    continue
+
+                start = pc = self.pc
+                instructCode = pages[pc >> shift][pc & offset]
+                if trace is not None:
+                    pack_into(buffer, position, pc, instructCode, self.a,
+                              self.x, self.y, self.sp,
+                              self._p | NZ[self._nz], cycles)
+                    position += record_size
+                    if position == end:
+                        position = 0
+                recorded += 1
+                self.pc = (pc + 1) & addrMask
+                self.excycles = 0
+                self.addcycles = extracycles[instructCode]
+                instruct[instructCode](self)
+                pc = self.pc = self.pc & addrMask
+                spent = cycletime[instructCode] + self.excycles
+                cycles += spent
+
+                if profile is not None:
+                    pc_instructions[start] += 1
+                    pc_cycles[start] += spent
+                    if instructCode == 0x20: # JSR
+                        profile.call(start, pc, executed + recorded, cycles)
+                    elif instructCode == 0x60: # RTS
+                        profile.ret(executed + recorded, cycles)
+
+                if (stop_opcodes and
+                        pages[pc >> shift][pc & offset] in stop_opcodes):
+                    return self.RUN_STOP_OPCODE
+                if pc in stop_pcs:
+                    return self.RUN_STOP_PC
+        finally:
+            self.processorCycles = cycles
+            if trace is not None:
+                trace.count += recorded
+            if profile is not None:
+                profile.executed += recorded
+
+    # step() and run() when not cycle_exact
+
+    def _step_without_cycles(self):
+        if self.interrupt_pending:
+            self.interrupts.service(self)
+        if not self.waiting:
+            instructCode = self._memory[self.pc]
+            self.pc = (self.pc + 1) & self.addrMask
+            self._instruct[instructCode](self)
+            self.pc &= self.addrMask
+        return self
+
+    def _run_without_cycles(self, max_instructions, stop_pcs, stop_opcodes):
+        if max_instructions is None:
+            max_instructions = -1
+        stop_pcs = frozenset(stop_pcs or ())
+        stop_opcodes = frozenset(stop_opcodes or ())
+
+        pages = self._read_pages
+        shift, offset = self._page_shift_and_mask()
+        instruct = self._instruct
+        addrMask = self.addrMask
+        count = 0
+
+        while count != max_instructions:
+            count += 1
+            if self.interrupt_pending:
+                self.interrupts.service(self)
+                instruct = self._instruct
+            if self.waiting:
+                continue
+
+            pc = self.pc
+            instructCode = pages[pc >> shift][pc & offset]
+            self.pc = (pc + 1) & addrMask
+            instruct[instructCode](self)
+            pc = self.pc = self.pc & addrMask
+
+            if (stop_opcodes and
+                    pages[pc >> shift][pc & offset] in stop_opcodes):
+                return self.RUN_STOP_OPCODE
+            if pc in stop_pcs:
+                return self.RUN_STOP_PC
+        return self.RUN_MAX_INSTRUCTIONS
+
     def reset(self):
         self.pc = self.start_pc
         if self.pc is None:
@@ -76,6 +536,114 @@ class MPU:
         self.p = self.BREAK | self.UNUSED
         self.processorCycles = 0
 
+    # snapshot(), restore() and fork() keep the memory's own snapshots
+    # when it has them (py65.memory.PagedMemory, which shares its pages
+    # until they are written to, ObservableMemory and Bus), or otherwise
+    # a copy of a list or array memory[:].  Other memory raises TypeError,
+    # since slicing it may call devices and the copy would be a list.
+
+    def snapshot(self):
+        """Return the state of the registers, the cycle counter and the
+        memory, for restore()"""
+        memory = self._memory
+        if hasattr(memory, 'snapshot'):
+            contents = memory.snapshot()
+        else:
+            contents = self._sequence_memory()[:]
+        return self._registers() + (contents,)
+
+    def restore(self, snapshot):
+        """Return to the state of a snapshot taken with snapshot()"""
+        registers, contents = snapshot[:-1], snapshot[-1]
+        self._set_registers(registers)
+        memory = self._memory
+        if hasattr(memory, 'restore'):
+            memory.restore(contents)
+        else:
+            self._sequence_memory()[:] = contents
+        if self.translator is not None:
+            # the code restored is not marked in dirty_pages
+            self.translator.invalidate()
+
+    def fork(self):
+        """Return a new MPU of the same class in the same state, with the
+        same options and hooks and a fork (or a copy) of the memory"""
+        memory = self._memory
+        if hasattr(memory, 'fork'):
+            memory = memory.fork()
+        else:
+            memory = self._sequence_memory()[:]
+        mpu = type(self)(memory=memory, pc=self.start_pc)
+        mpu.lazy_flags = self._lazy_flags
+        mpu.cycle_exact = self._cycle_exact
+        for opcode, callbacks in self._hooks.items():
+            for callback in callbacks:
+                mpu.add_hook([opcode], callback)
+        mpu._set_registers(self._registers())
+        return mpu
+
+    def _sequence_memory(self):
+        memory = self._memory
+        if not isinstance(memory, (list, bytearray, array)):
+            raise TypeError("cannot snapshot memory of type %s, which has "
+                            "no snapshot(), restore() and fork()" %
+                            type(memory).__name__)
+        return memory
+
+    def _registers(self):
+        return (self.pc, self.a, self.x, self.y, self.sp, self.p,
+                self.processorCycles, self.excycles, self.waiting)
+
+    def _set_registers(self, registers):
+        (self.pc, self.a, self.x, self.y, self.sp, self.p,
+         self.processorCycles, self.excycles, self.waiting) = registers
+
+    # pickling keeps the registers as the tuple of _registers(), the
+    # options, the hooks and the memory, with a list memory packed into
+    # bytes (or an array of words).  The MPU is made again by __init__(),
+    # as by fork(); its translator, trace, profile, scheduler and
+    # interrupts are not kept.
+
+    def __getstate__(self):
+        memory = self._memory
+        packed = type(memory) is list
+        if packed:
+            try:
+                if self.BYTE_WIDTH == 8:
+                    memory = bytes(memory)
+                else:
+                    memory = array('H', memory)
+            except (ValueError, OverflowError, TypeError):
+                packed = False # values that do not fit, kept as a list
+        state = {'registers': self._registers(),
+                 'memory': memory,
+                 'packed': packed,
+                 'start_pc': self.start_pc,
+                 'name': self.name,
+                 'lazy_flags': self._lazy_flags,
+                 'cycle_exact': self._cycle_exact,
+                 'dirty_pages': self._dirty_pages,
+                 'hooks': self._hooks}
+        if hasattr(self, '__dict__'):
+            # the attributes of a subclass without __slots__
+            state['dict'] = self.__dict__
+        return state
+
+    def __setstate__(self, state):
+        memory = state['memory']
+        if state['packed']:
+            memory = list(memory)
+        type(self).__init__(self, memory=memory, pc=state['start_pc'])
+        self.name = state['name']
+        self.lazy_flags = state['lazy_flags']
+        self.cycle_exact = state['cycle_exact']
+        self.dirty_pages = state['dirty_pages']
+        self._hooks = state.get('hooks', {})
+        self._update_instructions()
+        self._set_registers(state['registers'])
+        if 'dict' in state:
+            self.__dict__.update(state['dict'])
+
     def irq(self):
         # triggers a normal IRQ
         # this is very similar to the BRK instruction
@@ -182,6 +750,8 @@ class MPU:
 
     def stPush(self, z):
         self.memory[self.sp + self.spBase] = z & self.byteMask
+        if self._dirty_pages is not None:
+            self._dirty_pages.mark(self.sp + self.spBase)
         self.sp -= 1
         self.sp &= self.byteMask
 
@@ -1265,3 +1835,22 @@ class MPU:
     def inst_0xfe(self):
         self.opINCR(self.AbsoluteXAddr)
         self.pc += 2
+
+
+# replace the decorated handlers with ones that have the addressing mode
+# and operation inlined (see py65.utils.codegen)
+MPU.instruct = codegen.fuse_instructions(MPU)
+MPU._NZ = alu.nz_table(MPU.BYTE_WIDTH)
+MPU._NZVALUE = alu.nz_values(MPU.BYTE_WIDTH)
+
+
+def _hooked(handler, opcode, callbacks):
+    # a handler calling the hooks of its opcode before the instruction
+    callbacks = tuple(callbacks)
+
+    def hooked(mpu):
+        address = (mpu.pc - 1) & mpu.addrMask
+        for callback in callbacks:
+            callback(mpu, address, opcode)
+        handler(mpu)
+    return hooked
@@ -3,14 +3,19 @@ from py65.utils.devices import make_instruction_decorator
 
 
 class MPU(mpu6502.MPU):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         mpu6502.MPU.__init__(self, *args, **kwargs)
         self.name = '65C02'
-        self.waiting = False
 
     def step(self):
-        if self.waiting:
-            self.processorCycles += 1
+        if (self.waiting and self.scheduler is None and
+                not self.interrupt_pending):
+            # otherwise MPU.step() waits for the events of the scheduler
+            # or takes the interrupt
+            if self._cycle_exact:
+                self.processorCycles += 1
         else:
             mpu6502.MPU.step(self)
         return self
@@ -1,4 +1,5 @@
 from py65.devices import mpu6502
+from py65.memory import SparseMemory
 
 
 class MPU(mpu6502.MPU):
@@ -19,19 +20,28 @@ class MPU(mpu6502.MPU):
     ADDR_WIDTH = 32
     ADDR_FORMAT = "%08x"
 
-    def __init__(self, *args, **kwargs):
-        mpu6502.MPU.__init__(self, *args, **kwargs)
+    NEGATIVE = 1 << 15
+    OVERFLOW = 1 << 14
+
+    __slots__ = ('IrqTo', 'ResetTo', 'NMITo')
+
+    def __init__(self, memory=None, pc=0x0000):
+        if memory is None:
+            # the whole 32-bit address space, allocated as it is used
+            memory = SparseMemory(self.ADDR_WIDTH, self.BYTE_WIDTH)
+        mpu6502.MPU.__init__(self, memory, pc)
         self.name = '65Org16'
-        self.waiting = False
         self.IrqTo = (1 << self.ADDR_WIDTH) - 2
         self.ResetTo = (1 << self.ADDR_WIDTH) - 4
         self.NMITo = (1 << self.ADDR_WIDTH) - 6
-        self.NEGATIVE = 1 << 15
-        self.OVERFLOW = 1 << 14
 
     def step(self):
-        if self.waiting:
-            self.processorCycles += 1
+        if (self.waiting and self.scheduler is None and
+                not self.interrupt_pending):
+            # otherwise MPU.step() waits for the events of the scheduler
+            # or takes the interrupt
+            if self._cycle_exact:
+                self.processorCycles += 1
         else:
             mpu6502.MPU.step(self)
         return self
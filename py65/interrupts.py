@@ -0,0 +1,95 @@
+"""Interrupt lines of an MPU, asserted and released by devices.
+
+MPU.irq() and MPU.nmi() take an interrupt at once, and irq() does
+nothing while the I flag is set.  InterruptLines models the lines
+instead: a device asserts its IRQ line and releases it when the
+interrupt is acknowledged, and the MPU takes the interrupt at an
+instruction boundary whenever the line is asserted and the I flag is
+clear.  IRQ is level-triggered, so an IRQ asserted while the I flag is
+set is taken when CLI, PLP or RTI clear it.  NMI is edge-triggered:
+each nmi() is taken once.
+
+  lines = InterruptLines(mpu)
+  TIMER = 1 # a bit of lines.irq for each device
+
+  def underflow(mpu, cycle):
+      lines.assert_irq(TIMER)
+
+  def acknowledge(address, value):
+      lines.release_irq(TIMER)
+
+The lines are sampled through mpu.interrupt_pending: a change of the
+lines sets it, and step() and run() check it at each instruction
+boundary, as they check mpu.waiting, and call service() when it is set.
+This works with or without mpu.cycle_exact.  While an IRQ is asserted
+but masked, hooks (see MPU.add_hook()) on CLI, PLP and RTI sample the
+lines again before those instructions; no other instruction pays for
+it.  A pending IRQ is taken right after the instruction clearing the I
+flag, without the one instruction delay of CLI on the 6502.  If the I
+flag is changed in another way, such as by assigning mpu.p, call
+sample().  With the translator, an interrupt asserted by a device
+during a translated block is taken at the end of the block.
+
+Interrupts also end the waiting of the 65C02's WAI instruction, and an
+IRQ ends it even while the I flag is set.
+"""
+
+# CLI, PLP and RTI, which can clear the I flag
+REENABLING_OPCODES = (0x58, 0x28, 0x40)
+
+
+class InterruptLines:
+    """IRQ lines, a bit of irq each, and the NMI line of an MPU"""
+
+    def __init__(self, mpu):
+        self.mpu = mpu
+        mpu.interrupts = self
+        self.irq = 0 # the bits of the IRQ lines asserted
+        self.nmi_pending = False # an NMI edge not yet taken
+        self._hooked = False # if the hooks on REENABLING_OPCODES are in
+
+    def assert_irq(self, line=1):
+        """Assert the IRQ lines of the bits of line.  The IRQ is taken
+        at an instruction boundary while any line is asserted and the I
+        flag is clear."""
+        self.irq |= line
+        self.sample()
+
+    def release_irq(self, line=1):
+        """Release the IRQ lines of the bits of line"""
+        self.irq &= ~line
+        if not self.irq and self._hooked:
+            self.mpu.remove_hook(self._reenabled)
+            self._hooked = False
+
+    def nmi(self):
+        """Signal an NMI edge.  The NMI is taken at the next instruction
+        boundary."""
+        self.nmi_pending = True
+        self.sample()
+
+    def sample(self):
+        """Sample the lines at the next instruction boundary"""
+        if self.irq or self.nmi_pending:
+            self.mpu.interrupt_pending = 1
+
+    def service(self, mpu):
+        """Take the interrupts of the lines.  Called by the MPU at an
+        instruction boundary when mpu.interrupt_pending is set."""
+        mpu.interrupt_pending = 0
+        if self.nmi_pending:
+            self.nmi_pending = False
+            mpu.waiting = False
+            mpu.nmi()
+        if self.irq:
+            mpu.waiting = False
+            if not mpu.p & mpu.INTERRUPT:
+                mpu.irq()
+            # the IRQ is asserted and now masked
+            if not self._hooked:
+                mpu.add_hook(REENABLING_OPCODES, self._reenabled)
+                self._hooked = True
+
+    def _reenabled(self, mpu, address, opcode):
+        # called before an instruction that can clear the I flag
+        self.sample()
@@ -0,0 +1,549 @@
+"""Lockstep execution of many instances of an 8-bit MPU with NumPy.
+
+A LockstepMPU holds the registers of N machines, its lanes, as NumPy
+arrays and their memories as an N x 64K array, and executes one
+instruction on every lane per step().  The lanes are grouped by the
+opcode at their PC, so lanes running different code still progress, and
+each group is executed with array operations on all of its lanes at
+once.  The common instructions (loads, stores, arithmetic, logic,
+shifts, compares, transfers, flags, branches, JMP, JSR, RTS and stack
+operations) have array versions of the opcode handlers of the MPU
+class; any other instruction, including those a subclass overrides, is
+executed lane by lane with the MPU class itself.  Cycles are counted
+with the cycle tables of the MPU class.
+
+NumPy is needed for this module only:
+
+    from py65.devices.mpu6502 import MPU
+    from py65.lockstep import LockstepMPU
+
+    machines = LockstepMPU(MPU, 1000, memory=image, pc=0xC000)
+    machines.a[:] = range(1000)
+    machines.run(max_instructions=10000, stop_pcs=[0xC100])
+"""
+
+import numpy
+
+from py65.devices import mpu6502
+from py65.translator import OPERAND_LENGTHS
+
+
+# the scalar methods whose behavior the array version of each instruction
+# and addressing mode reproduces; an opcode is only executed with arrays
+# if the MPU class has the same methods as mpu6502.MPU
+OPERATIONS = {
+    'LDA': ('opLDA', 'FlagsNZ'), 'LDX': ('opLDX', 'FlagsNZ'),
+    'LDY': ('opLDY', 'FlagsNZ'), 'AND': ('opAND', 'FlagsNZ'),
+    'ORA': ('opORA', 'FlagsNZ'), 'EOR': ('opEOR', 'FlagsNZ'),
+    'ADC': ('opADC',), 'SBC': ('opSBC',), 'BIT': ('opBIT',),
+    'CMP': ('opCMPR',), 'CPX': ('opCMPR',), 'CPY': ('opCMPR',),
+    'STA': ('opSTA',), 'STX': ('opSTX',), 'STY': ('opSTY',),
+    'ASL': ('opASL',), 'LSR': ('opLSR',), 'ROL': ('opROL', 'FlagsNZ'),
+    'ROR': ('opROR', 'FlagsNZ'), 'INC': ('opINCR',), 'DEC': ('opDECR',),
+    'TAX': ('FlagsNZ',), 'TAY': ('FlagsNZ',), 'TXA': ('FlagsNZ',),
+    'TYA': ('FlagsNZ',), 'TSX': ('FlagsNZ',), 'TXS': (),
+    'INX': ('FlagsNZ',), 'INY': ('FlagsNZ',), 'DEX': ('FlagsNZ',),
+    'DEY': ('FlagsNZ',), 'CLC': ('opCLR',), 'CLD': ('opCLR',),
+    'CLI': ('opCLR',), 'CLV': ('opCLR',), 'SEC': ('opSET',),
+    'SED': ('opSET',), 'SEI': ('opSET',), 'NOP': (),
+    'BPL': ('opBCL', 'BranchRelAddr'), 'BMI': ('opBST', 'BranchRelAddr'),
+    'BVC': ('opBCL', 'BranchRelAddr'), 'BVS': ('opBST', 'BranchRelAddr'),
+    'BCC': ('opBCL', 'BranchRelAddr'), 'BCS': ('opBST', 'BranchRelAddr'),
+    'BNE': ('opBCL', 'BranchRelAddr'), 'BEQ': ('opBST', 'BranchRelAddr'),
+    'JMP': ('WordAt',), 'JSR': ('stPushWord', 'stPush', 'WordAt'),
+    'RTS': ('stPopWord', 'stPop'), 'PHA': ('stPush',),
+    'PLA': ('stPop', 'FlagsNZ'), 'PHP': ('stPush',), 'PLP': ('stPop',),
+    }
+
+MODES = {
+    'imp': (), 'acc': (), 'imm': ('ImmediateByte',),
+    'zpg': ('ZeroPageAddr',), 'zpx': ('ZeroPageXAddr',),
+    'zpy': ('ZeroPageYAddr',), 'abs': ('AbsoluteAddr', 'WordAt'),
+    'abx': ('AbsoluteXAddr', 'WordAt'), 'aby': ('AbsoluteYAddr', 'WordAt'),
+    'inx': ('IndirectXAddr', 'WrapAt'), 'iny': ('IndirectYAddr', 'WrapAt'),
+    'rel': (),
+    }
+
+READS = frozenset(['LDA', 'LDX', 'LDY', 'AND', 'ORA', 'EOR', 'ADC', 'SBC',
+                   'BIT', 'CMP', 'CPX', 'CPY'])
+WRITES = {'STA': 'a', 'STX': 'x', 'STY': 'y'}
+MODIFIES = frozenset(['ASL', 'LSR', 'ROL', 'ROR', 'INC', 'DEC'])
+TRANSFERS = {'TAX': ('a', 'x'), 'TAY': ('a', 'y'), 'TXA': ('x', 'a'),
+             'TYA': ('y', 'a'), 'TSX': ('sp', 'x'), 'TXS': ('x', 'sp')}
+COUNTS = {'INX': ('x', 1), 'INY': ('y', 1), 'DEX': ('x', -1),
+          'DEY': ('y', -1)}
+FLAGS = {'CLC': ('CARRY', False), 'CLD': ('DECIMAL', False),
+         'CLI': ('INTERRUPT', False), 'CLV': ('OVERFLOW', False),
+         'SEC': ('CARRY', True), 'SED': ('DECIMAL', True),
+         'SEI': ('INTERRUPT', True)}
+BRANCHES = {'BPL': ('NEGATIVE', False), 'BMI': ('NEGATIVE', True),
+            'BVC': ('OVERFLOW', False), 'BVS': ('OVERFLOW', True),
+            'BCC': ('CARRY', False), 'BCS': ('CARRY', True),
+            'BNE': ('ZERO', False), 'BEQ': ('ZERO', True)}
+
+REGISTERS = ('pc', 'a', 'x', 'y', 'sp', 'p')
+
+
+class LockstepMPU:
+    """lanes instances of mpu_type, an MPU class with 8-bit bytes and a
+    16-bit address space, executed in lockstep.
+
+    The registers are the arrays pc, a, x, y, sp and p, the cycle
+    counters the array cycles and the memories the array memory, with
+    a row per lane.  They may be read and changed in place.  memory, if
+    given, is the initial contents of the memory of every lane.
+    """
+
+    def __init__(self, mpu_type, lanes, memory=None, pc=0x0000):
+        if mpu_type.BYTE_WIDTH != 8 or mpu_type.ADDR_WIDTH != 16:
+            raise ValueError("only MPUs with 8-bit bytes are supported")
+        self.mpu_type = mpu_type
+        self.lanes = lanes
+        self.memory = numpy.zeros((lanes, 0x10000), numpy.uint8)
+        if memory is not None:
+            self.memory[:, :len(memory)] = numpy.asarray(memory[:0x10000],
+                                                         numpy.uint8)
+
+        # executes the instructions without an array version
+        self._mpu = mpu_type(pc=pc)
+        self._rows = [memoryview(row) for row in self.memory]
+
+        self.pc = numpy.full(lanes, pc, numpy.int64)
+        self.a = numpy.zeros(lanes, numpy.int64)
+        self.x = numpy.zeros(lanes, numpy.int64)
+        self.y = numpy.zeros(lanes, numpy.int64)
+        self.sp = numpy.full(lanes, self._mpu.sp, numpy.int64)
+        self.p = numpy.full(lanes, self._mpu.p, numpy.int64)
+        self.cycles = numpy.zeros(lanes, numpy.int64)
+        self.waiting = numpy.zeros(lanes, bool)
+
+        self._cycletime = numpy.array(mpu_type.cycletime, numpy.int64)
+        self._handlers = [self._make_handler(opcode) for opcode in
+                          range(len(mpu_type.instruct))]
+
+    def step(self, lanes=None):
+        """Execute one instruction on each lane, or on each of the lanes
+        in the array of lane numbers given"""
+        if lanes is None:
+            lanes = numpy.arange(self.lanes)
+        opcodes = self.memory[lanes, self.pc[lanes]].astype(numpy.int64)
+        opcodes[self.waiting[lanes]] = -1 # see _step_scalar()
+
+        # the lanes of each opcode are a run of the stable sort
+        order = numpy.argsort(opcodes, kind='stable')
+        sorted_opcodes = opcodes[order]
+        starts = numpy.flatnonzero(numpy.diff(sorted_opcodes)) + 1
+        bounds = [0] + starts.tolist() + [len(order)]
+        for start, stop in zip(bounds, bounds[1:]):
+            if start == stop:
+                continue
+            group = lanes[order[start:stop]]
+            opcode = int(sorted_opcodes[start])
+            handler = self._handlers[opcode] if opcode >= 0 else None
+            if handler is None:
+                self._step_scalar(group)
+            else:
+                handler(group)
+
+    def run(self, max_instructions, stop_pcs=()):
+        """Step the lanes until each has executed max_instructions
+        instructions or stopped at one of stop_pcs, checked after each
+        instruction.  Returns a boolean array of the lanes stopped at
+        one of stop_pcs."""
+        stop_pcs = numpy.array(sorted(stop_pcs), numpy.int64)
+        stopped = numpy.zeros(self.lanes, bool)
+        lanes = numpy.arange(self.lanes)
+        for count in range(max_instructions):
+            self.step(lanes)
+            if len(stop_pcs):
+                stopped[lanes] = numpy.isin(self.pc[lanes], stop_pcs)
+                lanes = lanes[~stopped[lanes]]
+                if not len(lanes):
+                    break
+        return stopped
+
+    def mpu(self, lane):
+        """Return a new instance of the MPU class in the state of a lane,
+        with a copy of its memory"""
+        mpu = self.mpu_type(memory=self.memory[lane].tolist())
+        self._load(mpu, lane)
+        mpu.processorCycles = int(self.cycles[lane])
+        return mpu
+
+    # instructions without an array version
+
+    def _step_scalar(self, lanes):
+        mpu = self._mpu
+        for lane in lanes.tolist():
+            mpu.memory = self._rows[lane]
+            self._load(mpu, lane)
+            mpu.processorCycles = 0
+            mpu.step()
+            for name in REGISTERS:
+                getattr(self, name)[lane] = getattr(mpu, name)
+            self.waiting[lane] = mpu.waiting
+            self.cycles[lane] += mpu.processorCycles
+
+    def _load(self, mpu, lane):
+        for name in REGISTERS:
+            setattr(mpu, name, int(getattr(self, name)[lane]))
+        mpu.waiting = bool(self.waiting[lane])
+
+    # array versions of the instructions
+
+    def _make_handler(self, opcode):
+        # the function executing opcode on an array of lanes, or None if
+        # it has no array version for the MPU class
+        cls = self.mpu_type
+        name, mode = cls.disassemble[opcode]
+        method = 'inst_0x%02x' % opcode
+        if (name not in OPERATIONS or mode not in MODES or
+                getattr(cls, method, None) is not
+                getattr(mpu6502.MPU, method, None)):
+            return None
+        for scalar in OPERATIONS[name] + MODES[mode] + ('ByteAt',):
+            if getattr(cls, scalar) is not getattr(mpu6502.MPU, scalar):
+                return None
+
+        length = OPERAND_LENGTHS[mode]
+        cycles = cls.cycletime[opcode]
+        addcycles = cls.extracycles[opcode]
+
+        if name in READS:
+            operation = getattr(self, '_op' + name)
+            def handler(lanes):
+                if name in ('ADC', 'SBC'):
+                    # decimal mode is left to the MPU class
+                    decimal = (self.p[lanes] & cls.DECIMAL) != 0
+                    if decimal.any():
+                        self._step_scalar(lanes[decimal])
+                        lanes = lanes[~decimal]
+                pc = self.pc[lanes]
+                if mode == 'imm':
+                    value = self._bytes(lanes, (pc + 1) & 0xFFFF)
+                    excycles = 0
+                else:
+                    address, excycles = self._address(mode, lanes, pc,
+                                                       addcycles)
+                    value = self._bytes(lanes, address)
+                operation(lanes, value)
+                self.pc[lanes] = (pc + 1 + length) & 0xFFFF
+                self.cycles[lanes] += cycles + excycles
+
+        elif name in WRITES:
+            register = getattr(self, WRITES[name])
+            def handler(lanes):
+                pc = self.pc[lanes]
+                address, excycles = self._address(mode, lanes, pc, addcycles)
+                self.memory[lanes, address] = register[lanes]
+                self.pc[lanes] = (pc + 1 + length) & 0xFFFF
+                self.cycles[lanes] += cycles + excycles
+
+        elif name in MODIFIES:
+            operation = getattr(self, '_op' + name)
+            def handler(lanes):
+                pc = self.pc[lanes]
+                excycles = 0
+                if mode == 'acc':
+                    self.a[lanes] = operation(lanes, self.a[lanes])
+                else:
+                    address, excycles = self._address(mode, lanes, pc,
+                                                      addcycles)
+                    value = self._bytes(lanes, address)
+                    self.memory[lanes, address] = operation(lanes, value)
+                self.pc[lanes] = (pc + 1 + length) & 0xFFFF
+                self.cycles[lanes] += cycles + excycles
+
+        elif name in BRANCHES:
+            flag, when_set = BRANCHES[name]
+            mask = getattr(cls, flag)
+            def handler(lanes):
+                pc = (self.pc[lanes] + 1) & 0xFFFF
+                taken = ((self.p[lanes] & mask) != 0) == when_set
+                offset = self._bytes(lanes, pc)
+                following = pc + 1
+                target = numpy.where(offset & 0x80, following + offset - 0x100,
+                                     following + offset)
+                crossed = (following & 0xFF00) != (target & 0xFF00)
+                self.pc[lanes] = numpy.where(taken, target,
+                                             following) & 0xFFFF
+                self.cycles[lanes] += (cycles + taken +
+                                       (taken & crossed))
+
+        else:
+            operation = getattr(self, '_op' + name)
+            def handler(lanes):
+                pc = self.pc[lanes]
+                self.pc[lanes] = (pc + 1 + length) & 0xFFFF
+                operation(lanes)
+                self.cycles[lanes] += cycles
+
+        return handler
+
+    def _bytes(self, lanes, addresses):
+        return self.memory[lanes, addresses].astype(numpy.int64)
+
+    def _word(self, lanes, address):
+        return (self._bytes(lanes, address) +
+                (self._bytes(lanes, (address + 1) & 0xFFFF) << 8))
+
+    def _zero_page_word(self, lanes, address):
+        # WrapAt() of a zero page address
+        return (self._bytes(lanes, address) +
+                (self._bytes(lanes, (address + 1) & 0xFF) << 8))
+
+    def _address(self, mode, lanes, pc, addcycles):
+        # the effective addresses of the operands of instructions at pc,
+        # and the extra cycles taken by crossing a page
+        operand = (pc + 1) & 0xFFFF
+        if mode == 'zpg':
+            return self._bytes(lanes, operand), 0
+        if mode == 'zpx':
+            return (self._bytes(lanes, operand) + self.x[lanes]) & 0xFF, 0
+        if mode == 'zpy':
+            return (self._bytes(lanes, operand) + self.y[lanes]) & 0xFF, 0
+        if mode == 'abs':
+            return self._word(lanes, operand), 0
+        if mode == 'inx':
+            pointer = (self._bytes(lanes, operand) + self.x[lanes]) & 0xFF
+            return self._zero_page_word(lanes, pointer), 0
+        if mode == 'abx':
+            base, index = self._word(lanes, operand), self.x[lanes]
+        elif mode == 'aby':
+            base, index = self._word(lanes, operand), self.y[lanes]
+        else: # iny
+            base = self._zero_page_word(lanes, self._bytes(lanes, operand))
+            index = self.y[lanes]
+        address = (base + index) & 0xFFFF
+        if addcycles:
+            return address, (base & 0xFF00) != (address & 0xFF00)
+        return address, 0
+
+    def _flags_nz(self, lanes, value, clear=0):
+        cls = self.mpu_type
+        p = self.p[lanes] & ~(cls.ZERO | cls.NEGATIVE | clear)
+        self.p[lanes] = (p | numpy.where(value == 0, cls.ZERO, 0) |
+                         (value & cls.NEGATIVE))
+
+    def _set_flag(self, lanes, flag, condition):
+        self.p[lanes] |= numpy.where(condition, flag, 0)
+
+    def _push(self, lanes, value):
+        sp = self.sp[lanes]
+        self.memory[lanes, 0x100 + sp] = value & 0xFF
+        self.sp[lanes] = (sp - 1) & 0xFF
+
+    def _pop(self, lanes):
+        sp = self.sp[lanes] = (self.sp[lanes] + 1) & 0xFF
+        return self._bytes(lanes, 0x100 + sp)
+
+    # reads
+
+    def _opLDA(self, lanes, value):
+        self.a[lanes] = value
+        self._flags_nz(lanes, value)
+
+    def _opLDX(self, lanes, value):
+        self.x[lanes] = value
+        self._flags_nz(lanes, value)
+
+    def _opLDY(self, lanes, value):
+        self.y[lanes] = value
+        self._flags_nz(lanes, value)
+
+    def _opAND(self, lanes, value):
+        self._opLDA(lanes, self.a[lanes] & value)
+
+    def _opORA(self, lanes, value):
+        self._opLDA(lanes, self.a[lanes] | value)
+
+    def _opEOR(self, lanes, value):
+        self._opLDA(lanes, self.a[lanes] ^ value)
+
+    def _opADC(self, lanes, value):
+        cls = self.mpu_type
+        a = self.a[lanes]
+        result = value + a + (self.p[lanes] & cls.CARRY)
+        masked = result & 0xFF
+        self._flags_nz(lanes, masked, cls.CARRY | cls.OVERFLOW)
+        self._set_flag(lanes, cls.OVERFLOW,
+                       ~(a ^ value) & (a ^ result) & cls.NEGATIVE)
+        self._set_flag(lanes, cls.CARRY, result > 0xFF)
+        self.a[lanes] = masked
+
+    def _opSBC(self, lanes, value):
+        cls = self.mpu_type
+        a = self.a[lanes]
+        result = a + (~value & 0xFF) + (self.p[lanes] & cls.CARRY)
+        masked = result & 0xFF
+        self._flags_nz(lanes, masked, cls.CARRY | cls.OVERFLOW)
+        self._set_flag(lanes, cls.OVERFLOW,
+                       (a ^ value) & (a ^ result) & cls.NEGATIVE)
+        self._set_flag(lanes, cls.CARRY, result > 0xFF)
+        self.a[lanes] = masked
+
+    def _opBIT(self, lanes, value):
+        cls = self.mpu_type
+        p = self.p[lanes] & ~(cls.ZERO | cls.NEGATIVE | cls.OVERFLOW)
+        self.p[lanes] = (p |
+                         numpy.where(self.a[lanes] & value, 0, cls.ZERO) |
+                         (value & (cls.NEGATIVE | cls.OVERFLOW)))
+
+    def _compare(self, lanes, register, value):
+        cls = self.mpu_type
+        self._flags_nz(lanes, (register - value) & 0xFF, cls.CARRY)
+        self._set_flag(lanes, cls.CARRY, register >= value)
+
+    def _opCMP(self, lanes, value):
+        self._compare(lanes, self.a[lanes], value)
+
+    def _opCPX(self, lanes, value):
+        self._compare(lanes, self.x[lanes], value)
+
+    def _opCPY(self, lanes, value):
+        self._compare(lanes, self.y[lanes], value)
+
+    # read-modify-writes, returning the value written
+
+    def _opASL(self, lanes, value):
+        cls = self.mpu_type
+        result = (value << 1) & 0xFF
+        self._flags_nz(lanes, result, cls.CARRY)
+        self._set_flag(lanes, cls.CARRY, value & 0x80)
+        return result
+
+    def _opLSR(self, lanes, value):
+        cls = self.mpu_type
+        result = value >> 1
+        self._flags_nz(lanes, result, cls.CARRY)
+        self._set_flag(lanes, cls.CARRY, value & 1)
+        return result
+
+    def _opROL(self, lanes, value):
+        cls = self.mpu_type
+        result = ((value << 1) | (self.p[lanes] & cls.CARRY)) & 0xFF
+        self._flags_nz(lanes, result, cls.CARRY)
+        self._set_flag(lanes, cls.CARRY, value & 0x80)
+        return result
+
+    def _opROR(self, lanes, value):
+        cls = self.mpu_type
+        result = (value >> 1) | ((self.p[lanes] & cls.CARRY) << 7)
+        self._flags_nz(lanes, result, cls.CARRY)
+        self._set_flag(lanes, cls.CARRY, value & 1)
+        return result
+
+    def _opINC(self, lanes, value):
+        result = (value + 1) & 0xFF
+        self._flags_nz(lanes, result)
+        return result
+
+    def _opDEC(self, lanes, value):
+        result = (value - 1) & 0xFF
+        self._flags_nz(lanes, result)
+        return result
+
+    # implied, with the pc of the lanes already past the instruction
+
+    def _transfer(self, lanes, source, destination, flags=True):
+        value = getattr(self, source)[lanes]
+        getattr(self, destination)[lanes] = value
+        if flags:
+            self._flags_nz(lanes, value)
+
+    def _opTAX(self, lanes):
+        self._transfer(lanes, 'a', 'x')
+
+    def _opTAY(self, lanes):
+        self._transfer(lanes, 'a', 'y')
+
+    def _opTXA(self, lanes):
+        self._transfer(lanes, 'x', 'a')
+
+    def _opTYA(self, lanes):
+        self._transfer(lanes, 'y', 'a')
+
+    def _opTSX(self, lanes):
+        self._transfer(lanes, 'sp', 'x')
+
+    def _opTXS(self, lanes):
+        self._transfer(lanes, 'x', 'sp', flags=False)
+
+    def _count(self, lanes, register, increment):
+        value = (getattr(self, register)[lanes] + increment) & 0xFF
+        getattr(self, register)[lanes] = value
+        self._flags_nz(lanes, value)
+
+    def _opINX(self, lanes):
+        self._count(lanes, 'x', 1)
+
+    def _opINY(self, lanes):
+        self._count(lanes, 'y', 1)
+
+    def _opDEX(self, lanes):
+        self._count(lanes, 'x', -1)
+
+    def _opDEY(self, lanes):
+        self._count(lanes, 'y', -1)
+
+    def _flag(self, lanes, name):
+        flag, value = FLAGS[name]
+        if value:
+            self.p[lanes] |= getattr(self.mpu_type, flag)
+        else:
+            self.p[lanes] &= ~getattr(self.mpu_type, flag)
+
+    def _opCLC(self, lanes):
+        self._flag(lanes, 'CLC')
+
+    def _opCLD(self, lanes):
+        self._flag(lanes, 'CLD')
+
+    def _opCLI(self, lanes):
+        self._flag(lanes, 'CLI')
+
+    def _opCLV(self, lanes):
+        self._flag(lanes, 'CLV')
+
+    def _opSEC(self, lanes):
+        self._flag(lanes, 'SEC')
+
+    def _opSED(self, lanes):
+        self._flag(lanes, 'SED')
+
+    def _opSEI(self, lanes):
+        self._flag(lanes, 'SEI')
+
+    def _opNOP(self, lanes):
+        pass
+
+    def _opJMP(self, lanes):
+        # the pc is past the operand
+        self.pc[lanes] = self._word(lanes, (self.pc[lanes] - 2) & 0xFFFF)
+
+    def _opJSR(self, lanes):
+        # pushes the address of the last byte of the instruction, then
+        # reads the operand, as inst_0x20() does
+        returns = (self.pc[lanes] - 1) & 0xFFFF
+        self._push(lanes, returns >> 8)
+        self._push(lanes, returns)
+        self.pc[lanes] = self._word(lanes, (returns - 1) & 0xFFFF)
+
+    def _opRTS(self, lanes):
+        low = self._pop(lanes)
+        high = self._pop(lanes)
+        self.pc[lanes] = (low + (high << 8) + 1) & 0xFFFF
+
+    def _opPHA(self, lanes):
+        self._push(lanes, self.a[lanes])
+
+    def _opPLA(self, lanes):
+        self._opLDA(lanes, self._pop(lanes))
+
+    def _opPHP(self, lanes):
+        cls = self.mpu_type
+        self._push(lanes, self.p[lanes] | cls.BREAK | cls.UNUSED)
+
+    def _opPLP(self, lanes):
+        cls = self.mpu_type
+        self.p[lanes] = self._pop(lanes) | cls.BREAK | cls.UNUSED
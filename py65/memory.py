@@ -1,4 +1,106 @@
-from collections import defaultdict
+import copy
+import mmap
+import os
+import sys
+from array import array
+
+
+def _make_buffer(byteWidth, size):
+    """A buffer of size zeros, bytes or 16-bit words"""
+    if byteWidth == 8:
+        return bytearray(size)
+    return array('H', bytes(2 * size))
+
+
+def _make_array(byteWidth, values):
+    """A buffer holding values, bytes or 16-bit words"""
+    if byteWidth == 8:
+        return bytearray(values)
+    words = array('H')
+    words.extend(values)
+    return words
+
+
+def _join_pages(byteWidth, pages):
+    """The contents of the page buffers as one bytes, or an array of
+    16-bit words, for pickling"""
+    data = b''.join(page.tobytes() for page in pages)
+    if byteWidth == 8:
+        return data
+    words = array('H')
+    words.frombytes(data)
+    return words
+
+
+def _copy_buffer(view):
+    """A copy of the contents of a memoryview of bytes or 16-bit words,
+    in a new buffer"""
+    if view.format == 'H':
+        words = array('H')
+        words.frombytes(view.tobytes())
+        return words
+    return bytearray(view.tobytes())
+
+
+def _pack_values(values):
+    # a list of values as bytes, or an array of 16-bit words, which
+    # pickle far smaller; the list itself if its values do not fit
+    try:
+        return bytes(values)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return array('H', values)
+    except (OverflowError, TypeError):
+        return values
+
+
+class DirtyPages:
+    """A bitmap of the pages of 1 << page_bits addresses that have been
+    written to since it was last cleared.
+
+    Assigning one to mpu.dirty_pages makes the MPU mark the pages it
+    writes to; it is also given to the memory of the MPU if that has a
+    dirty_pages attribute (ObservableMemory, PagedMemory and Bus), so
+    that writes through the memory object are marked as well.  Marking a
+    page is a single store, cheap enough to leave on.
+    """
+
+    def __init__(self, addrWidth=16, page_bits=None):
+        if page_bits is None:
+            page_bits = 8 if addrWidth <= 16 else 16
+        self.page_bits = page_bits
+        self.bitmap = bytearray(1 << max(addrWidth - page_bits, 0))
+
+    def mark(self, address):
+        self.bitmap[address >> self.page_bits] = 1
+
+    def mark_range(self, start, stop):
+        """Mark the pages of the addresses from start to stop - 1"""
+        first = start >> self.page_bits
+        last = min((stop - 1) >> self.page_bits, len(self.bitmap) - 1)
+        if first <= last:
+            self.bitmap[first:last + 1] = b'\x01' * (last + 1 - first)
+
+    def dirty(self):
+        """The numbers of the pages that are dirty, in order"""
+        pages = []
+        page = self.bitmap.find(1)
+        while page != -1:
+            pages.append(page)
+            page = self.bitmap.find(1, page + 1)
+        return pages
+
+    def clear(self):
+        """Mark all pages clean"""
+        self.bitmap[:] = bytes(len(self.bitmap))
+
+    def take(self):
+        """The numbers of the pages that are dirty, after which all are
+        marked clean"""
+        pages = self.dirty()
+        self.clear()
+        return pages
 
 
 class ObservableMemory:
@@ -12,62 +114,1363 @@ class ObservableMemory:
             subject = (self.physMask + 1) * [0x00]
         self._subject = subject
 
-        self._read_subscribers = defaultdict(list)
-        self._write_subscribers = defaultdict(list)
+        self._read_subscribers = _Subscriptions(self.physMask + 1)
+        self._write_subscribers = _Subscriptions(self.physMask + 1)
+        self._protected = _Subscriptions(self.physMask + 1)
+        self.dirty_pages = None # see DirtyPages
 
     def __setitem__(self, address, value):
         if isinstance(address, slice):
             r = range(*address.indices(self.physMask + 1))
-            for n, v in zip(r, value):
-                self[n] = v
+            if r.step != 1:
+                for n, v in zip(r, value):
+                    self[n] = v
+                return
+            # copy the runs of addresses without subscribers at once
+            values = list(value)[:len(r)]
+            subscribers = self._write_subscribers
+            for start, stop, observed in subscribers.segments(
+                    r.start, r.start + len(values)):
+                run = values[start - r.start:stop - r.start]
+                if observed or self._protected.overlaps(start, stop):
+                    for n, v in zip(range(start, stop), run):
+                        self[n] = v
+                else:
+                    self._subject[start:stop] = run
+                    if self.dirty_pages is not None:
+                        self.dirty_pages.mark_range(start, stop)
             return
 
         address &= self.physMask
-        callbacks = self._write_subscribers[address]
-
-        for callback in callbacks:
-            result = callback(address, value)
-            if result is not None:
-                value = result
+        subscribers = self._write_subscribers
+        if subscribers.pages[address >> subscribers.page_bits]:
+            for callback in subscribers[address]:
+                result = callback(address, value)
+                if result is not None:
+                    value = result
+        protected = self._protected
+        if (protected.pages[address >> protected.page_bits] and
+                _protected_write(protected, address, value)):
+            return
 
         self._subject[address] = value
+        if self.dirty_pages is not None:
+            self.dirty_pages.mark(address)
 
     def __getitem__(self, address):
         if isinstance(address, slice):
             r = range(*address.indices(self.physMask + 1))
-            return [ self[n] for n in r ]
+            if r.step != 1:
+                return [ self[n] for n in r ]
+            # copy the runs of addresses without subscribers at once
+            values = []
+            for start, stop, observed in self._read_subscribers.segments(
+                    r.start, r.stop):
+                if observed:
+                    values.extend(self[n] for n in range(start, stop))
+                else:
+                    values.extend(self._subject[start:stop])
+            return values
 
         address &= self.physMask
-        callbacks = self._read_subscribers[address]
-        final_result = None
-
-        for callback in callbacks:
-            result = callback(address)
-            if result is not None:
-                final_result = result
-
-        if final_result is None:
-            return self._subject[address]
-        else:
-            return final_result
+        subscribers = self._read_subscribers
+        if subscribers.pages[address >> subscribers.page_bits]:
+            final_result = None
+            for callback in subscribers[address]:
+                result = callback(address)
+                if result is not None:
+                    final_result = result
+            if final_result is not None:
+                return final_result
+        return self._subject[address]
 
     def __getattr__(self, attribute):
         return getattr(self._subject, attribute)
 
-    def subscribe_to_write(self, address_range, callback):
-        for address in address_range:
-            address &= self.physMask
-            callbacks = self._write_subscribers.setdefault(address, [])
-            if callback not in callbacks:
-                callbacks.append(callback)
+    def subscribe_to_write(self, address_range, callback, replace=False):
+        """Call callback(address, value) before each write to an address
+        in address_range.  If it returns a value other than None, that
+        value is written instead.  If replace is true, the callbacks
+        already subscribed to these addresses are unsubscribed first."""
+        self._write_subscribers.add(address_range, callback, replace)
 
-    def subscribe_to_read(self, address_range, callback):
-        for address in address_range:
-            address &= self.physMask
-            callbacks = self._read_subscribers.setdefault(address, [])
-            if callback not in callbacks:
-                callbacks.append(callback)
+    def subscribe_to_read(self, address_range, callback, replace=False):
+        """Call callback(address) on each read of an address in
+        address_range.  If it returns a value other than None, that value
+        is read instead.  If replace is true, the callbacks already
+        subscribed to these addresses are unsubscribed first."""
+        self._read_subscribers.add(address_range, callback, replace)
+
+    def unsubscribe_from_write(self, address_range, callback=None):
+        """Unsubscribe callback, or all callbacks if it is None, from
+        writes to the addresses in address_range"""
+        self._write_subscribers.remove(address_range, callback)
+
+    def unsubscribe_from_read(self, address_range, callback=None):
+        """Unsubscribe callback, or all callbacks if it is None, from
+        reads of the addresses in address_range"""
+        self._read_subscribers.remove(address_range, callback)
+
+    def protect(self, address_range, on_write=None):
+        """Make the addresses in address_range read-only, like ROM.
+        Writes to them are ignored, except by write(), which loads them.
+        If on_write is given, on_write(address, value) is called with
+        each write ignored, e.g. to count them or to raise an exception
+        that stops the program."""
+        self._protected.add(address_range, on_write)
+
+    def unprotect(self, address_range):
+        """Make the addresses in address_range writable again"""
+        self._protected.remove(address_range)
 
     def write(self, start_address, bytes):
         start_address &= self.physMask
         self._subject[start_address:start_address + len(bytes)] = bytes
+        if self.dirty_pages is not None:
+            self.dirty_pages.mark_range(start_address,
+                                        start_address + len(bytes))
+
+    # snapshot(), restore() and fork() copy the subject, or use its own
+    # snapshots if it has them, without calling the callbacks
+
+    def snapshot(self):
+        """Return the contents of memory, for restore()"""
+        subject = self._subject
+        if hasattr(subject, 'snapshot'):
+            return subject.snapshot()
+        return subject[:]
+
+    def restore(self, snapshot):
+        """Set the contents of memory to those of a snapshot"""
+        subject = self._subject
+        if hasattr(subject, 'restore'):
+            subject.restore(snapshot)
+        else:
+            subject[:] = snapshot
+
+    def fork(self):
+        """Return a new ObservableMemory with a copy (or a fork) of the
+        subject and the same subscriptions and protection"""
+        subject = self._subject
+        memory = copy.copy(self)
+        if hasattr(subject, 'fork'):
+            memory._subject = subject.fork()
+        else:
+            memory._subject = subject[:]
+        memory._read_subscribers = self._read_subscribers.copy()
+        memory._write_subscribers = self._write_subscribers.copy()
+        memory._protected = self._protected.copy()
+        memory.dirty_pages = None
+        return memory
+
+    # pickling keeps a list subject as bytes (or an array of words) and
+    # the callbacks as they are, so those that are closures or lambdas
+    # need py65.utils.serialization to re-attach them by name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if type(self._subject) is list:
+            state['_subject'] = _pack_values(self._subject)
+            state['_subject_packed'] = True
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        if state.pop('_subject_packed', False):
+            state['_subject'] = list(state['_subject'])
+        self.__dict__.update(state)
+
+
+def _protected_write(protected, address, value):
+    # true if address is write-protected, after calling the on_write
+    # hooks of its protected ranges with the write
+    hooks = protected[address]
+    for on_write in hooks:
+        if on_write is not None:
+            on_write(address, value)
+    return bool(hooks)
+
+
+class _Subscriptions:
+    """Callbacks subscribed to ranges of addresses from 0 to size - 1.
+
+    Each subscription is kept as one (start, stop, callback) interval,
+    so subscribing and unsubscribing cost time in proportion to the
+    number of subscriptions, not the number of addresses.  For looking
+    up the callbacks of an address quickly, pages[address >> page_bits]
+    holds the subscriptions overlapping its page; it is empty for most
+    pages.  An address range is a range or any iterable of addresses;
+    addresses are taken modulo size.
+    """
+
+    def __init__(self, size, page_bits=8):
+        self.size = size
+        self.page_bits = page_bits
+        self.ranges = [] # in the order subscribed
+        self.pages = [()] * ((size + (1 << page_bits) - 1) >> page_bits)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __getitem__(self, address):
+        """The callbacks subscribed to address, each once, in the order
+        they were first subscribed"""
+        callbacks = []
+        for start, stop, callback in self.pages[address >> self.page_bits]:
+            if start <= address < stop and callback not in callbacks:
+                callbacks.append(callback)
+        return callbacks
+
+    def intervals(self, address_range):
+        """The (start, stop) intervals of the addresses in address_range"""
+        if isinstance(address_range, range) and address_range.step == 1:
+            start = address_range.start % self.size
+            stop = start + min(len(address_range), self.size)
+            if stop <= self.size:
+                return [(start, stop)] if start < stop else []
+            return [(start, self.size), (0, stop - self.size)]
+
+        intervals = []
+        for address in sorted(set(a % self.size for a in address_range)):
+            if intervals and intervals[-1][1] == address:
+                intervals[-1][1] = address + 1
+            else:
+                intervals.append([address, address + 1])
+        return [tuple(interval) for interval in intervals]
+
+    def segments(self, start, stop):
+        """Split the addresses from start to stop - 1 into runs that are
+        all subscribed to or not, returned as (start, stop, observed)"""
+        observed = sorted((max(first, start), min(last, stop))
+                          for first, last, callback in self.ranges
+                          if first < stop and start < last)
+        segments = []
+        for first, last in observed:
+            if segments and first <= segments[-1][1]:
+                # overlaps or adjoins the previous observed run
+                segments[-1][1] = max(segments[-1][1], last)
+            else:
+                if start < first:
+                    segments.append([start, first, False])
+                segments.append([first, last, True])
+            start = segments[-1][1]
+        if start < stop:
+            segments.append([start, stop, False])
+        return [tuple(segment) for segment in segments]
+
+    def __getstate__(self):
+        # pages is rebuilt from ranges
+        return (self.size, self.page_bits, self.ranges)
+
+    def __setstate__(self, state):
+        size, page_bits, ranges = state
+        self.__init__(size, page_bits)
+        self.ranges = list(ranges)
+        self._index([(start, stop) for start, stop, callback in ranges])
+
+    def copy(self):
+        subscriptions = _Subscriptions(self.size, self.page_bits)
+        subscriptions.ranges = list(self.ranges)
+        subscriptions.pages = list(self.pages)
+        return subscriptions
+
+    def overlaps(self, start, stop):
+        """True if any address from start to stop - 1 has callbacks"""
+        return any(first < stop and start < last
+                   for first, last, callback in self.ranges)
+
+    def add(self, address_range, callback, replace=False):
+        """Subscribe callback to the addresses in address_range, after
+        unsubscribing all callbacks from them if replace is true.
+        Returns the intervals of the addresses."""
+        intervals = self.intervals(address_range)
+        if replace:
+            self._remove(intervals, None)
+        for start, stop in intervals:
+            self.ranges.append((start, stop, callback))
+        self._index(intervals)
+        return intervals
+
+    def remove(self, address_range, callback=None):
+        """Remove callback, or all callbacks if it is None, from the
+        addresses in address_range.  Returns the intervals of the
+        addresses."""
+        intervals = self.intervals(address_range)
+        self._remove(intervals, callback)
+        self._index(intervals)
+        return intervals
+
+    def _remove(self, intervals, callback):
+        for start, stop in intervals:
+            ranges = []
+            for first, last, subscribed in self.ranges:
+                if (first < stop and start < last and
+                        callback in (None, subscribed)):
+                    # keep the parts outside of the removed interval
+                    if first < start:
+                        ranges.append((first, start, subscribed))
+                    if stop < last:
+                        ranges.append((stop, last, subscribed))
+                else:
+                    ranges.append((first, last, subscribed))
+            self.ranges = ranges
+
+    def _index(self, intervals):
+        # update the entries of pages for the pages of intervals
+        for start, stop in intervals:
+            for page in range(start >> self.page_bits,
+                              ((stop - 1) >> self.page_bits) + 1):
+                page_start = page << self.page_bits
+                page_stop = page_start + (1 << self.page_bits)
+                self.pages[page] = tuple(
+                    subscription for subscription in self.ranges
+                    if subscription[0] < page_stop and
+                    page_start < subscription[1])
+
+
+class PagedMemory:
+    """Memory backed by a bytearray, or an array('H') for 16-bit bytes,
+    per page, with the same interface as ObservableMemory.
+
+    The address space is divided into pages of 1 << page_bits addresses.
+    read_pages and write_pages hold an entry per page that is indexed by
+    the offset within the page: a memoryview of the buffer for a page
+    without subscribers, or an object calling the subscribers.  An MPU
+    given this memory accesses it through these page tables directly, so
+    only the pages with subscribers cost a Python call per access.  Both
+    tables have an extra entry at the end for the first page again, so
+    that an access just past the end of the address space wraps around.
+
+    snapshot(), restore() and fork() share the buffers of the pages
+    until they are written to, when the page being written is copied.
+
+    Like ObservableMemory, an address space wider than 16 bits is
+    modeled with 256K addresses that repeat.
+    """
+
+    def __init__(self, addrWidth=16, byteWidth=8, page_bits=None):
+        self.physMask = 0xffff
+        if addrWidth > 16:
+            # even with 32-bit address space, model only 256k memory
+            self.physMask = 0x3ffff
+        if page_bits is None:
+            # keep the page tables of a wide address space small
+            page_bits = 8 if addrWidth <= 16 else 16
+        self.addrWidth = addrWidth
+        self.byteWidth = byteWidth
+        self.page_bits = page_bits
+        self._offset_mask = (1 << page_bits) - 1
+
+        size = self.physMask + 1
+        page_size = min(1 << page_bits, size)
+        self._ram_pages = [memoryview(_make_buffer(byteWidth, page_size))
+                           for start in range(0, size, page_size)]
+        # the pages whose buffers are shared by a snapshot or fork,
+        # which are copied before they are written to
+        self._shared = set()
+
+        page_count = 1 << max(addrWidth - page_bits, 0)
+        physical_pages = len(self._ram_pages)
+        self.read_pages = [self._ram_pages[page % physical_pages]
+                           for page in range(page_count + 1)]
+        self.write_pages = list(self.read_pages)
+
+        self._read_subscribers = _Subscriptions(self.physMask + 1)
+        self._write_subscribers = _Subscriptions(self.physMask + 1)
+        self._protected = _Subscriptions(self.physMask + 1)
+        self._discarded = None # see _discard_page()
+        self.dirty_pages = None # see DirtyPages
+
+    def _map_page(self, physical):
+        # point the table entries of a physical page (and those of its
+        # repeats) at its buffer or at an object handling the accesses
+        read_entry, write_entry = self._page_entries(physical)
+        for index in range(physical, len(self.read_pages),
+                           len(self._ram_pages)):
+            self.read_pages[index] = read_entry
+            self.write_pages[index] = write_entry
+
+    def _page_entries(self, physical):
+        # the read and write table entries of a physical page
+        read_observed = self._has_subscribers(self._read_subscribers,
+                                              physical)
+        write_observed = self._has_subscribers(self._write_subscribers,
+                                               physical)
+        protected = self._has_subscribers(self._protected, physical)
+        if read_observed or write_observed or protected:
+            observed = _ObservedPage(self, physical << self.page_bits)
+        ram = self._ram_pages[physical]
+        if read_observed:
+            read_entry = observed
+        else:
+            read_entry = ram
+        if write_observed:
+            write_entry = observed
+        elif protected and self._discards_writes(physical):
+            write_entry = self._discard_page()
+        elif protected:
+            write_entry = observed
+        elif physical in self._shared:
+            write_entry = _CopyOnWritePage(self, physical)
+        else:
+            write_entry = ram
+        return read_entry, write_entry
+
+    def _has_subscribers(self, subscribers, physical):
+        start = physical << self.page_bits
+        return subscribers.overlaps(start, start + (1 << self.page_bits))
+
+    def _discards_writes(self, physical):
+        # true if the whole of a physical page is protected without
+        # on_write hooks, so its writes need no Python call
+        start = physical << self.page_bits
+        stop = start + (1 << self.page_bits)
+        return (self._protected.segments(start, stop) ==
+                [(start, stop, True)] and
+                all(on_write is None
+                    for first, last, on_write in self._protected.ranges
+                    if first < stop and start < last))
+
+    def _discard_page(self):
+        # a page buffer that the writes to protected pages go to and
+        # that is never read
+        if self._discarded is None:
+            self._discarded = memoryview(
+                _make_buffer(self.byteWidth, 1 << self.page_bits))
+        return self._discarded
+
+    def _writable_page(self, physical):
+        # the buffer of a physical page, copied first if it is shared
+        if physical in self._shared:
+            page = self._ram_pages[physical]
+            if self.byteWidth == 8:
+                copy = bytearray(page)
+            else:
+                copy = array('H', page.tobytes())
+            self._ram_pages[physical] = memoryview(copy)
+            self._shared.discard(physical)
+            self._map_page(physical)
+        return self._ram_pages[physical]
+
+    def __len__(self):
+        return self.physMask + 1
+
+    def __setitem__(self, address, value):
+        if isinstance(address, slice):
+            r = range(*address.indices(self.physMask + 1))
+            if r.step != 1:
+                for n, v in zip(r, value):
+                    self[n] = v
+                return
+            values = list(value)[:len(r)]
+            for start, stop, observed in self._write_subscribers.segments(
+                    r.start, r.start + len(values)):
+                run = values[start - r.start:stop - r.start]
+                if observed or self._protected.overlaps(start, stop):
+                    for n, v in zip(range(start, stop), run):
+                        self[n] = v
+                else:
+                    self._write_run(start, run)
+            return
+
+        address &= self.physMask
+        subscribers = self._write_subscribers
+        if subscribers.pages[address >> subscribers.page_bits]:
+            for callback in subscribers[address]:
+                result = callback(address, value)
+                if result is not None:
+                    value = result
+        protected = self._protected
+        if (protected.pages[address >> protected.page_bits] and
+                _protected_write(protected, address, value)):
+            return
+
+        self._writable_page(address >> self.page_bits)[
+            address & self._offset_mask] = value
+        if self.dirty_pages is not None:
+            self.dirty_pages.mark(address)
+
+    def __getitem__(self, address):
+        if isinstance(address, slice):
+            r = range(*address.indices(self.physMask + 1))
+            if r.step != 1:
+                return [ self[n] for n in r ]
+            values = []
+            for start, stop, observed in self._read_subscribers.segments(
+                    r.start, r.stop):
+                if observed:
+                    values.extend(self[n] for n in range(start, stop))
+                else:
+                    values.extend(self._read_run(start, stop))
+            return values
+
+        address &= self.physMask
+        subscribers = self._read_subscribers
+        if subscribers.pages[address >> subscribers.page_bits]:
+            final_result = None
+            for callback in subscribers[address]:
+                result = callback(address)
+                if result is not None:
+                    final_result = result
+            if final_result is not None:
+                return final_result
+        return self._ram_pages[address >> self.page_bits][
+            address & self._offset_mask]
+
+    def _read_run(self, start, stop):
+        # the values from start to stop - 1, bypassing subscribers
+        values = []
+        while start < stop:
+            offset = start & self._offset_mask
+            count = min(stop - start, (self._offset_mask + 1) - offset)
+            page = self._ram_pages[start >> self.page_bits]
+            values.extend(page[offset:offset + count])
+            start += count
+        return values
+
+    def _write_run(self, start, values):
+        # write values from start on, bypassing subscribers, wrapping
+        # around at the end of memory
+        index = 0
+        while index < len(values):
+            start &= self.physMask
+            offset = start & self._offset_mask
+            count = min(len(values) - index,
+                        (self._offset_mask + 1) - offset)
+            page = self._writable_page(start >> self.page_bits)
+            page[offset:offset + count] = _make_array(
+                self.byteWidth, values[index:index + count])
+            if self.dirty_pages is not None:
+                self.dirty_pages.mark_range(start, start + count)
+            start += count
+            index += count
+
+    def subscribe_to_write(self, address_range, callback, replace=False):
+        self._remap(self._write_subscribers.add(address_range, callback,
+                                                replace))
+
+    def subscribe_to_read(self, address_range, callback, replace=False):
+        self._remap(self._read_subscribers.add(address_range, callback,
+                                               replace))
+
+    def unsubscribe_from_write(self, address_range, callback=None):
+        self._remap(self._write_subscribers.remove(address_range, callback))
+
+    def unsubscribe_from_read(self, address_range, callback=None):
+        self._remap(self._read_subscribers.remove(address_range, callback))
+
+    def protect(self, address_range, on_write=None):
+        """Make the addresses in address_range read-only, like ROM.
+        Writes to them are ignored, except by write(), which loads them.
+        If on_write is given, on_write(address, value) is called with
+        each write ignored.  The MPU writes to a page that is protected
+        entirely and without on_write straight to a discarded buffer."""
+        self._remap(self._protected.add(address_range, on_write))
+
+    def unprotect(self, address_range):
+        """Make the addresses in address_range writable again"""
+        self._remap(self._protected.remove(address_range))
+
+    def _remap(self, intervals):
+        # map the pages of intervals again after their subscribers have
+        # changed
+        for start, stop in intervals:
+            for page in range(start >> self.page_bits,
+                              ((stop - 1) >> self.page_bits) + 1):
+                self._map_page(page)
+
+    def write(self, start_address, bytes):
+        self._write_run(start_address, list(bytes))
+
+    def snapshot(self):
+        """Return the contents of memory, for restore().  No memory is
+        copied: the pages are shared until they are written to."""
+        self._share_pages()
+        return tuple(self._ram_pages)
+
+    def restore(self, snapshot):
+        """Set the contents of memory to those of a snapshot.  Only the
+        pages written to since the snapshot was taken are changed."""
+        for physical, page in enumerate(snapshot):
+            if self._ram_pages[physical] is not page:
+                self._ram_pages[physical] = page
+                self._shared.add(physical)
+                self._map_page(physical)
+
+    def fork(self):
+        """Return a new PagedMemory with the same contents and
+        subscriptions that shares the pages of this one until either
+        writes to them"""
+        self._share_pages()
+        memory = copy.copy(self)
+        memory._ram_pages = list(self._ram_pages)
+        memory._shared = set(self._shared)
+        memory.read_pages = list(self.read_pages)
+        memory.write_pages = list(self.write_pages)
+        memory._read_subscribers = self._read_subscribers.copy()
+        memory._write_subscribers = self._write_subscribers.copy()
+        memory._protected = self._protected.copy()
+        memory._discarded = None
+        memory.dirty_pages = None
+        if (self._read_subscribers or self._write_subscribers or
+                self._protected):
+            for physical in range(len(memory._ram_pages)):
+                memory._map_page(physical)
+        else:
+            # all pages are shared and unobserved
+            physical_pages = len(memory._ram_pages)
+            entries = [_CopyOnWritePage(memory, physical)
+                       for physical in range(physical_pages)]
+            memory.write_pages = [entries[page % physical_pages]
+                                  for page in range(len(self.write_pages))]
+        return memory
+
+    def _share_pages(self):
+        for physical in range(len(self._ram_pages)):
+            if physical not in self._shared:
+                self._shared.add(physical)
+                self._map_page(physical)
+
+    # pickling keeps the contents of the pages as bytes (or an array of
+    # words) and the subscriptions; the pages are not shared with the
+    # snapshots and forks of the memory pickled
+
+    def __getstate__(self):
+        return {'addrWidth': self.addrWidth,
+                'byteWidth': self.byteWidth,
+                'page_bits': self.page_bits,
+                'pages': self._pickled_pages(),
+                'read_subscribers': self._read_subscribers,
+                'write_subscribers': self._write_subscribers,
+                'protected': self._protected,
+                'dirty_pages': self.dirty_pages}
+
+    def __setstate__(self, state):
+        self.__init__(state['addrWidth'], state['byteWidth'],
+                      state['page_bits'])
+        self._unpickle_pages(state['pages'])
+        self._read_subscribers = state['read_subscribers']
+        self._write_subscribers = state['write_subscribers']
+        self._protected = state['protected']
+        for subscriptions in (self._read_subscribers,
+                              self._write_subscribers, self._protected):
+            self._remap([(start, stop)
+                         for start, stop, callback in subscriptions.ranges])
+        self.dirty_pages = state['dirty_pages']
+
+    def _pickled_pages(self):
+        return _join_pages(self.byteWidth, self._ram_pages)
+
+    def _unpickle_pages(self, data):
+        page_size = len(self._ram_pages[0])
+        for physical, page in enumerate(self._ram_pages):
+            start = physical * page_size
+            page[:] = data[start:start + page_size]
+
+
+class _ObservedPage:
+    """Page table entry of PagedMemory for a page with subscribers"""
+
+    __slots__ = ('memory', 'base')
+
+    def __init__(self, memory, base):
+        self.memory = memory
+        self.base = base
+
+    def __getitem__(self, offset):
+        return self.memory[self.base + offset]
+
+    def __setitem__(self, offset, value):
+        self.memory[self.base + offset] = value
+
+
+class _CopyOnWritePage:
+    """Write page table entry of PagedMemory for a page whose buffer is
+    shared, which copies it on the first write"""
+
+    __slots__ = ('memory', 'physical')
+
+    def __init__(self, memory, physical):
+        self.memory = memory
+        self.physical = physical
+
+    def __setitem__(self, offset, value):
+        self.memory._writable_page(self.physical)[offset] = value
+
+
+class SparseMemory(PagedMemory):
+    """Memory for the whole of a wide address space, such as the 32-bit
+    address space of the 65Org16, that allocates the buffer of a page
+    when it is first written to.  Pages never written to read as zero,
+    so the memory used is in proportion to the pages in use rather than
+    to the size of the address space.
+
+    The interface is that of PagedMemory, including snapshot(),
+    restore() and fork(), except that the addresses do not repeat.
+    read_pages and write_pages are dicts without entries for the pages
+    not allocated: a read of one gets a shared page of zeros, and a
+    write allocates it.
+    """
+
+    def __init__(self, addrWidth=32, byteWidth=16, page_bits=16):
+        self.physMask = (1 << addrWidth) - 1
+        self.addrWidth = addrWidth
+        self.byteWidth = byteWidth
+        self.page_bits = page_bits = min(page_bits, addrWidth)
+        self._offset_mask = (1 << page_bits) - 1
+        self._page_size = 1 << page_bits
+        self._page_count = 1 << (addrWidth - page_bits)
+
+        zeros = memoryview(bytes(self._page_size * ((byteWidth + 7) // 8)))
+        if byteWidth != 8:
+            zeros = zeros.cast('H')
+        self._ram_pages = _SparsePages(zeros) # only the pages allocated
+        self._shared = set()
+        self.read_pages = _SparsePages(zeros)
+        self.write_pages = _SparseWritePages(self)
+
+        size = self.physMask + 1
+        self._read_subscribers = _Subscriptions(size, page_bits)
+        self._write_subscribers = _Subscriptions(size, page_bits)
+        self._protected = _Subscriptions(size, page_bits)
+        self._discarded = None # see _discard_page()
+        self.dirty_pages = None # see DirtyPages
+
+    def _map_page(self, physical):
+        # a table entry for a page not allocated is left out unless the
+        # page has subscribers or is protected
+        allocated = physical in self._ram_pages
+        zeros = self._ram_pages.zeros
+        read_entry, write_entry = self._page_entries(physical)
+        indexes = [physical]
+        if physical == 0:
+            indexes.append(self._page_count)
+        for index in indexes:
+            for table, entry in ((self.read_pages, read_entry),
+                                 (self.write_pages, write_entry)):
+                if allocated or entry is not zeros:
+                    table[index] = entry
+                else:
+                    table.pop(index, None)
+
+    def _writable_page(self, physical):
+        if physical not in self._ram_pages:
+            self._ram_pages[physical] = memoryview(
+                _make_buffer(self.byteWidth, self._page_size))
+            self._map_page(physical)
+            return self._ram_pages[physical]
+        return PagedMemory._writable_page(self, physical)
+
+    def snapshot(self):
+        """Return the contents of memory, for restore().  No memory is
+        copied: the pages are shared until they are written to."""
+        self._share_pages()
+        return dict(self._ram_pages)
+
+    def restore(self, snapshot):
+        """Set the contents of memory to those of a snapshot.  Only the
+        pages allocated or written to since the snapshot was taken are
+        changed."""
+        for physical in list(self._ram_pages):
+            if physical not in snapshot:
+                del self._ram_pages[physical]
+                self._shared.discard(physical)
+                self._map_page(physical)
+        for physical, page in snapshot.items():
+            if self._ram_pages.get(physical) is not page:
+                self._ram_pages[physical] = page
+                self._shared.add(physical)
+                self._map_page(physical)
+
+    def fork(self):
+        """Return a new SparseMemory with the same contents and
+        subscriptions that shares the pages of this one until either
+        writes to them"""
+        self._share_pages()
+        memory = copy.copy(self)
+        memory._ram_pages = _SparsePages(self._ram_pages.zeros,
+                                         self._ram_pages)
+        memory._shared = set(self._shared)
+        memory.read_pages = _SparsePages(self.read_pages.zeros)
+        memory.write_pages = _SparseWritePages(memory)
+        memory._read_subscribers = self._read_subscribers.copy()
+        memory._write_subscribers = self._write_subscribers.copy()
+        memory._protected = self._protected.copy()
+        memory._discarded = None
+        memory.dirty_pages = None
+        for index in set(self.read_pages) | set(self.write_pages):
+            if index < self._page_count:
+                memory._map_page(index)
+        return memory
+
+    def _share_pages(self):
+        for physical in list(self._ram_pages):
+            if physical not in self._shared:
+                self._shared.add(physical)
+                self._map_page(physical)
+
+    def _pickled_pages(self):
+        # only the pages allocated, by page number
+        return dict((physical, _join_pages(self.byteWidth, [page]))
+                    for physical, page in self._ram_pages.items())
+
+    def _unpickle_pages(self, pages):
+        for physical, data in pages.items():
+            self._writable_page(physical)[:] = data
+
+
+class _SparsePages(dict):
+    """Pages of SparseMemory by page number, where a page not in the
+    dict reads as zeros"""
+
+    __slots__ = ('zeros',)
+
+    def __init__(self, zeros, pages=()):
+        dict.__init__(self, pages)
+        self.zeros = zeros
+
+    def __missing__(self, page):
+        return self.zeros
+
+
+class _SparseWritePages(dict):
+    """Write page table of SparseMemory, where a page not in the dict
+    is allocated when it is looked up"""
+
+    __slots__ = ('memory',)
+
+    def __init__(self, memory):
+        dict.__init__(self)
+        self.memory = memory
+
+    def __missing__(self, page):
+        memory = self.memory
+        memory._writable_page(page & (memory._page_count - 1))
+        return self[page]
+
+
+class Bus:
+    """An address space divided into pages of 1 << page_bits addresses,
+    each of which is mapped to RAM, ROM, a device, or nothing.
+
+    The pages are mapped in windows given as ranges of page-aligned
+    addresses, e.g. range(0xD000, 0xD100).  A device is an object with
+    the methods read(offset) and write(offset, value), where offset is
+    relative to the start of its window.  Writes to ROM and to unmapped
+    pages are ignored, by writing them to a buffer that is never read,
+    and unmapped pages read as zero.  map_banks() maps
+    a window whose banks can be switched.
+
+    Like PagedMemory, the bus has page tables that the MPU indexes
+    directly, so looking up the page of an address is a list index and
+    the bus does not grow as it is accessed.
+    """
+
+    def __init__(self, addrWidth=16, byteWidth=8, page_bits=None):
+        if page_bits is None:
+            page_bits = 8 if addrWidth <= 16 else 16
+        self.addrWidth = addrWidth
+        self.byteWidth = byteWidth
+        self.page_bits = page_bits
+        self.addrMask = (1 << addrWidth) - 1
+        self._offset_mask = (1 << page_bits) - 1
+
+        # the pages of RAM and ROM by page number, for write()
+        page_count = 1 << max(addrWidth - page_bits, 0)
+        self._buffers = [None] * page_count
+
+        unmapped = memoryview(self._new_buffer(1 << page_bits))
+        self._unmapped = unmapped.toreadonly()
+        self._ignored = memoryview(self._new_buffer(1 << page_bits))
+        self.read_pages = [self._unmapped] * (page_count + 1)
+        self.write_pages = [self._ignored] * (page_count + 1)
+        self.dirty_pages = None # see DirtyPages
+        self._files = [] # mmaps of map_ram_file()
+        self._sources = [None] * page_count # how each page is mapped
+        self._banks = [] # the Banks of map_banks()
+
+    def _new_buffer(self, size, data=()):
+        if len(data) > size:
+            raise ValueError("%d values do not fit in %d addresses" %
+                             (len(data), size))
+        buffer = _make_buffer(self.byteWidth, size)
+        buffer[:len(data)] = _make_array(self.byteWidth, data)
+        return buffer
+
+    def _pages(self, address_range):
+        r = address_range
+        if (r.step != 1 or r.start >= r.stop or r.start & self._offset_mask
+                or r.stop & self._offset_mask or r.stop > self.addrMask + 1):
+            raise ValueError("not a range of whole pages: %r" % (r,))
+        return range(r.start >> self.page_bits, r.stop >> self.page_bits)
+
+    def _map(self, page, source):
+        # map a page as described by source, (kind, obj, index, extra):
+        #   ('ram', view, index, None) and ('ram file', view, index, None)
+        #     page index of the memoryview view of a buffer or a file
+        #   ('rom', view, index, on_write)
+        #     page index of view, read-only but changed by write()
+        #   ('rom file', view, index, on_write)
+        #     page index of the read-only memoryview view of a file
+        #   ('device', device, index, None)
+        #     page index of the window of device
+        #   ('banks', banks, index, None)
+        #     page index of the window of the Banks banks
+        # or None for an unmapped page.  The sources are what snapshot(),
+        # fork() and pickling copy and map again.
+        if source is None:
+            read_page, write_page, buffer = self._unmapped, self._ignored, None
+        else:
+            kind, obj, index, extra = source
+            start = index << self.page_bits
+            if kind == 'device':
+                read_page = write_page = _DevicePage(obj, start)
+                buffer = None
+            elif kind == 'banks':
+                read_pages, write_pages, buffers = obj._tables[obj.selected]
+                read_page = read_pages[index]
+                write_page = write_pages[index]
+                buffer = buffers[index]
+            else:
+                page_view = obj[start:start + (1 << self.page_bits)]
+                if kind in ('ram', 'ram file'):
+                    read_page = write_page = buffer = page_view
+                else:
+                    read_page = page_view.toreadonly()
+                    write_page = self._rom_writes(page, extra)
+                    buffer = page_view if kind == 'rom' else None
+        self.read_pages[page] = read_page
+        self.write_pages[page] = write_page
+        self._buffers[page] = buffer
+        self._sources[page] = source
+        if page == 0:
+            # the extra entry wrapping around to the first page
+            self.read_pages[-1] = read_page
+            self.write_pages[-1] = write_page
+        if self.dirty_pages is not None:
+            # the page reads differently, as if written to
+            self.dirty_pages.mark_range(page << self.page_bits,
+                                        (page + 1) << self.page_bits)
+
+    def _map_window(self, pages, read_pages, write_pages, buffers):
+        # map the pages of a window at once, with one slice assignment
+        # per table
+        self.read_pages[pages.start:pages.stop] = read_pages
+        self.write_pages[pages.start:pages.stop] = write_pages
+        self._buffers[pages.start:pages.stop] = buffers
+        if pages.start == 0:
+            self.read_pages[-1] = read_pages[0]
+            self.write_pages[-1] = write_pages[0]
+        if self.dirty_pages is not None:
+            self.dirty_pages.mark_range(pages.start << self.page_bits,
+                                        pages.stop << self.page_bits)
+
+    def map_ram(self, address_range, data=()):
+        """Map RAM to the pages of address_range, initialized with data
+        and zeros after it.  Returns the buffer holding its values."""
+        pages = self._pages(address_range)
+        buffer = self._new_buffer(len(address_range), data)
+        view = memoryview(buffer)
+        for index, page in enumerate(pages):
+            self._map(page, ('ram', view, index, None))
+        return buffer
+
+    def map_rom(self, address_range, data, on_write=None):
+        """Map ROM with the contents data, followed by zeros, to the pages
+        of address_range.  Returns the buffer holding its values.  Writes
+        to ROM are ignored; if on_write is given, on_write(address, value)
+        is called with each of them, e.g. to count them or to raise an
+        exception that stops the program."""
+        pages = self._pages(address_range)
+        buffer = self._new_buffer(len(address_range), data)
+        view = memoryview(buffer)
+        for index, page in enumerate(pages):
+            self._map(page, ('rom', view, index, on_write))
+        return buffer
+
+    def _rom_writes(self, page, on_write):
+        # the write page table entry of a page of ROM
+        if on_write is None:
+            return self._ignored
+        return _RomWrites(on_write, page << self.page_bits)
+
+    def map_rom_file(self, address_range, filename, on_write=None,
+                     byteorder=sys.byteorder):
+        """Map the contents of a file, followed by zeros, as ROM to the
+        pages of address_range.  The file is mapped into memory with mmap
+        instead of being read, so the pages it covers entirely are not
+        copied.  16-bit bytes are pairs in the file in the byte order
+        byteorder, 'big' or 'little', which is that of the machine by
+        default; an image in the other order, such as the big-endian
+        images of the monitor's load command on most machines, is
+        copied to swap its bytes.  write() does not change this ROM.
+        on_write is as for map_rom()."""
+        pages = self._pages(address_range)
+        width = self.byteWidth // 8
+        self._check_byteorder(byteorder)
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            length = os.fstat(fd).st_size
+            if length > len(address_range) * width:
+                raise ValueError("%s does not fit in %d addresses" %
+                                 (filename, len(address_range)))
+            if length == 0:
+                view = memoryview(b'')
+            else:
+                view = memoryview(mmap.mmap(fd, length,
+                                            access=mmap.ACCESS_READ))
+        finally:
+            os.close(fd)
+        if width == 2:
+            view = view[:length - length % 2]
+            if byteorder == sys.byteorder:
+                view = view.cast('H')
+            else:
+                words = array('H', view.tobytes())
+                words.byteswap()
+                view = memoryview(words).toreadonly()
+
+        page_size = 1 << self.page_bits
+        for index, page in enumerate(pages):
+            start = index << self.page_bits
+            if start + page_size <= len(view):
+                self._map(page, ('rom file', view, index, on_write))
+            else:
+                # the end of the file and the zeros after it
+                buffer = self._new_buffer(page_size,
+                                          view[start:].tolist())
+                tail = memoryview(buffer).toreadonly()
+                self._map(page, ('rom file', tail, 0, on_write))
+
+    def map_ram_file(self, address_range, filename,
+                     byteorder=sys.byteorder):
+        """Map RAM to the pages of address_range that is kept in a file,
+        so that its contents persist.  The file is created, or extended
+        with zeros, to the size of the window and mapped into memory with
+        mmap.  16-bit bytes are pairs in the file in the byte order
+        byteorder, as for map_rom_file(); since the MPU accesses the file
+        directly, it must be that of the machine, the default.  Changes
+        reach the file as the operating system writes them back, or on
+        flush()."""
+        pages = self._pages(address_range)
+        self._check_byteorder(byteorder)
+        if self.byteWidth != 8 and byteorder != sys.byteorder:
+            raise ValueError("RAM files can only be mapped in the byte "
+                             "order of the machine, %s" % sys.byteorder)
+        size = len(address_range) * (self.byteWidth // 8)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            mapped = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._files.append(mapped)
+        view = memoryview(mapped)
+        if self.byteWidth != 8:
+            view = view.cast('H')
+        for index, page in enumerate(pages):
+            self._map(page, ('ram file', view, index, None))
+
+    def _check_byteorder(self, byteorder):
+        if byteorder not in ('big', 'little'):
+            raise ValueError("byteorder must be 'big' or 'little', "
+                             "not %r" % (byteorder,))
+
+    def flush(self):
+        """Write the changes to RAM kept in files back to them"""
+        for mapped in self._files:
+            mapped.flush()
+
+    def map_banks(self, address_range, count, data=(), rom=False):
+        """Map count banks of RAM, or of ROM if rom is true, that take
+        turns at the pages of address_range.  data is a sequence of the
+        initial contents of the banks, which are zeros after it.  Bank 0
+        is mapped first.  Returns the Banks, whose select() maps another
+        bank."""
+        pages = self._pages(address_range)
+        if len(data) > count:
+            raise ValueError("%d banks of data do not fit in %d banks" %
+                             (len(data), count))
+        data = list(data) + [()] * (count - len(data))
+        banks = Banks(self, pages, rom)
+        for contents in data:
+            banks._add(self._new_buffer(len(address_range), contents))
+        banks.selected = 0
+        self._banks.append(banks)
+        for index, page in enumerate(pages):
+            self._map(page, ('banks', banks, index, None))
+        return banks
+
+    def map_device(self, address_range, device):
+        """Map a device to the pages of address_range"""
+        pages = self._pages(address_range)
+        for index, page in enumerate(pages):
+            self._map(page, ('device', device, index, None))
+
+    def unmap(self, address_range):
+        """Unmap the pages of address_range"""
+        for page in self._pages(address_range):
+            self._map(page, None)
+
+    # snapshot(), restore() and fork() copy the buffers of the RAM and
+    # ROM mapped, including the banks that are not selected, and keep
+    # the bank selected; no device is read or written.  ROM files are
+    # not copied, since nothing changes them.
+
+    def _views(self):
+        # the memoryview of each buffer that write() can change, once
+        views = {}
+        for source in self._sources:
+            if source is not None and source[0] in ('ram', 'ram file',
+                                                    'rom'):
+                views[id(source[1])] = source[1]
+        for banks in self._banks:
+            for view in banks._views:
+                views[id(view)] = view
+        return list(views.values())
+
+    def snapshot(self):
+        """Return the contents of the RAM and ROM and the banks selected,
+        for restore()"""
+        return (tuple((view, view.tobytes()) for view in self._views()),
+                tuple((banks, banks.selected) for banks in self._banks))
+
+    def restore(self, snapshot):
+        """Set the contents of the RAM and ROM and the banks selected to
+        those of a snapshot of this bus"""
+        contents, selected = snapshot
+        for view, data in contents:
+            view.cast('B')[:] = data
+        for banks, bank in selected:
+            banks.select(bank)
+
+    def fork(self):
+        """Return a new Bus with copies of the RAM, ROM and banks of this
+        one, mapped the same way.  RAM kept in files is copied into
+        memory; the devices and the ROM files are shared.  A device that
+        is the Banks of this bus is replaced with that of the fork."""
+        views = dict((id(view), memoryview(_copy_buffer(view)))
+                     for view in self._views())
+        bus = Bus(self.addrWidth, self.byteWidth, self.page_bits)
+        forks = {}
+        for banks in self._banks:
+            fork = Banks(bus, banks.pages, banks.rom)
+            for view in banks._views:
+                fork._add(views[id(view)].obj)
+            fork.selected = banks.selected
+            bus._banks.append(fork)
+            forks[id(banks)] = fork
+        for page, source in enumerate(self._sources):
+            if source is not None:
+                kind, obj, index, extra = source
+                if kind in ('ram', 'ram file'):
+                    source = ('ram', views[id(obj)], index, extra)
+                elif kind == 'rom':
+                    source = ('rom', views[id(obj)], index, extra)
+                elif id(obj) in forks:
+                    source = (kind, forks[id(obj)], index, extra)
+                bus._map(page, source)
+        return bus
+
+    # pickling keeps the contents of the RAM, ROM and banks as bytes (or
+    # arrays of words) and how each page is mapped, with the buffers and
+    # the Banks by number; memoryviews cannot be pickled, so __setstate__
+    # maps pages of the buffers again.  RAM and ROM kept in files are
+    # loaded into memory.  The devices are pickled as they are, so those
+    # that cannot be need py65.utils.serialization to re-attach them by
+    # name, as do devices that refer to the Banks of the bus.
+
+    def __getstate__(self):
+        numbers = {} # buffer number by id of its memoryview
+        buffers = []
+        banks_numbers = dict((id(banks), number)
+                             for number, banks in enumerate(self._banks))
+
+        def number(view):
+            if id(view) not in numbers:
+                numbers[id(view)] = len(buffers)
+                buffers.append(_join_pages(self.byteWidth, [view]))
+            return numbers[id(view)]
+
+        banks = [(banks.pages.start, banks.pages.stop, banks.rom,
+                  banks.selected, [number(view) for view in banks._views])
+                 for banks in self._banks]
+        sources = []
+        for page, source in enumerate(self._sources):
+            if source is None:
+                continue
+            kind, obj, index, extra = source
+            if kind == 'banks':
+                obj = banks_numbers[id(obj)]
+            elif kind == 'device':
+                if id(obj) in banks_numbers:
+                    kind, obj = 'banks device', banks_numbers[id(obj)]
+            else:
+                obj = number(obj)
+            sources.append((page, kind, obj, index, extra))
+        return {'addrWidth': self.addrWidth,
+                'byteWidth': self.byteWidth,
+                'page_bits': self.page_bits,
+                'buffers': buffers,
+                'banks': banks,
+                'sources': sources,
+                'dirty_pages': self.dirty_pages}
+
+    def __setstate__(self, state):
+        self.__init__(state['addrWidth'], state['byteWidth'],
+                      state['page_bits'])
+        views = [memoryview(_make_array(self.byteWidth, data))
+                 for data in state['buffers']]
+        for start, stop, rom, selected, numbers in state['banks']:
+            banks = Banks(self, range(start, stop), rom)
+            for number in numbers:
+                banks._add(views[number].obj)
+            banks.selected = selected
+            self._banks.append(banks)
+        for page, kind, obj, index, extra in state['sources']:
+            if kind in ('banks', 'banks device'):
+                obj = self._banks[obj]
+                if kind == 'banks device':
+                    kind = 'device'
+            elif kind == 'rom file':
+                obj = views[obj].toreadonly()
+            elif kind != 'device':
+                obj = views[obj]
+                if kind == 'ram file':
+                    kind = 'ram'
+            self._map(page, (kind, obj, index, extra))
+        self.dirty_pages = state['dirty_pages']
+
+    def __len__(self):
+        return self.addrMask + 1
+
+    def __getitem__(self, address):
+        if isinstance(address, slice):
+            r = range(*address.indices(self.addrMask + 1))
+            return [ self[n] for n in r ]
+
+        address &= self.addrMask
+        return self.read_pages[address >> self.page_bits][
+            address & self._offset_mask]
+
+    def __setitem__(self, address, value):
+        if isinstance(address, slice):
+            r = range(*address.indices(self.addrMask + 1))
+            for n, v in zip(r, value):
+                self[n] = v
+            return
+
+        address &= self.addrMask
+        self.write_pages[address >> self.page_bits][
+            address & self._offset_mask] = value
+        if self.dirty_pages is not None:
+            self.dirty_pages.mark(address)
+
+    def write(self, start_address, bytes):
+        """Write values starting at start_address, including to ROM.
+        Devices are written as by the MPU; unmapped pages are skipped."""
+        for address, value in enumerate(bytes, start_address):
+            address &= self.addrMask
+            page = address >> self.page_bits
+            offset = address & self._offset_mask
+            buffer = self._buffers[page]
+            if buffer is not None:
+                buffer[offset] = value
+            else:
+                self.write_pages[page][offset] = value
+            if self.dirty_pages is not None:
+                self.dirty_pages.mark(address)
+
+
+class Banks:
+    """Banks of memory taking turns at a window of a Bus, returned by
+    Bus.map_banks().
+
+    buffers holds the buffer of each bank and selected the number of the
+    bank mapped.  select() points the page table entries of the window at
+    the pages of another bank, which costs a slice assignment per table
+    and copies no memory; the MPU then accesses the bank as directly as
+    any RAM.  A Banks is also a device whose writes select the bank with
+    the value written, modulo the number of banks, and whose reads return
+    the selected bank, so it can be the bank register itself or be called
+    from the device that has it.
+    """
+
+    def __init__(self, bus, pages, rom=False):
+        self.bus = bus
+        self.pages = pages
+        self.rom = rom
+        self.buffers = []
+        self.selected = None
+        self._views = [] # a memoryview of each buffer
+        self._tables = [] # (read pages, write pages, buffers) per bank
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def _add(self, buffer):
+        # add a bank with the contents buffer
+        page_bits = self.bus.page_bits
+        view = memoryview(buffer)
+        buffers = [view[index << page_bits:(index + 1) << page_bits]
+                   for index in range(len(self.pages))]
+        if self.rom:
+            read_pages = [page.toreadonly() for page in buffers]
+            write_pages = [self.bus._ignored] * len(self.pages)
+        else:
+            read_pages = write_pages = buffers
+        self.buffers.append(buffer)
+        self._views.append(view)
+        self._tables.append((read_pages, write_pages, buffers))
+
+    def __reduce__(self):
+        # pickled as the Banks of its bus, which keeps their contents
+        return (_bus_banks, (self.bus, self.bus._banks.index(self)))
+
+    def select(self, bank):
+        """Map bank number bank to the window"""
+        read_pages, write_pages, buffers = self._tables[bank]
+        self.bus._map_window(self.pages, read_pages, write_pages, buffers)
+        self.selected = bank
+
+    def read(self, offset):
+        return self.selected
+
+    def write(self, offset, value):
+        self.select(value % len(self.buffers))
+
+
+def _bus_banks(bus, number):
+    # the Banks number number of bus, for unpickling
+    return bus._banks[number]
+
+
+class _DevicePage:
+    """Page table entry of Bus for a page of a device's window"""
+
+    __slots__ = ('device', 'base')
+
+    def __init__(self, device, base):
+        self.device = device
+        self.base = base
+
+    def __getitem__(self, offset):
+        return self.device.read(self.base + offset)
+
+    def __setitem__(self, offset, value):
+        self.device.write(self.base + offset, value)
+
+
+class _RomWrites:
+    """Write page table entry of Bus for a page of ROM with an on_write
+    hook"""
+
+    __slots__ = ('on_write', 'base')
+
+    def __init__(self, on_write, base):
+        self.on_write = on_write
+        self.base = base
+
+    def __setitem__(self, offset, value):
+        self.on_write(self.base + offset, value)
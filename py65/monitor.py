@@ -30,7 +30,7 @@ from py65.assembler import Assembler
 from py65.utils.addressing import AddressParser
 from py65.utils import console
 from py65.utils.conversions import itoa
-from py65.memory import ObservableMemory
+from py65.memory import ObservableMemory, PagedMemory, SparseMemory
 
 try:
     from urllib2 import urlopen
@@ -83,8 +83,9 @@ class Monitor(cmd.Cmd):
                 self.do_goto(goto)
 
             if rom is not None:
-                # load a ROM and run from the reset vector
-                self.do_load("%r top" % rom)
+                # load a ROM that programs cannot write to and run from
+                # the reset vector
+                self._load_rom(rom)
                 physMask = self._mpu.memory.physMask
                 reset = self._mpu.RESET & physMask
                 dest = self._mpu.memory[reset] + \
@@ -183,6 +184,7 @@ class Monitor(cmd.Cmd):
         self.byteFmt = self._mpu.BYTE_FORMAT
         self.addrMask = self._mpu.addrMask
         self.byteMask = self._mpu.byteMask
+        self._roms = []
         if getc_addr and putc_addr:
             self._install_mpu_observers(getc_addr, putc_addr)
         self._address_parser = AddressParser()
@@ -273,7 +275,15 @@ class Monitor(cmd.Cmd):
                 byte = 0
             return byte
 
-        m = ObservableMemory(subject=self.memory, addrWidth=self.addrWidth)
+        if self.memory is None and self.addrWidth > 16:
+            m = SparseMemory(addrWidth=self.addrWidth,
+                             byteWidth=self.byteWidth)
+        elif self.memory is None:
+            m = PagedMemory(addrWidth=self.addrWidth,
+                            byteWidth=self.byteWidth)
+        else:
+            m = ObservableMemory(subject=self.memory,
+                                 addrWidth=self.addrWidth)
         m.subscribe_to_write([self.putc_addr], putc)
         m.subscribe_to_read([self.getc_addr], getc)
 
@@ -347,8 +357,7 @@ class Monitor(cmd.Cmd):
         try:
             start = self._address_parser.number(splitted[0])
             bytes = self._assembler.assemble(statement, start)
-            end = start + len(bytes)
-            self._mpu.memory[start:end] = bytes
+            self._write(start, bytes)
             self.do_disassemble(self.addrFmt % start)
         except KeyError as exc:
             self._output(exc.args[0]) # "Label not found: foo"
@@ -392,7 +401,7 @@ class Monitor(cmd.Cmd):
                 numbytes = len(bytes)
 
                 end = start + numbytes
-                self._mpu.memory[start:end] = bytes
+                self._write(start, bytes)
 
                 # print disassembly
                 _, disasm = self._disassembler.instruction_at(start)
@@ -496,30 +505,16 @@ class Monitor(cmd.Cmd):
         self._run(stopcodes=brks)
 
     def _run(self, stopcodes):
-        stopcodes = set(stopcodes)
-        breakpoints = set(self._breakpoints)
         mpu = self._mpu
-        mem = self._mpu.memory
 
         # Switch to immediate (noncanonical) no-echo input mode on POSIX
         # operating systems.  This has no effect on Windows.
         console.noncanonical_mode(self.stdin)
 
-        if not breakpoints:
-            while True:
-                mpu.step()
-                if mem[mpu.pc] in stopcodes:
-                    break
-        else:
-            while True:
-                mpu.step()
-                pc = mpu.pc
-                if mem[pc] in stopcodes:
-                    break
-                if pc in breakpoints:
-                    msg = "Breakpoint %d reached."
-                    self._output(msg % self._breakpoints.index(pc))
-                    break
+        reason = mpu.run(stop_pcs=self._breakpoints, stop_opcodes=stopcodes)
+        if reason == mpu.RUN_STOP_PC:
+            msg = "Breakpoint %d reached."
+            self._output(msg % self._breakpoints.index(mpu.pc))
 
         # Switch back to the previous input mode.
         console.restore_mode()
@@ -642,7 +637,36 @@ class Monitor(cmd.Cmd):
             return
 
         filename = split[0]
+        bytes = self._read_file(filename)
+        if bytes is None:
+            return
+
+        if len(split) == 2:
+            if split[1] == "top":
+                # load a ROM to top of memory
+                start = self.addrMask - len(bytes) + 1
+            else:
+                start = self._address_parser.number(split[1])
+        else:
+            start = self._mpu.pc
+
+        self._fill(start, start, bytes)
+
+    def _load_rom(self, filename):
+        # load a file to the top of memory, like "load <filename> top",
+        # and make it read-only
+        bytes = self._read_file(filename)
+        if bytes is None:
+            return
+        start = self.addrMask - len(bytes) + 1
+        self._fill(start, start, bytes)
+        protect = getattr(self._mpu.memory, 'protect', None)
+        if protect is not None:
+            protect(range(start, self.addrMask + 1))
+            self._roms.append((start, self.addrMask + 1))
 
+    def _read_file(self, filename):
+        # the bytes of a file or URL, or None if it cannot be read
         if "://" in filename:
             try:
                 f = urlopen(filename)
@@ -651,7 +675,7 @@ class Monitor(cmd.Cmd):
             except Exception as exc:
                 msg = "Cannot fetch remote file: %s" % str(exc)
                 self._output(msg)
-                return
+                return None
         else:
             try:
                 f = open(filename, 'rb')
@@ -660,18 +684,7 @@ class Monitor(cmd.Cmd):
             except (OSError, IOError) as exc:
                 msg = "Cannot load file: [%d] %s" % (exc.errno, exc.strerror)
                 self._output(msg)
-                return
-
-        if len(split) == 2:
-            if split[1] == "top":
-                # load a ROM to top of memory
-                top_address = self.addrMask
-                program_size = len(bytes) // (self.byteWidth // 8)
-                start = top_address - program_size + 1
-            else:
-                start = self._address_parser.number(split[1])
-        else:
-            start = self._mpu.pc
+                return None
 
         if self.byteWidth == 8:
             if isinstance(bytes, str):
@@ -687,7 +700,7 @@ class Monitor(cmd.Cmd):
                     return (msb << 8) + lsb
             bytes = list(map(format, bytes[0::2], bytes[1::2]))
 
-        self._fill(start, start, bytes)
+        return bytes
 
     def help_save(self):
         self._output("save \"filename\" <start> <end>")
@@ -759,7 +772,7 @@ class Monitor(cmd.Cmd):
 
         while address <= end:
             address &= self.addrMask
-            self._mpu.memory[address] = (filler[index] & self.byteMask)
+            self._write(address, [filler[index] & self.byteMask])
             index += 1
             if index == length:
                 index = 0
@@ -769,6 +782,21 @@ class Monitor(cmd.Cmd):
         starttoend = "$" + self.addrFmt + " to $" + self.addrFmt
         self._output(("Wrote +%d bytes from " + starttoend) % fmt)
 
+    def _write(self, start, bytes):
+        # write bytes to memory like the MPU does, except that the ROM
+        # loaded with --rom is patched with write(), which is the only
+        # way past its protection
+        end = start + len(bytes)
+        if not any(first < end and start < last
+                   for first, last in self._roms):
+            self._mpu.memory[start:end] = bytes
+            return
+        for address, value in enumerate(bytes, start):
+            if any(first <= address < last for first, last in self._roms):
+                self._mpu.memory.write(address, [value])
+            else:
+                self._mpu.memory[address] = value
+
     def help_mem(self):
         self._output("mem <address_range>")
         self._output("Display the contents of memory.")
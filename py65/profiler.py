@@ -0,0 +1,224 @@
+"""Profile of the 6502 code executed by an MPU.
+
+Assigning a Profile to mpu.profile makes step() and run() count the
+instructions executed and the cycles spent (cycletime[opcode] plus
+excycles) at each address, in flat arrays indexed by the PC and sized
+for the address width of the MPU (in dicts for the 65Org16):
+
+  mpu.profile = Profile()
+  mpu.run(max_cycles=10 ** 7)
+  mpu.profile.write_flat(sys.stdout, mpu)
+  with open('callgrind.out.rom', 'w') as f:
+      mpu.profile.write_callgrind(f, mpu)
+
+The counts are rolled up per subroutine using the JSR and RTS
+instructions executed: each JSR target is the entry of a subroutine,
+and each address is attributed to the subroutine with the nearest entry
+at or below it, as profilers attribute addresses to symbols.  The costs
+of each call, from the JSR to its RTS, are those of the subroutine
+including the subroutines it calls.  write_callgrind() writes the
+profile in the format of callgrind, for KCachegrind and similar tools.
+
+With mpu.profile set to None, the default, nothing is counted and run()
+is unchanged.  Like the translator, instructions are not profiled while
+mpu.cycle_exact is false.
+"""
+
+import bisect
+import collections
+from array import array
+
+from py65.disassembler import Disassembler
+
+
+class Profile:
+    """Instructions executed and cycles spent per address, and the
+    calls made with JSR"""
+
+    def __init__(self, addrWidth=None):
+        # the counts are allocated for the address width of the first MPU
+        # profiled unless addrWidth is given
+        self.addrWidth = None
+        self.instructions = array('Q')
+        self.cycles = array('Q')
+        if addrWidth is not None:
+            self._allocate(addrWidth)
+        self.executed = 0 # instructions executed while profiling
+        # (call site, entry): [calls, instructions, cycles] of the calls
+        # from the JSR at call site to the subroutine at entry
+        self.calls = {}
+        self._stack = [] # (call site, entry, instructions, cycles)
+        # addresses that are entries of subroutines besides the JSR
+        # targets, such as the reset and interrupt handlers
+        self.entry_points = set()
+
+    def _allocate(self, addrWidth):
+        self.addrWidth = addrWidth
+        if addrWidth <= 16:
+            size = 1 << addrWidth
+            self.instructions = array('Q', bytes(8 * size))
+            self.cycles = array('Q', bytes(8 * size))
+        else:
+            # the address space is too large for arrays
+            self.instructions = collections.defaultdict(int)
+            self.cycles = collections.defaultdict(int)
+
+    def counters(self, mpu):
+        """The instructions and cycles counts per address, for step()
+        and run() of mpu.  Raises ValueError if the addresses of mpu are
+        wider than those of the profile."""
+        if self.addrWidth is None:
+            self._allocate(mpu.ADDR_WIDTH)
+        elif self.addrWidth < mpu.ADDR_WIDTH:
+            raise ValueError(
+                "a profile of %d-bit addresses cannot profile an MPU "
+                "with %d-bit addresses" % (self.addrWidth, mpu.ADDR_WIDTH))
+        return self.instructions, self.cycles
+
+    def clear(self):
+        for counts in (self.instructions, self.cycles):
+            if isinstance(counts, array):
+                counts[:] = array(counts.typecode, bytes(8 * len(counts)))
+            else:
+                counts.clear()
+        self.executed = 0
+        self.calls = {}
+        self._stack = []
+
+    def call(self, site, entry, executed, cycles):
+        """Record a JSR at site to entry, after which executed
+        instructions have been executed and the cycle count is cycles"""
+        self._stack.append((site, entry, executed, cycles))
+
+    def ret(self, executed, cycles):
+        """Record an RTS, ending the last call recorded.  An RTS without
+        a call, such as one used as a computed jump, is ignored."""
+        if self._stack:
+            site, entry, call_executed, call_cycles = self._stack.pop()
+            totals = self.calls.setdefault((site, entry), [0, 0, 0])
+            totals[0] += 1
+            totals[1] += executed - call_executed
+            totals[2] += cycles - call_cycles
+
+    def addresses(self):
+        """The (address, instructions, cycles) of each address executed,
+        the costliest first"""
+        counts = self.instructions
+        if isinstance(counts, array):
+            executed = [address for address, count in enumerate(counts)
+                        if count]
+        else:
+            executed = [address for address, count in counts.items()
+                        if count]
+        profile = [(address, counts[address], self.cycles[address])
+                   for address in executed]
+        profile.sort(key=lambda entry: (-entry[2], entry[0]))
+        return profile
+
+    def entries(self):
+        """The entry addresses of the subroutines called, in order"""
+        return sorted(set(entry for site, entry in self.calls) |
+                      set(entry for site, entry, _, _ in self._stack) |
+                      self.entry_points)
+
+    def subroutine_of(self, address, entries=None):
+        """The entry of the subroutine that address is attributed to,
+        or None if it is below all of them"""
+        if entries is None:
+            entries = self.entries()
+        index = bisect.bisect_right(entries, address)
+        if index == 0:
+            return None
+        return entries[index - 1]
+
+    def subroutines(self):
+        """The (entry, calls, instructions, cycles, inclusive
+        instructions, inclusive cycles) of each subroutine, the
+        costliest including its calls first.  The code outside of all
+        subroutines has the entry None, with no calls, and its
+        inclusive costs are those of all of the instructions."""
+        entries = self.entries()
+        totals = {}
+        all_cycles = 0
+        for address, instructions, cycles in self.addresses():
+            entry = self.subroutine_of(address, entries)
+            costs = totals.setdefault(entry, [0, 0, 0, 0, 0])
+            costs[1] += instructions
+            costs[2] += cycles
+            all_cycles += cycles
+        for (site, entry), (calls, instructions, cycles) in self.calls.items():
+            costs = totals.setdefault(entry, [0, 0, 0, 0, 0])
+            costs[0] += calls
+            costs[3] += instructions
+            costs[4] += cycles
+        if None in totals:
+            totals[None][3:] = [self.executed, all_cycles]
+        profile = [(entry,) + tuple(costs) for entry, costs in totals.items()]
+        profile.sort(key=lambda entry: (-entry[5], -entry[3], entry[0] or 0))
+        return profile
+
+    def write_flat(self, f, mpu, address_parser=None, limit=None):
+        """Write the profile as text to the file f: the addresses
+        executed, the costliest first and at most limit of them, each
+        disassembled from the memory of mpu, then the subroutines"""
+        disassembler = Disassembler(mpu, address_parser)
+        addresses = self.addresses()
+        total = sum(cycles for _, _, cycles in addresses) or 1
+        f.write("Addresses\n\n")
+        f.write("      cycles      %  instructions  address\n")
+        for address, instructions, cycles in addresses[:limit]:
+            length, disasm = disassembler.instruction_at(address)
+            f.write("%12d %6.2f  %12d  $%s  %s\n" % (
+                cycles, 100.0 * cycles / total, instructions,
+                mpu.ADDR_FORMAT % address, disasm))
+
+        f.write("\nSubroutines\n\n")
+        f.write("   inclusive      %        cycles         calls"
+                "  subroutine\n")
+        for (entry, calls, instructions, cycles, inclusive_instructions,
+             inclusive_cycles) in self.subroutines()[:limit]:
+            f.write("%12d %6.2f  %12d  %12d  %s\n" % (
+                inclusive_cycles, 100.0 * inclusive_cycles / total, cycles,
+                calls, _name(entry, mpu, address_parser)))
+
+    def write_callgrind(self, f, mpu, address_parser=None):
+        """Write the profile to the file f in the callgrind format, with
+        instructions and cycles as the events and the addresses as the
+        positions"""
+        entries = self.entries()
+        lines = collections.defaultdict(list)
+        for address, instructions, cycles in sorted(self.addresses()):
+            entry = self.subroutine_of(address, entries)
+            lines[entry].append((address, instructions, cycles))
+        calls = collections.defaultdict(list)
+        for (site, entry), totals in sorted(self.calls.items()):
+            calls[self.subroutine_of(site, entries)].append(
+                (site, entry, totals))
+
+        f.write("# callgrind format\n")
+        f.write("version: 1\n")
+        f.write("creator: py65\n")
+        f.write("positions: instr\n")
+        f.write("events: Instructions Cycles\n")
+        f.write("summary: %d %d\n\n" % (
+            self.executed, sum(cycles for _, _, cycles in self.addresses())))
+        for entry in sorted(set(lines) | set(calls),
+                            key=lambda entry: -1 if entry is None else entry):
+            f.write("fn=%s\n" % _name(entry, mpu, address_parser))
+            for address, instructions, cycles in lines[entry]:
+                f.write("0x%x %d %d\n" % (address, instructions, cycles))
+            for site, callee, (count, instructions, cycles) in calls[entry]:
+                f.write("cfn=%s\n" % _name(callee, mpu, address_parser))
+                f.write("calls=%d 0x%x\n" % (count, callee))
+                f.write("0x%x %d %d\n" % (site, instructions, cycles))
+            f.write("\n")
+
+
+def _name(entry, mpu, address_parser):
+    # the name of the subroutine at entry: its label or its address
+    if entry is None:
+        return "(outside subroutines)"
+    address = '$' + mpu.ADDR_FORMAT % entry
+    if address_parser is None:
+        return address
+    return address_parser.label_for(entry, address)
@@ -0,0 +1,330 @@
+"""py65run -- run a program against many input cases in parallel
+
+Usage: %s [options] [<cases>]
+
+Reads the cases, one JSON object per line, from the file <cases> or from
+standard input and writes the result of each, also one JSON object per
+line, in the same order.  A case may set registers and memory:
+
+  {"a": 1, "x": 2, "memory": {"0200": [1, 2, 3]}}
+
+and its result holds the reason the run stopped, the registers, the
+cycle count and the memory ranges given with --dump:
+
+  {"reason": "stop_pc", "pc": 61442, "a": 1, ..., "memory": {"0200": [...]}}
+
+Addresses are hexadecimal.
+
+Options:
+-h, --help                  : Show this message
+-m, --mpu <device>          : Choose which MPU device (default is 6502)
+-l, --load <file>[@<addr>]  : Load a file at an address (default 0)
+-r, --rom <file>            : Load a read-only rom at the top of address space
+-g, --goto <address>        : Start each case at address (default is the
+                              reset vector)
+-c, --max-cycles <n>        : Stop a case after n cycles
+-n, --max-instructions <n>  : Stop a case after n instructions
+-s, --stop-pc <address>     : Stop a case when the PC reaches address
+-b, --stop-opcode <opcode>  : Stop a case before it executes opcode
+-d, --dump <start:end>      : Include memory from start to end in the results
+-j, --jobs <n>              : Number of processes (default is one per CPU)
+
+--stop-pc, --stop-opcode, --load and --dump may be given more than once.
+"""
+
+import getopt
+import json
+import multiprocessing
+import sys
+
+from py65.devices.mpu6502 import MPU as NMOS6502
+from py65.devices.mpu65c02 import MPU as CMOS65C02
+from py65.devices.mpu65org16 import MPU as V65Org16
+from py65.memory import PagedMemory, SparseMemory
+
+
+Microprocessors = {'6502': NMOS6502, '65C02': CMOS65C02,
+                   '65Org16': V65Org16}
+
+REGISTERS = ('pc', 'a', 'x', 'y', 'sp', 'p')
+
+REASONS = {
+    NMOS6502.RUN_MAX_CYCLES: 'max_cycles',
+    NMOS6502.RUN_MAX_INSTRUCTIONS: 'max_instructions',
+    NMOS6502.RUN_STOP_PC: 'stop_pc',
+    NMOS6502.RUN_STOP_OPCODE: 'stop_opcode',
+    }
+
+
+class Machine:
+    """Description of the machine that each case is run on.
+
+    images and roms are sequences of (address, values) loaded into
+    memory, the roms made read-only.  pc is where each case starts, or
+    None for the reset vector.  The stop conditions are those of
+    MPU.run().  dumps is a sequence of (start, stop) address ranges
+    whose contents are included in the results.
+    """
+
+    def __init__(self, mpu_type=NMOS6502, images=(), roms=(), pc=None,
+                 max_cycles=None, max_instructions=None, stop_pcs=(),
+                 stop_opcodes=(), dumps=()):
+        if not (max_cycles is not None or max_instructions is not None or
+                stop_pcs or stop_opcodes):
+            raise ValueError("a stop condition is needed")
+        self.mpu_type = mpu_type
+        self.images = list(images)
+        self.roms = list(roms)
+        self.pc = pc
+        self.max_cycles = max_cycles
+        self.max_instructions = max_instructions
+        self.stop_pcs = frozenset(stop_pcs)
+        self.stop_opcodes = frozenset(stop_opcodes)
+        self.dumps = list(dumps)
+
+    def build(self):
+        """Return a new MPU with the memory of the machine"""
+        klass = self.mpu_type
+        if klass.ADDR_WIDTH > 16:
+            memory = SparseMemory(klass.ADDR_WIDTH, klass.BYTE_WIDTH)
+        else:
+            memory = PagedMemory(klass.ADDR_WIDTH, klass.BYTE_WIDTH)
+        for address, values in self.images + self.roms:
+            memory.write(address, values)
+        for address, values in self.roms:
+            memory.protect(range(address, address + len(values)))
+        return klass(memory=memory, pc=self.pc)
+
+
+class Worker:
+    """Runs cases on one MPU built from a Machine, restoring it to its
+    initial state before each case"""
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.mpu = machine.build()
+        self._snapshot = self.mpu.snapshot()
+
+    def run(self, case):
+        """Run a case, a dict that may set the registers named in
+        REGISTERS and hold "memory", a dict of address to the values
+        written there first.  Returns the result as a dict."""
+        mpu = self.mpu
+        machine = self.machine
+        mpu.restore(self._snapshot)
+        for name, value in case.items():
+            if name == 'memory':
+                for address, values in value.items():
+                    mpu.memory[address:address + len(values)] = values
+            elif name in REGISTERS:
+                setattr(mpu, name, value)
+            else:
+                raise ValueError("unknown case field: %r" % (name,))
+
+        reason = mpu.run(machine.max_cycles, machine.max_instructions,
+                         machine.stop_pcs, machine.stop_opcodes)
+
+        result = {'reason': REASONS[reason]}
+        for name in REGISTERS:
+            result[name] = getattr(mpu, name)
+        result['cycles'] = mpu.processorCycles
+        result['memory'] = dict((start, mpu.memory[start:stop])
+                                for start, stop in machine.dumps)
+        return result
+
+
+def run_cases(machine, cases, processes=None, chunksize=16):
+    """Run each of the cases, an iterable, on the machine and yield their
+    results in the same order.  The cases are divided among a pool of
+    processes, one per CPU unless processes is given.  The machine,
+    including its images, is sent to each process once, when it starts,
+    and each case is sent as it is given.  With processes=1, the cases
+    are run in this process."""
+    if processes == 1:
+        worker = Worker(machine)
+        for case in cases:
+            yield worker.run(case)
+        return
+
+    with multiprocessing.Pool(processes, _start_worker, (machine,)) as pool:
+        for result in pool.imap(_run_case, cases, chunksize):
+            yield result
+
+
+_worker = None # the Worker of a pool process
+
+
+def _start_worker(machine):
+    global _worker
+    _worker = Worker(machine)
+
+
+def _run_case(case):
+    return _worker.run(case)
+
+
+def read_image(filename, byteWidth=8):
+    """The values of a binary file.  16-bit bytes are big-endian pairs,
+    as for the monitor's load command."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if byteWidth == 8:
+        return list(data)
+    return [(msb << 8) + lsb for msb, lsb in zip(data[0::2], data[1::2])]
+
+
+def _usage(stdout):
+    stdout.write(__doc__ % sys.argv[0])
+
+
+def main(argv=None, stdin=None, stdout=None):
+    if argv is None:
+        argv = sys.argv
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+
+    try:
+        shortopts = 'hm:l:r:g:c:n:s:b:d:j:'
+        longopts = ['help', 'mpu=', 'load=', 'rom=', 'goto=', 'max-cycles=',
+                    'max-instructions=', 'stop-pc=', 'stop-opcode=',
+                    'dump=', 'jobs=']
+        options, args = getopt.getopt(argv[1:], shortopts, longopts)
+    except getopt.GetoptError as exc:
+        stdout.write(exc.args[0] + "\n")
+        _usage(stdout)
+        return 1
+    if len(args) > 1:
+        _usage(stdout)
+        return 1
+
+    mpu_type = NMOS6502
+    loads, roms, dumps = [], [], []
+    stop_pcs, stop_opcodes = [], []
+    pc = max_cycles = max_instructions = processes = None
+
+    for opt, value in options:
+        if opt in ('-h', '--help'):
+            _usage(stdout)
+            return 0
+        if opt in ('-m', '--mpu'):
+            names = dict((name.lower(), name) for name in Microprocessors)
+            if value.lower() not in names:
+                mpus = sorted(Microprocessors.keys())
+                msg = "Fatal: no such MPU. Available MPUs: %s\n"
+                stdout.write(msg % ', '.join(mpus))
+                return 1
+            mpu_type = Microprocessors[names[value.lower()]]
+        if opt in ('-l', '--load'):
+            filename, _, address = value.rpartition('@')
+            if not filename:
+                filename, address = value, '0'
+            loads.append((filename, int(address, 16)))
+        if opt in ('-r', '--rom'):
+            roms.append(value)
+        if opt in ('-g', '--goto'):
+            pc = int(value, 16)
+        if opt in ('-c', '--max-cycles'):
+            max_cycles = int(value)
+        if opt in ('-n', '--max-instructions'):
+            max_instructions = int(value)
+        if opt in ('-s', '--stop-pc'):
+            stop_pcs.append(int(value, 16))
+        if opt in ('-b', '--stop-opcode'):
+            stop_opcodes.append(int(value, 16))
+        if opt in ('-d', '--dump'):
+            start, end = value.split(':')
+            dumps.append((int(start, 16), int(end, 16) + 1))
+        if opt in ('-j', '--jobs'):
+            processes = int(value)
+
+    width = mpu_type.BYTE_WIDTH
+    top = (1 << mpu_type.ADDR_WIDTH)
+    try:
+        images = [(address, read_image(filename, width))
+                  for filename, address in loads]
+        rom_images = []
+        for filename in roms:
+            values = read_image(filename, width)
+            rom_images.append((top - len(values), values))
+    except OSError as exc:
+        stdout.write("Fatal: cannot load file: [%d] %s\n" % (exc.errno,
+                                                             exc.strerror))
+        return 1
+    try:
+        machine = Machine(mpu_type, images, rom_images, pc, max_cycles,
+                          max_instructions, stop_pcs, stop_opcodes, dumps)
+    except ValueError as exc:
+        stdout.write("Fatal: %s\n" % exc)
+        return 1
+
+    if not args:
+        return _write_results(machine, stdin, processes, stdout)
+    try:
+        lines = open(args[0])
+    except OSError as exc:
+        stdout.write("Fatal: cannot read cases: [%d] %s\n" % (exc.errno,
+                                                              exc.strerror))
+        return 1
+    with lines:
+        return _write_results(machine, lines, processes, stdout)
+
+
+def _write_results(machine, lines, processes, stdout):
+    # run the cases in the lines of JSON and write their results, up to
+    # the first line that is not a valid case
+    addrFmt = machine.mpu_type.ADDR_FORMAT
+    width = machine.mpu_type.BYTE_WIDTH
+    errors = []
+
+    def cases():
+        for number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    yield _parse_case(line, width)
+                except ValueError as exc:
+                    errors.append("bad case on line %d: %s" % (number, exc))
+                    return
+
+    try:
+        for result in run_cases(machine, cases(), processes):
+            result['memory'] = dict((addrFmt % start, values)
+                                    for start, values
+                                    in result['memory'].items())
+            stdout.write(json.dumps(result) + "\n")
+            stdout.flush()
+    except ValueError as exc:
+        errors.append(str(exc))
+    if errors:
+        stdout.write("Fatal: %s\n" % errors[0])
+        return 1
+    return 0
+
+
+def _parse_case(line, byteWidth=8):
+    # a case from a line of JSON, with the addresses of its memory as
+    # hexadecimal strings; ValueError if it is not a valid case
+    case = json.loads(line)
+    if not isinstance(case, dict):
+        raise ValueError("not a JSON object")
+    for name, value in case.items():
+        if name == 'memory':
+            if not isinstance(value, dict):
+                raise ValueError("memory is not a JSON object")
+        elif name not in REGISTERS:
+            raise ValueError("unknown case field: %r" % (name,))
+        elif not isinstance(value, int):
+            raise ValueError("%s is not an integer" % name)
+    if 'memory' in case:
+        case['memory'] = dict((int(address, 16), values)
+                              for address, values in case['memory'].items())
+        for values in case['memory'].values():
+            if not (isinstance(values, list) and
+                    all(isinstance(value, int) and
+                        0 <= value < (1 << byteWidth) for value in values)):
+                raise ValueError("memory values are not %d-bit bytes"
+                                 % byteWidth)
+    return case
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Events at given cycle counts of an MPU, for timers and interrupts.
+
+A Scheduler keeps a heap of (cycle, callback) events.  Attached to an
+MPU, it makes step() and run() call callback(mpu, cycle) at the first
+instruction boundary at which mpu.processorCycles has reached the cycle
+of an event, so a timer device schedules its next underflow instead of
+comparing processorCycles after every instruction:
+
+  scheduler = Scheduler(mpu)
+
+  def underflow(mpu, cycle):
+      mpu.irq()
+      scheduler.schedule_at(cycle + period, underflow) # without drift
+
+  event = scheduler.schedule(period, underflow)
+  ...
+  scheduler.cancel(event)
+
+Callbacks may change the registers, call mpu.irq() or mpu.nmi(), and
+schedule and cancel events.  Between events, run() only checks the
+cycle count against the deadline of the earliest event.  While a
+Scheduler is attached, processorCycles is kept up to date during run()
+(it is the cycle count at the start of the current instruction), so
+devices may schedule events from memory callbacks.
+
+Like the translator, the scheduler is not used while mpu.cycle_exact is
+false; nor is the translator used while a scheduler is attached.
+"""
+
+import heapq
+import itertools
+import sys
+
+# the deadline when no events are scheduled
+NEVER = sys.maxsize
+
+
+class Scheduler:
+    """Heap of the events of an MPU"""
+
+    def __init__(self, mpu=None):
+        self._heap = [] # [cycle, sequence, callback] entries
+        self._sequence = itertools.count() # keeps equal cycles in order
+        self.deadline = NEVER # cycle of the earliest event
+        self.mpu = None
+        if mpu is not None:
+            self.attach(mpu)
+
+    def __len__(self):
+        return len(self.events())
+
+    def attach(self, mpu):
+        """Make the scheduler that of mpu"""
+        self.mpu = mpu
+        mpu.scheduler = self
+
+    def schedule(self, delay, callback):
+        """Call callback(mpu, cycle) delay cycles from now, which is the
+        start of the current instruction while one is executed.  Returns
+        the event, for cancel()."""
+        return self.schedule_at(self.mpu.processorCycles + delay, callback)
+
+    def schedule_at(self, cycle, callback):
+        """Call callback(mpu, cycle) when processorCycles reaches cycle.
+        Events at the same cycle are called in the order scheduled.
+        Returns the event, for cancel()."""
+        event = [cycle, next(self._sequence), callback]
+        heapq.heappush(self._heap, event)
+        if cycle < self.deadline:
+            self.deadline = cycle
+        return event
+
+    def cancel(self, event):
+        """Cancel an event if it has not been called yet"""
+        event[2] = None
+        self._update_deadline()
+
+    def events(self):
+        """The (cycle, callback) of the events not yet called, in order"""
+        return [(cycle, callback) for cycle, sequence, callback
+                in sorted(self._heap) if callback is not None]
+
+    def service(self, mpu):
+        """Call the callbacks of the events that are due, in order.
+        Called by the MPU at an instruction boundary when processorCycles
+        has reached the deadline."""
+        heap = self._heap
+        while heap and heap[0][0] <= mpu.processorCycles:
+            cycle, sequence, callback = heapq.heappop(heap)
+            if callback is not None:
+                callback(mpu, cycle)
+        self._update_deadline()
+
+    def _update_deadline(self):
+        # drop the cancelled events at the top of the heap
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        self.deadline = heap[0][0] if heap else NEVER
@@ -1,6 +1,12 @@
+import pickle
 import unittest
+import weakref
 import sys
 import py65.assembler
+import py65.memory
+import py65.profiler
+import py65.trace
+import py65.translator
 import py65.devices.mpu6502
 
 
@@ -36,6 +42,398 @@ class Common6502Tests:
         mpu.reset()
         self.assertEqual(mpu.pc, 0xABCD)
 
+    # Run
+
+    def test_run_stops_after_max_instructions(self):
+        mpu = self._make_mpu()
+        # $0000 NOP
+        # $0001 NOP
+        # $0002 NOP
+        self._write(mpu.memory, 0x0000, (0xEA, 0xEA, 0xEA))
+        reason = mpu.run(max_instructions=2)
+        self.assertEqual(mpu.RUN_MAX_INSTRUCTIONS, reason)
+        self.assertEqual(0x0002, mpu.pc)
+        self.assertEqual(4, mpu.processorCycles)
+
+    def test_run_with_zero_max_instructions_executes_nothing(self):
+        mpu = self._make_mpu()
+        self._write(mpu.memory, 0x0000, (0xEA,))
+        reason = mpu.run(max_instructions=0)
+        self.assertEqual(mpu.RUN_MAX_INSTRUCTIONS, reason)
+        self.assertEqual(0x0000, mpu.pc)
+        self.assertEqual(0, mpu.processorCycles)
+
+    def test_run_stops_once_max_cycles_have_elapsed(self):
+        mpu = self._make_mpu()
+        mpu.processorCycles = 100
+        self._write(mpu.memory, 0x0000, (0xEA, 0xEA, 0xEA, 0xEA))
+        reason = mpu.run(max_cycles=5)
+        self.assertEqual(mpu.RUN_MAX_CYCLES, reason)
+        self.assertEqual(0x0003, mpu.pc)
+        self.assertEqual(106, mpu.processorCycles)
+
+    def test_run_stops_at_stop_pc(self):
+        mpu = self._make_mpu()
+        # $0000 LDX #$03
+        # $0002 DEX
+        # $0003 BNE $0002
+        # $0005 NOP
+        self._write(mpu.memory, 0x0000, (0xA2, 0x03, 0xCA, 0xD0, 0xFD, 0xEA))
+        reason = mpu.run(stop_pcs=[0x0005])
+        self.assertEqual(mpu.RUN_STOP_PC, reason)
+        self.assertEqual(0x0005, mpu.pc)
+        self.assertEqual(0x00, mpu.x)
+
+    def test_run_does_not_stop_at_stop_pc_before_executing(self):
+        mpu = self._make_mpu()
+        # $0000 JMP $0000
+        self._write(mpu.memory, 0x0000, (0x4C, 0x00, 0x00))
+        reason = mpu.run(stop_pcs=[0x0000])
+        self.assertEqual(mpu.RUN_STOP_PC, reason)
+        self.assertEqual(3, mpu.processorCycles)
+
+    def test_run_stops_when_next_opcode_is_a_stop_opcode(self):
+        mpu = self._make_mpu()
+        # $0000 NOP
+        # $0001 NOP
+        # $0002 BRK
+        self._write(mpu.memory, 0x0000, (0xEA, 0xEA, 0x00))
+        reason = mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(mpu.RUN_STOP_OPCODE, reason)
+        self.assertEqual(0x0002, mpu.pc)
+
+    def test_run_matches_step_loop(self):
+        # $0000 LDY #$00
+        # $0002 LDA ($10),Y
+        # $0004 STA $0300,Y
+        # $0007 INY
+        # $0008 BNE $0002
+        program = (0xA0, 0x00, 0xB1, 0x10, 0x99, 0x00, 0x03, 0xC8,
+                   0xD0, 0xF8)
+        stepped = self._make_mpu()
+        ran = self._make_mpu()
+        for mpu in (stepped, ran):
+            self._write(mpu.memory, 0x0000, program)
+            self._write(mpu.memory, 0x0010, (0x80, 0x02))
+        for _ in range(1 + 256 * 4):
+            stepped.step()
+        ran.run(max_instructions=1 + 256 * 4)
+        self.assertEqual(repr(stepped), repr(ran))
+        self.assertEqual(stepped.processorCycles, ran.processorCycles)
+        self.assertEqual(stepped.memory[:], ran.memory[:])
+
+    # Cycle exact
+
+    def test_not_cycle_exact_gives_same_results_without_cycles(self):
+        # $0000 LDY #$00
+        # $0002 LDA ($10),Y
+        # $0004 ADC #$31
+        # $0006 STA $0300,Y
+        # $0009 DEY
+        # $000A BNE $0002
+        program = (0xA0, 0x00, 0xB1, 0x10, 0x69, 0x31, 0x99, 0x00, 0x03,
+                   0x88, 0xD0, 0xF6)
+        exact = self._make_mpu()
+        fast = self._make_mpu()
+        fast.cycle_exact = False
+        self.assertFalse(fast.cycle_exact)
+        for mpu in (exact, fast):
+            self._write(mpu.memory, 0x0000, program)
+            self._write(mpu.memory, 0x0010, (0x80, 0x02))
+            mpu.run(max_instructions=1 + 256 * 5)
+        self.assertEqual(repr(exact), repr(fast))
+        self.assertEqual(exact.memory[:], fast.memory[:])
+        self.assertEqual(0, fast.processorCycles)
+
+    def test_not_cycle_exact_step_does_not_count_cycles(self):
+        mpu = self._make_mpu()
+        mpu.cycle_exact = False
+        # $0000 LDX #$01
+        self._write(mpu.memory, 0x0000, (0xA2, 0x01))
+        mpu.step()
+        self.assertEqual(0x0002, mpu.pc)
+        self.assertEqual(0x01, mpu.x)
+        self.assertEqual(0, mpu.processorCycles)
+
+    def test_not_cycle_exact_run_rejects_max_cycles(self):
+        mpu = self._make_mpu()
+        mpu.cycle_exact = False
+        self.assertRaises(ValueError, mpu.run, max_cycles=10)
+
+    def test_cycle_exact_can_be_restored_at_a_breakpoint(self):
+        mpu = self._make_mpu()
+        mpu.cycle_exact = False
+        # $0000 INX
+        # $0001 INX
+        # $0002 INX
+        self._write(mpu.memory, 0x0000, (0xE8, 0xE8, 0xE8))
+        reason = mpu.run(stop_pcs=[0x0002])
+        self.assertEqual(mpu.RUN_STOP_PC, reason)
+        mpu.cycle_exact = True
+        mpu.step()
+        self.assertEqual(0x03, mpu.x)
+        self.assertEqual(2, mpu.processorCycles)
+
+    # Registers
+
+    def test_registers_are_slots(self):
+        mpu = self._make_mpu()
+        self.assertFalse(hasattr(mpu, '__dict__'))
+        self.assertRaises(AttributeError, setattr, mpu, 'foo', 0)
+
+    # Lazy flags
+
+    def test_lazy_flags_keeps_processor_status(self):
+        mpu = self._make_mpu()
+        mpu.p = 0xFF
+        mpu.lazy_flags = True
+        self.assertTrue(mpu.lazy_flags)
+        self.assertEqual(0xFF, mpu.p)
+        mpu.lazy_flags = False
+        self.assertFalse(mpu.lazy_flags)
+        self.assertEqual(0xFF, mpu.p)
+
+    def test_lazy_flags_computes_nz_from_last_result(self):
+        mpu = self._make_mpu()
+        mpu.lazy_flags = True
+        mpu.p = mpu.ZERO | mpu.CARRY
+        # $0000 LDA #$80
+        self._write(mpu.memory, 0x0000, (0xA9, 0x80))
+        mpu.step()
+        self.assertEqual(mpu.NEGATIVE | mpu.CARRY, mpu.p)
+
+    def test_lazy_flags_php_pushes_computed_flags(self):
+        mpu = self._make_mpu()
+        mpu.lazy_flags = True
+        mpu.p = mpu.BREAK | mpu.UNUSED
+        # $0000 LDX #$00
+        # $0002 PHP
+        self._write(mpu.memory, 0x0000, (0xA2, 0x00, 0x08))
+        mpu.run(max_instructions=2)
+        self.assertEqual(mpu.BREAK | mpu.UNUSED | mpu.ZERO,
+                         mpu.memory[0x01FF])
+
+    def test_lazy_flags_matches_eager_run(self):
+        # $0000 LDY #$00
+        # $0002 LDA ($10),Y
+        # $0004 ADC #$31
+        # $0006 STA $0300,Y
+        # $0009 CMP #$40
+        # $000B ROL A
+        # $000C DEY
+        # $000D BNE $0002
+        program = (0xA0, 0x00, 0xB1, 0x10, 0x69, 0x31, 0x99, 0x00, 0x03,
+                   0xC9, 0x40, 0x2A, 0x88, 0xD0, 0xF3)
+        eager = self._make_mpu()
+        lazy = self._make_mpu()
+        lazy.lazy_flags = True
+        for mpu in (eager, lazy):
+            self._write(mpu.memory, 0x0000, program)
+            self._write(mpu.memory, 0x0010, (0x80, 0x02))
+            mpu.run(max_instructions=1 + 256 * 6)
+        self.assertEqual(repr(eager), repr(lazy))
+        self.assertEqual(eager.processorCycles, lazy.processorCycles)
+        self.assertEqual(eager.memory[:], lazy.memory[:])
+
+    # Dirty pages
+
+    def test_dirty_pages_marks_pages_written_by_instructions(self):
+        mpu = self._make_mpu()
+        # $0000 STA $C012
+        # $0003 PHA
+        # $0004 LDA $D000
+        self._write(mpu.memory, 0x0000, (0x8D, 0x12, 0xC0, 0x48,
+                                         0xAD, 0x00, 0xD0))
+        mpu.dirty_pages = py65.memory.DirtyPages()
+        mpu.run(max_instructions=3)
+        self.assertEqual([0x01, 0xC0], mpu.dirty_pages.dirty())
+
+    def test_dirty_pages_marks_stack_page_on_interrupt(self):
+        mpu = self._make_mpu()
+        mpu.dirty_pages = py65.memory.DirtyPages()
+        mpu.nmi()
+        self.assertEqual([0x01], mpu.dirty_pages.dirty())
+
+    def test_dirty_pages_take_clears_bitmap(self):
+        mpu = self._make_mpu()
+        # $0000 STA $C012
+        self._write(mpu.memory, 0x0000, (0x8D, 0x12, 0xC0))
+        mpu.dirty_pages = py65.memory.DirtyPages()
+        mpu.step()
+        self.assertEqual([0xC0], mpu.dirty_pages.take())
+        self.assertEqual([], mpu.dirty_pages.dirty())
+
+    def test_dirty_pages_none_stops_tracking(self):
+        mpu = self._make_mpu()
+        # $0000 STA $C012
+        self._write(mpu.memory, 0x0000, (0x8D, 0x12, 0xC0))
+        dirty_pages = py65.memory.DirtyPages()
+        mpu.dirty_pages = dirty_pages
+        mpu.dirty_pages = None
+        mpu.step()
+        self.assertEqual([], dirty_pages.dirty())
+
+    # Snapshots
+
+    def test_restore_returns_to_state_at_snapshot(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 STA $C000
+        # $0005 PHA
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0x8D, 0x00, 0xC0, 0x48))
+        snapshot = mpu.snapshot()
+        before = (repr(mpu), mpu.processorCycles, mpu.memory[:])
+        mpu.run(max_instructions=3)
+        mpu.restore(snapshot)
+        self.assertEqual(before, (repr(mpu), mpu.processorCycles,
+                                  mpu.memory[:]))
+
+    def test_snapshot_raises_for_memory_without_snapshots(self):
+        class Memory:
+            # memory without snapshot(), restore() and fork()
+            def __init__(self):
+                self.values = 0x10000 * [0x00]
+
+            def __getitem__(self, address):
+                return self.values[address]
+
+            def __setitem__(self, address, value):
+                self.values[address] = value
+
+        mpu = self._make_mpu()
+        mpu.memory = Memory()
+        self.assertRaises(TypeError, mpu.snapshot)
+        self.assertRaises(TypeError, mpu.fork)
+
+    def test_fork_is_independent_machine_in_same_state(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 STA $C000
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0x8D, 0x00, 0xC0))
+        mpu.step()
+        fork = mpu.fork()
+        self.assertEqual(repr(mpu), repr(fork))
+        self.assertEqual(mpu.processorCycles, fork.processorCycles)
+        fork.step()
+        self.assertEqual(0x01, fork.memory[0xC000])
+        self.assertEqual(0xAA, mpu.memory[0xC000])
+        self.assertEqual(0x0002, mpu.pc)
+
+    # Trace
+
+    def test_step_and_run_append_to_trace(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 LDX #$02
+        # $0004 LDY #$03
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0xA2, 0x02, 0xA0, 0x03))
+        mpu.trace = py65.trace.TraceBuffer(2)
+        mpu.step()
+        mpu.run(max_instructions=2)
+        self.assertEqual(3, mpu.trace.count)
+        self.assertEqual([(0x0002, 0xA2, 0x01, 0x00, 0x00, 0xFF, 0x30, 2),
+                          (0x0004, 0xA0, 0x01, 0x02, 0x00, 0xFF, 0x30, 4)],
+                         mpu.trace.records())
+
+    def test_run_without_trace_records_nothing(self):
+        mpu = self._make_mpu()
+        trace = py65.trace.TraceBuffer()
+        mpu.trace = trace
+        mpu.trace = None
+        mpu.run(max_instructions=2)
+        self.assertEqual(0, trace.count)
+
+    # Profile
+
+    def test_run_counts_instructions_and_cycles_in_profile(self):
+        mpu = self._make_mpu()
+        # $0000 JSR $0010
+        # $0010 RTS
+        self._write(mpu.memory, 0x0000, (0x20, 0x10, 0x00))
+        self._write(mpu.memory, 0x0010, (0x60,))
+        mpu.profile = py65.profiler.Profile()
+        mpu.run(max_instructions=2)
+        self.assertEqual(12, mpu.processorCycles)
+        self.assertEqual([(0x0000, 1, 6), (0x0010, 1, 6)],
+                         mpu.profile.addresses())
+        self.assertEqual({(0x0000, 0x0010): [1, 1, 6]}, mpu.profile.calls)
+
+    # Hooks
+
+    def test_hook_is_called_before_instructions_with_its_opcodes(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 JSR $0010
+        # $0010 LDA #$02
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0x20, 0x10, 0x00))
+        self._write(mpu.memory, 0x0010, (0xA9, 0x02))
+        calls = []
+        mpu.add_hook([0x20], lambda mpu, address, opcode:
+                     calls.append((address, opcode, mpu.a, mpu.sp)))
+        mpu.run(max_instructions=3)
+        self.assertEqual([(0x0002, 0x20, 0x01, 0xFF)], calls)
+        self.assertEqual((0x0012, 0x02), (mpu.pc, mpu.a))
+
+    def test_hook_copies_the_table_only_for_its_instance(self):
+        mpu = self._make_mpu()
+        instruct = mpu._instruct
+        mpu.add_hook([0x20], lambda mpu, address, opcode: None)
+        self.assertFalse(mpu._instruct is instruct)
+        self.assertTrue(mpu._instruct[0xA9] is instruct[0xA9])
+        self.assertTrue(self._make_mpu()._instruct is instruct)
+
+    def test_removing_all_hooks_restores_the_shared_table(self):
+        mpu = self._make_mpu()
+        instruct = mpu._instruct
+        def hook(mpu, address, opcode):
+            pass
+        mpu.add_hook([0x20, 0x60], hook)
+        mpu.remove_hook(hook, [0x20])
+        self.assertFalse(mpu._instruct is instruct)
+        mpu.remove_hook(hook)
+        self.assertTrue(mpu._instruct is instruct)
+
+    def test_hook_raising_stops_run(self):
+        mpu = self._make_mpu()
+        # $0000 NOP
+        # $0001 NOP
+        # $0002 BRK
+        self._write(mpu.memory, 0x0000, (0xEA, 0xEA, 0x00))
+        def breakpoint(mpu, address, opcode):
+            raise KeyboardInterrupt
+        mpu.add_hook([0x00], breakpoint)
+        self.assertRaises(KeyboardInterrupt, mpu.run)
+        self.assertEqual(0x0003, mpu.pc)
+
+    # Weak references
+
+    def test_mpu_can_be_weakly_referenced(self):
+        mpu = self._make_mpu()
+        self.assertTrue(weakref.ref(mpu)() is mpu)
+
+    # Pickling
+
+    def test_pickle_keeps_registers_options_and_memory(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 STA $C000
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0x8D, 0x00, 0xC0))
+        mpu.lazy_flags = True
+        mpu.step()
+        copy = pickle.loads(pickle.dumps(mpu))
+        self.assertEqual(type(mpu), type(copy))
+        self.assertEqual(type(mpu.memory), type(copy.memory))
+        self.assertEqual(repr(mpu), repr(copy))
+        self.assertEqual(mpu.processorCycles, copy.processorCycles)
+        self.assertTrue(copy.lazy_flags)
+        copy.step()
+        self.assertEqual(0x01, copy.memory[0xC000])
+        self.assertEqual(0xAA, mpu.memory[0xC000])
+
+    def test_pickle_packs_memory_into_bytes(self):
+        mpu = self._make_mpu()
+        self.assertTrue(len(pickle.dumps(mpu)) < 0x10000 + 1024)
+
     # ADC Absolute
 
     def test_adc_bcd_off_absolute_carry_clear_in_accumulator_zeroes(self):
@@ -5788,6 +6186,19 @@ class MPUTests(unittest.TestCase, Common6502Tests):
         mpu = self._make_mpu()
         self.assertTrue("6502" in repr(mpu))
 
+    def test_hook_on_illegal_opcodes(self):
+        mpu = self._make_mpu()
+        self.assertTrue(0x02 in mpu.illegal_opcodes())
+        self.assertFalse(0xEA in mpu.illegal_opcodes())
+        # $0000 NOP
+        # $0001 .byte $02
+        self._write(mpu.memory, 0x0000, (0xEA, 0x02))
+        addresses = []
+        mpu.add_hook(mpu.illegal_opcodes(),
+                     lambda mpu, address, opcode: addresses.append(address))
+        mpu.run(max_instructions=2)
+        self.assertEqual([0x0001], addresses)
+
     # ADC Indirect, Indexed (X)
 
     def test_adc_ind_indexed_has_page_wrap_bug(self):
@@ -6058,6 +6469,36 @@ class MPUTests(unittest.TestCase, Common6502Tests):
         return py65.devices.mpu6502.MPU
 
 
+class TranslatedMPUTests(MPUTests):
+    """ NMOS 6502 tests using the block translator """
+
+    def _make_mpu(self, *args, **kargs):
+        mpu = MPUTests._make_mpu(self, *args, **kargs)
+        mpu.translator = py65.translator.BlockTranslator()
+        return mpu
+
+
+class LazyFlagsMPUTests(MPUTests):
+    """ NMOS 6502 tests with lazy flag evaluation """
+
+    def _make_mpu(self, *args, **kargs):
+        mpu = MPUTests._make_mpu(self, *args, **kargs)
+        mpu.lazy_flags = True
+        return mpu
+
+
+class PagedMemoryMPUTests(MPUTests):
+    """ NMOS 6502 tests with paged memory """
+
+    def _make_mpu(self, *args, **kargs):
+        mpu = MPUTests._make_mpu(self, *args, **kargs)
+        if 'memory' not in kargs:
+            memory = py65.memory.PagedMemory()
+            memory.write(0x0000, mpu.memory)
+            mpu.memory = memory
+        return mpu
+
+
 def test_suite():
     return unittest.findTestCases(sys.modules[__name__])
 
@@ -1,6 +1,8 @@
 import unittest
 import sys
 import py65.devices.mpu65c02
+import py65.memory
+import py65.translator
 from py65.tests.devices.test_mpu6502 import Common6502Tests
 
 
@@ -1390,7 +1392,7 @@ class MPUTests(unittest.TestCase, Common6502Tests):
     def test_wai_sets_waiting(self):
         mpu = self._make_mpu()
         self.assertFalse(mpu.waiting)
-        # $0240 WAI
+        # $0204 WAI
         self._write(mpu.memory, 0x0204, [0xCB])
         mpu.pc = 0x0204
         mpu.step()
@@ -1398,12 +1400,65 @@ class MPUTests(unittest.TestCase, Common6502Tests):
         self.assertEqual(0x0205, mpu.pc)
         self.assertEqual(3, mpu.processorCycles)
 
+    def test_run_while_waiting_only_consumes_cycles(self):
+        mpu = self._make_mpu()
+        # $0204 WAI
+        self._write(mpu.memory, 0x0204, [0xCB, 0xEA])
+        mpu.pc = 0x0204
+        reason = mpu.run(max_instructions=3)
+        self.assertEqual(mpu.RUN_MAX_INSTRUCTIONS, reason)
+        self.assertTrue(mpu.waiting)
+        self.assertEqual(0x0205, mpu.pc)
+        self.assertEqual(5, mpu.processorCycles)
+
+    def test_step_while_waiting_not_cycle_exact_does_not_count_cycles(self):
+        mpu = self._make_mpu()
+        mpu.cycle_exact = False
+        # $0204 WAI
+        self._write(mpu.memory, 0x0204, [0xCB, 0xEA])
+        mpu.pc = 0x0204
+        mpu.step()
+        mpu.step()
+        self.assertTrue(mpu.waiting)
+        self.assertEqual(0x0205, mpu.pc)
+        self.assertEqual(0, mpu.processorCycles)
+
     # Test Helpers
 
     def _get_target_class(self):
         return py65.devices.mpu65c02.MPU
 
 
+class TranslatedMPUTests(MPUTests):
+    """ CMOS 65C02 tests using the block translator """
+
+    def _make_mpu(self, *args, **kargs):
+        mpu = MPUTests._make_mpu(self, *args, **kargs)
+        mpu.translator = py65.translator.BlockTranslator()
+        return mpu
+
+
+class LazyFlagsMPUTests(MPUTests):
+    """ CMOS 65C02 tests with lazy flag evaluation """
+
+    def _make_mpu(self, *args, **kargs):
+        mpu = MPUTests._make_mpu(self, *args, **kargs)
+        mpu.lazy_flags = True
+        return mpu
+
+
+class PagedMemoryMPUTests(MPUTests):
+    """ CMOS 65C02 tests with paged memory """
+
+    def _make_mpu(self, *args, **kargs):
+        mpu = MPUTests._make_mpu(self, *args, **kargs)
+        if 'memory' not in kargs:
+            memory = py65.memory.PagedMemory()
+            memory.write(0x0000, mpu.memory)
+            mpu.memory = memory
+        return mpu
+
+
 def test_suite():
     return unittest.findTestCases(sys.modules[__name__])
 
@@ -0,0 +1,201 @@
+import sys
+import unittest
+import py65.devices.mpu65c02
+from py65.devices.mpu6502 import MPU
+from py65.interrupts import InterruptLines
+from py65.memory import PagedMemory
+from py65.translator import BlockTranslator
+
+
+class InterruptLinesTests(unittest.TestCase):
+
+    def test_irq_is_taken_at_the_next_boundary(self):
+        mpu = self._make_mpu()
+        lines = InterruptLines(mpu)
+        mpu.step()
+        lines.assert_irq()
+        mpu.step()
+        # taken before the instruction, then $C000 NOP
+        self.assertEqual(0xC001, mpu.pc)
+        self.assertEqual(0x0001, mpu.WordAt(0x01FE))
+        self.assertTrue(mpu.p & MPU.INTERRUPT)
+
+    def test_irq_is_level_triggered(self):
+        mpu = self._make_mpu()
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        # IRQ, $C000 NOP, $C001 RTI, IRQ again, $C000 NOP
+        mpu.run(max_instructions=3)
+        self.assertEqual(0xC001, mpu.pc)
+        # released in the handler
+        mpu.step()
+        lines.release_irq()
+        mpu.run(max_instructions=2)
+        self.assertEqual(0x0002, mpu.pc)
+
+    def test_masked_irq_is_taken_after_cli(self):
+        mpu = self._make_mpu()
+        # $0000 NOP
+        # $0001 CLI
+        # $0002 NOP
+        mpu.memory[0x0000:0x0003] = [0xEA, 0x58, 0xEA]
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        mpu.run(max_instructions=2)
+        self.assertEqual(0x0002, mpu.pc)
+        mpu.step()
+        self.assertEqual(0xC001, mpu.pc)
+        self.assertEqual(0x0002, mpu.WordAt(0x01FE))
+
+    def test_masked_irq_is_taken_after_plp(self):
+        mpu = self._make_mpu()
+        # $0000 PLP
+        # $0001 NOP
+        mpu.memory[0x0000:0x0002] = [0x28, 0xEA]
+        mpu.memory[0x01FF] = MPU.UNUSED # I clear
+        mpu.sp = 0xFE
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        mpu.run(max_instructions=2)
+        self.assertEqual(0xC001, mpu.pc)
+
+    def test_irq_asserted_by_any_line_until_all_are_released(self):
+        mpu = self._make_mpu()
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        lines.assert_irq(1)
+        lines.assert_irq(4)
+        lines.release_irq(1)
+        self.assertEqual(4, lines.irq)
+        mpu.step()
+        lines.release_irq(4)
+        self.assertEqual(0, lines.irq)
+
+    def test_hooks_are_only_installed_while_irq_is_masked(self):
+        mpu = self._make_mpu()
+        instruct = mpu._instruct
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        mpu.step()
+        self.assertFalse(mpu._instruct is instruct)
+        lines.release_irq()
+        self.assertTrue(mpu._instruct is instruct)
+
+    def test_nmi_is_taken_once_even_when_masked(self):
+        mpu = self._make_mpu()
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        lines.nmi()
+        mpu.step()
+        self.assertEqual(0xC101, mpu.pc)
+        self.assertFalse(lines.nmi_pending)
+        mpu.step()
+        self.assertEqual(0xC102, mpu.pc)
+
+    def test_irq_asserted_by_a_device_during_run(self):
+        memory = PagedMemory()
+        mpu = self._make_mpu(memory)
+        # $0000 STA $D000
+        # $0003 NOP
+        memory.write(0x0000, [0x8D, 0x00, 0xD0, 0xEA])
+        lines = InterruptLines(mpu)
+        def write(address, value):
+            lines.assert_irq()
+        memory.subscribe_to_write([0xD000], write)
+        mpu.run(max_instructions=2)
+        self.assertEqual(0xC001, mpu.pc)
+        self.assertEqual(0x0003, mpu.WordAt(0x01FE))
+
+    def test_irq_ends_wai_even_when_masked(self):
+        mpu = self._make_mpu(mpu_type=py65.devices.mpu65c02.MPU)
+        # $0000 WAI
+        # $0001 NOP
+        mpu.memory[0x0000:0x0002] = [0xCB, 0xEA]
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        mpu.run(max_instructions=5)
+        self.assertTrue(mpu.waiting)
+        lines.assert_irq()
+        mpu.step()
+        self.assertFalse(mpu.waiting)
+        self.assertEqual(0x0002, mpu.pc)
+
+    def test_irq_released_before_it_is_taken_does_not_end_wai(self):
+        mpu = self._make_mpu(mpu_type=py65.devices.mpu65c02.MPU)
+        # $0000 WAI
+        # $0001 INX
+        mpu.memory[0x0000:0x0002] = [0xCB, 0xE8]
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        mpu.step()
+        self.assertTrue(mpu.waiting)
+        lines.assert_irq()
+        lines.release_irq()
+        mpu.step()
+        self.assertTrue(mpu.waiting)
+        self.assertEqual(0x0001, mpu.pc)
+        self.assertEqual(0x00, mpu.x)
+
+    def test_irq_is_taken_without_cycle_exact(self):
+        mpu = self._make_mpu()
+        mpu.cycle_exact = False
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        mpu.run(max_instructions=1)
+        self.assertEqual(0xC001, mpu.pc)
+        self.assertEqual(0x0000, mpu.WordAt(0x01FE))
+        lines.release_irq()
+        lines.nmi()
+        mpu.step()
+        self.assertEqual(0xC101, mpu.pc)
+
+    def test_masked_irq_is_taken_after_cli_without_cycle_exact(self):
+        mpu = self._make_mpu()
+        mpu.cycle_exact = False
+        # $0000 CLI
+        mpu.memory[0x0000] = 0x58
+        mpu.p |= MPU.INTERRUPT
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        mpu.run(max_instructions=2)
+        self.assertEqual(0xC001, mpu.pc)
+        self.assertEqual(0x0001, mpu.WordAt(0x01FE))
+
+    def test_irq_is_taken_with_the_translator(self):
+        mpu = self._make_mpu()
+        mpu.translator = BlockTranslator()
+        lines = InterruptLines(mpu)
+        lines.assert_irq()
+        mpu.run(max_instructions=1)
+        self.assertEqual(0xC001, mpu.pc)
+
+    def test_lines_do_not_attach_a_scheduler(self):
+        mpu = self._make_mpu()
+        lines = InterruptLines(mpu)
+        self.assertTrue(mpu.interrupts is lines)
+        self.assertEqual(None, mpu.scheduler)
+
+    # Test Helpers
+
+    def _make_mpu(self, memory=None, mpu_type=MPU):
+        mpu = mpu_type(memory=memory)
+        mpu.memory[0x0000:0x0010] = [0xEA] * 0x10 # NOP
+        # $C000 NOP
+        # $C001 RTI
+        mpu.memory[0xC000:0xC002] = [0xEA, 0x40]
+        # $C100 NOP
+        # $C101 NOP
+        mpu.memory[0xC100:0xC102] = [0xEA, 0xEA]
+        mpu.memory[0xFFFA:0xFFFC] = [0x00, 0xC1] # NMI
+        mpu.memory[0xFFFE:0x10000] = [0x00, 0xC0] # IRQ
+        return mpu
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
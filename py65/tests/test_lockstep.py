@@ -0,0 +1,110 @@
+import random
+import sys
+import unittest
+import py65.devices.mpu6502
+import py65.devices.mpu65c02
+
+try:
+    import numpy
+    from py65.lockstep import LockstepMPU
+except ImportError: # NumPy is optional
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class LockstepMPUTests(unittest.TestCase):
+
+    def test_6502_lanes_match_the_mpu_class(self):
+        self._assert_lanes_match(py65.devices.mpu6502.MPU)
+
+    def test_65c02_lanes_match_the_mpu_class(self):
+        self._assert_lanes_match(py65.devices.mpu65c02.MPU)
+
+    def test_common_instructions_have_array_versions(self):
+        machines = LockstepMPU(py65.devices.mpu6502.MPU, 1)
+        for opcode in (0xA9, 0x8D, 0x69, 0xE6, 0xD0, 0x20, 0x60, 0x48):
+            self.assertTrue(machines._handlers[opcode] is not None)
+        self.assertTrue(machines._handlers[0x00] is None) # BRK
+
+    def test_overridden_operations_are_executed_by_the_mpu_class(self):
+        class MPU(py65.devices.mpu6502.MPU):
+            def opORA(self, x):
+                self.a = 0x42
+        machines = LockstepMPU(MPU, 2, memory=[0x09, 0x00])
+        self.assertTrue(machines._handlers[0x09] is None)
+        machines.step()
+        self.assertEqual([0x42, 0x42], machines.a.tolist())
+
+    def test_divergent_lanes_each_follow_their_own_branch(self):
+        # $0000 LDX #$00
+        # $0002 BEQ $0006
+        # $0004 LDX #$01
+        # $0006 STX $0200
+        program = [0xA2, 0x00, 0xF0, 0x02, 0xA2, 0x01, 0x8E, 0x00, 0x02]
+        machines = LockstepMPU(py65.devices.mpu6502.MPU, 4, memory=program)
+        machines.memory[1::2, 0x0001] = 0x05
+        stopped = machines.run(max_instructions=10, stop_pcs=[0x0009])
+        self.assertEqual([True] * 4, stopped.tolist())
+        self.assertEqual([0x00, 0x01, 0x00, 0x01],
+                         machines.memory[:, 0x0200].tolist())
+        self.assertEqual([9, 10, 9, 10], machines.cycles.tolist())
+
+    def test_mpu_returns_the_state_of_a_lane(self):
+        machines = LockstepMPU(py65.devices.mpu6502.MPU, 2,
+                               memory=[0xA9, 0x12], pc=0x0000)
+        machines.memory[1, 0x0001] = 0x34
+        machines.step()
+        mpu = machines.mpu(1)
+        self.assertEqual((0x0002, 0x34, 2), (mpu.pc, mpu.a,
+                                             mpu.processorCycles))
+        self.assertEqual(0x34, mpu.memory[0x0001])
+
+    def test_raises_for_16_bit_bytes(self):
+        import py65.devices.mpu65org16
+        self.assertRaises(ValueError, LockstepMPU,
+                          py65.devices.mpu65org16.MPU, 1)
+
+    # Test Helpers
+
+    def _assert_lanes_match(self, klass, trials=4):
+        rand = random.Random(6502)
+        for trial in range(trials):
+            # a lane per opcode, each in a random state
+            machines = LockstepMPU(klass, 256)
+            rng = numpy.random.default_rng(trial)
+            machines.memory[:] = rng.integers(0, 256, machines.memory.shape)
+            expected = []
+            for lane in range(256):
+                pc = rand.randint(0, 0xFFF0)
+                machines.memory[lane, pc] = lane
+                machines.pc[lane] = pc
+                machines.a[lane] = rand.randint(0, 0xFF)
+                machines.x[lane] = rand.randint(0, 0xFF)
+                machines.y[lane] = rand.randint(0, 0xFF)
+                machines.sp[lane] = rand.randint(0, 0xFF)
+                machines.p[lane] = (rand.randint(0, 0xFF) |
+                                    klass.BREAK | klass.UNUSED)
+                memory = machines.memory[lane].copy()
+                mpu = klass(memory=memoryview(memory))
+                for name in ('pc', 'a', 'x', 'y', 'sp', 'p'):
+                    setattr(mpu, name, int(getattr(machines, name)[lane]))
+                mpu.step()
+                expected.append((mpu, memory))
+
+            machines.step()
+            for lane, (mpu, memory) in enumerate(expected):
+                msg = "%s $%02x" % (klass.__module__, lane)
+                self.assertEqual(
+                    (mpu.pc, mpu.a, mpu.x, mpu.y, mpu.sp, mpu.p,
+                     mpu.processorCycles),
+                    tuple(int(getattr(machines, name)[lane]) for name in
+                          ('pc', 'a', 'x', 'y', 'sp', 'p', 'cycles')), msg)
+                self.assertTrue(numpy.array_equal(memory,
+                                                  machines.memory[lane]), msg)
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
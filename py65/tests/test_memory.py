@@ -1,5 +1,13 @@
+import os
+import pickle
+import sys
+import tempfile
 import unittest
-from py65.memory import ObservableMemory
+from array import array
+from py65.memory import (Bus, DirtyPages, ObservableMemory, PagedMemory,
+                         SparseMemory)
+from py65.devices.mpu6502 import MPU
+import py65.devices.mpu65org16
 
 
 class ObservableMemoryTests(unittest.TestCase):
@@ -77,6 +85,100 @@ class ObservableMemoryTests(unittest.TestCase):
         value = value  # pyflakes
         self.assertEqual(['read_subscriber'], calls)
 
+    def test_subscribe_to_read_keeps_a_range_as_one_subscription(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        def read_subscriber(address):
+            return 0xAB
+
+        mem.subscribe_to_read(range(0xC000, 0xD000), read_subscriber)
+        self.assertEqual(1, len(mem._read_subscribers))
+        self.assertEqual(0xAB, mem[0xC000])
+        self.assertEqual(0xAB, mem[0xCFFF])
+        self.assertEqual(0x00, mem[0xD000])
+
+    def test_subscribe_to_read_wraps_range_past_end_of_memory(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        def read_subscriber(address):
+            return 0xAB
+
+        mem.subscribe_to_read(range(0xFFFF, 0x10001), read_subscriber)
+        self.assertEqual(0xAB, mem[0xFFFF])
+        self.assertEqual(0xAB, mem[0x0000])
+        self.assertEqual(0x00, mem[0x0001])
+
+    def test_subscribe_to_write_with_replace_unsubscribes_others(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        def write_subscriber_1(address, value):
+            return 0x01
+
+        def write_subscriber_2(address, value):
+            return 0x02
+
+        mem.subscribe_to_write(range(0xC000, 0xC100), write_subscriber_1)
+        mem.subscribe_to_write(range(0xC080, 0xC100), write_subscriber_2,
+                               replace=True)
+        mem[0xC07F] = 0xAB
+        mem[0xC080] = 0xAB
+        self.assertEqual(0x01, subject[0xC07F])
+        self.assertEqual(0x02, subject[0xC080])
+
+    # unsubscribe_from_read and unsubscribe_from_write
+
+    def test_unsubscribe_from_read_removes_only_given_addresses(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        def read_subscriber(address):
+            return 0xAB
+
+        mem.subscribe_to_read(range(0xC000, 0xC010), read_subscriber)
+        mem.unsubscribe_from_read(range(0xC004, 0xC008), read_subscriber)
+        self.assertEqual([0xAB] * 4 + [0x00] * 4 + [0xAB] * 8,
+                         mem[0xC000:0xC010])
+        self.assertEqual(2, len(mem._read_subscribers))
+
+    def test_unsubscribe_from_write_keeps_other_callbacks(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        calls = []
+
+        def write_subscriber_1(address, value):
+            calls.append('write_subscriber_1')
+
+        def write_subscriber_2(address, value):
+            calls.append('write_subscriber_2')
+
+        mem.subscribe_to_write([0xC000], write_subscriber_1)
+        mem.subscribe_to_write([0xC000], write_subscriber_2)
+        mem.unsubscribe_from_write([0xC000], write_subscriber_1)
+
+        mem[0xC000] = 0xAB
+        self.assertEqual(['write_subscriber_2'], calls)
+
+    def test_unsubscribe_without_callback_removes_all_callbacks(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        def read_subscriber_1(address):
+            return 0x01
+
+        def read_subscriber_2(address):
+            return 0x02
+
+        mem.subscribe_to_read(range(0xC000, 0xC100), read_subscriber_1)
+        mem.subscribe_to_read([0xC000], read_subscriber_2)
+        mem.unsubscribe_from_read(range(0xC000, 0xC100))
+
+        self.assertEqual(0, len(mem._read_subscribers))
+        self.assertEqual(0x00, mem[0xC000])
+
     # __getitem__
 
     def test___getitem__with_no_write_subscribers_changes_memory(self):
@@ -125,6 +227,159 @@ class ObservableMemoryTests(unittest.TestCase):
         expected_calls = ['read_subscriber_1', 'read_subscriber_2']
         self.assertEqual(expected_calls, calls)
 
+    def test___getitem__does_not_grow_subscribers(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        mem[0xC000] = mem[0xC001]
+        self.assertEqual(0, len(mem._read_subscribers))
+        self.assertEqual(0, len(mem._write_subscribers))
+
+    # slices
+
+    def test_slice_read_calls_only_subscribers_in_range(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        calls = []
+
+        def read_subscriber(address):
+            calls.append(address)
+            return 0xAB
+
+        mem.subscribe_to_read([0xC001, 0xC003], read_subscriber)
+        subject[0xC000:0xC005] = [0x01, 0x02, 0x03, 0x04, 0x05]
+
+        self.assertEqual([0x01, 0xAB, 0x03, 0xAB, 0x05], mem[0xC000:0xC005])
+        self.assertEqual([0xC001, 0xC003], calls)
+
+    def test_slice_write_calls_only_subscribers_in_range(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        calls = []
+
+        def write_subscriber(address, value):
+            calls.append(address)
+            return value + 1
+
+        mem.subscribe_to_write(range(0xC001, 0xC003), write_subscriber)
+        mem[0xC000:0xC004] = [0x01, 0x02, 0x03, 0x04]
+
+        self.assertEqual([0x01, 0x03, 0x04, 0x04], subject[0xC000:0xC004])
+        self.assertEqual([0xC001, 0xC002], calls)
+
+    def test_slice_copies_runs_without_subscribers_at_once(self):
+        subject = SliceCountingList(0x10000 * [0x00])
+        mem = ObservableMemory(subject=subject)
+
+        mem.subscribe_to_read([0xF004], lambda address: 0xAB)
+        mem.subscribe_to_write([0xF001], lambda address, value: None)
+        image = list(range(256)) * 256
+        mem[0x0000:0x10000] = image
+        self.assertEqual(image[:0xF004] + [0xAB] + image[0xF005:],
+                         mem[0x0000:0x10000])
+        self.assertEqual(4, subject.slices)
+
+    def test_slice_with_step_uses_each_address(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+
+        mem[0xC000:0xC004:2] = [0x01, 0x02]
+        self.assertEqual([0x01, 0x00, 0x02], subject[0xC000:0xC003])
+        self.assertEqual([0x01, 0x02], mem[0xC000:0xC004:2])
+
+    # protect
+
+    def test_protect_ignores_writes(self):
+        mem = ObservableMemory()
+        mem[0xF000] = 0x01
+        mem.protect(range(0xF000, 0x10000))
+        mem[0xF000] = 0xAB
+        mem[0xEFFF:0xF001] = [0x02, 0xAB]
+        self.assertEqual([0x02, 0x01], mem[0xEFFF:0xF001])
+
+    def test_protect_calls_on_write_with_writes_ignored(self):
+        mem = ObservableMemory()
+        writes = []
+        mem.protect(range(0xF000, 0x10000),
+                    lambda address, value: writes.append((address, value)))
+        mem[0xF001] = 0xAB
+        self.assertEqual([(0xF001, 0xAB)], writes)
+        self.assertEqual(0x00, mem[0xF001])
+
+    def test_write_loads_protected_addresses(self):
+        mem = ObservableMemory()
+        mem.protect(range(0xF000, 0x10000))
+        mem.write(0xF000, [0x01, 0x02])
+        self.assertEqual([0x01, 0x02], mem[0xF000:0xF002])
+
+    def test_unprotect_makes_addresses_writable(self):
+        mem = ObservableMemory()
+        mem.protect(range(0xF000, 0x10000))
+        mem.unprotect(range(0xF000, 0xF001))
+        mem[0xF000] = 0x01
+        mem[0xF001] = 0x02
+        self.assertEqual([0x01, 0x00], mem[0xF000:0xF002])
+
+    # dirty_pages
+
+    def test_dirty_pages_marks_pages_written_to(self):
+        subject = self._make_subject()
+        mem = ObservableMemory(subject=subject)
+        mem.dirty_pages = DirtyPages()
+
+        mem[0xC012] = 0xAB
+        mem[0x0100:0x0300] = [0x00] * 0x0200
+        mem.write(0xE0FF, [0x01, 0x02])
+        self.assertEqual([0x01, 0x02, 0xC0, 0xE0, 0xE1],
+                         mem.dirty_pages.dirty())
+
+    # snapshot, restore and fork
+
+    def test_restore_does_not_call_subscribers(self):
+        mem = ObservableMemory(subject=self._make_subject())
+        device = Device()
+        mem.subscribe_to_read(range(0x0000, 0x10000), device.read)
+        mem.subscribe_to_write(range(0x0000, 0x10000), device.write)
+        mem.write(0xC000, [0x01])
+        snapshot = mem.snapshot()
+        mem.write(0xC000, [0x02])
+        mem.restore(snapshot)
+        self.assertEqual(0x01, mem._subject[0xC000])
+        self.assertEqual(([], []), (device.reads, device.writes))
+
+    def test_fork_copies_subject_subscriptions_and_protection(self):
+        mem = ObservableMemory(subject=self._make_subject())
+        device = Device()
+        mem.subscribe_to_read([0xF004], device.read)
+        mem.protect(range(0xE000, 0x10000))
+        fork = mem.fork()
+        fork[0xC000] = 0x01
+        fork[0xE000] = 0x01
+        self.assertEqual([0x01, 0x00], [fork[0xC000], fork[0xE000]])
+        self.assertEqual(0x00, mem[0xC000])
+        self.assertEqual(0x42, fork[0xF004])
+        mem.unprotect(range(0xE000, 0x10000))
+        fork[0xE000] = 0x01
+        self.assertEqual(0x00, fork[0xE000])
+
+    # pickling
+
+    def test_pickle_keeps_contents_and_subscriptions(self):
+        mem = ObservableMemory(subject=self._make_subject())
+        mem[0xC000] = 0xAB
+        device = Device()
+        mem.subscribe_to_read([0xF004], device.read)
+        mem.protect(range(0xE000, 0x10000))
+
+        copy = pickle.loads(pickle.dumps(mem))
+        self.assertEqual(list, type(copy._subject))
+        self.assertEqual(0xAB, copy[0xC000])
+        self.assertEqual(0x42, copy[0xF004])
+        copy[0xE000] = 0x01
+        self.assertEqual(0x00, copy[0xE000])
+
     # __getattr__
 
     def test__getattr__proxies_subject(self):
@@ -152,5 +407,929 @@ class ObservableMemoryTests(unittest.TestCase):
         subject = 0x10000 * [0x00]
         return subject
 
+
+class DirtyPagesTests(unittest.TestCase):
+
+    def test_mark_and_dirty(self):
+        dirty_pages = DirtyPages()
+
+        dirty_pages.mark(0xC012)
+        dirty_pages.mark(0x01FF)
+        self.assertEqual([0x01, 0xC0], dirty_pages.dirty())
+
+    def test_mark_range_marks_each_page_in_range(self):
+        dirty_pages = DirtyPages()
+
+        dirty_pages.mark_range(0x10FF, 0x1201)
+        self.assertEqual([0x10, 0x11, 0x12], dirty_pages.dirty())
+
+    def test_mark_range_stops_at_end_of_bitmap(self):
+        dirty_pages = DirtyPages()
+
+        dirty_pages.mark_range(0xFF00, 0x10100)
+        self.assertEqual([0xFF], dirty_pages.dirty())
+        self.assertEqual(0x100, len(dirty_pages.bitmap))
+
+    def test_clear_and_take(self):
+        dirty_pages = DirtyPages()
+
+        dirty_pages.mark(0xC012)
+        self.assertEqual([0xC0], dirty_pages.take())
+        self.assertEqual([], dirty_pages.dirty())
+        dirty_pages.mark(0xC012)
+        dirty_pages.clear()
+        self.assertEqual([], dirty_pages.dirty())
+
+    def test_wide_address_space_uses_larger_pages(self):
+        dirty_pages = DirtyPages(addrWidth=32)
+
+        dirty_pages.mark(0xFFFF1234)
+        self.assertEqual(16, dirty_pages.page_bits)
+        self.assertEqual([0xFFFF], dirty_pages.dirty())
+
+
+class SliceCountingList(list):
+    """List counting the slices of it that are read or written"""
+
+    slices = 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self.slices += 1
+        return list.__getitem__(self, index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self.slices += 1
+        list.__setitem__(self, index, value)
+
+
+class PagedMemoryTests(unittest.TestCase):
+
+    # __setitem__ and __getitem__
+
+    def test___setitem__with_no_listeners_changes_memory(self):
+        mem = PagedMemory()
+
+        mem[0xC000] = 0xAB
+        self.assertEqual(0xAB, mem[0xC000])
+        self.assertEqual(0xAB, mem.read_pages[0xC0][0x00])
+
+    def test___setitem__uses_result_of_last_subscriber(self):
+        mem = PagedMemory()
+
+        def write_subscriber_1(address, value):
+            return 0x01
+
+        def write_subscriber_2(address, value):
+            return 0x02
+
+        mem.subscribe_to_write([0xC000], write_subscriber_1)
+        mem.subscribe_to_write([0xC000], write_subscriber_2)
+
+        mem[0xC000] = 0xAB
+        self.assertEqual(0x02, mem[0xC000])
+
+    def test___getitem__calls_all_read_subscribers_uses_last_result(self):
+        mem = PagedMemory()
+
+        calls = []
+
+        def read_subscriber_1(address):
+            calls.append('read_subscriber_1')
+            return 0x01
+
+        def read_subscriber_2(address):
+            calls.append('read_subscriber_2')
+            return 0x02
+
+        mem.subscribe_to_read([0xC000], read_subscriber_1)
+        mem.subscribe_to_read([0xC000], read_subscriber_2)
+
+        self.assertEqual(0x02, mem[0xC000])
+        expected_calls = ['read_subscriber_1', 'read_subscriber_2']
+        self.assertEqual(expected_calls, calls)
+
+    def test_subscribe_to_read_does_not_register_same_listener_twice(self):
+        mem = PagedMemory()
+
+        def read_subscriber(address):
+            return 0xAB
+
+        mem.subscribe_to_read([0xC000], read_subscriber)
+        mem.subscribe_to_read([0xC000], read_subscriber)
+        self.assertEqual([read_subscriber], mem._read_subscribers[0xC000])
+
+    def test_unsubscribe_maps_the_page_to_the_data_again(self):
+        mem = PagedMemory()
+
+        def write_subscriber(address, value):
+            return 0xFF
+        mem.subscribe_to_write(range(0xC000, 0xC200), write_subscriber)
+        mem.unsubscribe_from_write(range(0xC100, 0xC200))
+
+        self.assertFalse(isinstance(mem.write_pages[0xC0], memoryview))
+        self.assertTrue(isinstance(mem.write_pages[0xC1], memoryview))
+
+    def test_dirty_pages_marks_pages_written_to(self):
+        mem = PagedMemory()
+        mem.dirty_pages = DirtyPages()
+
+        mem[0xC012] = 0xAB
+        mem[0x0100:0x0102] = [0x01, 0x02]
+        mem.write(0xE000, [0x01])
+        self.assertEqual([0x01, 0xC0, 0xE0], mem.dirty_pages.dirty())
+
+    def test_16_bit_bytes_are_kept_in_an_array_of_words(self):
+        mem = PagedMemory(addrWidth=32, byteWidth=16)
+
+        mem[0x12345] = 0xABCD
+        self.assertEqual(0xABCD, mem[0x12345])
+        self.assertEqual('H', mem.read_pages[0x0001].format)
+
+    def test_wide_address_space_repeats_physical_memory(self):
+        mem = PagedMemory(addrWidth=32, byteWidth=16)
+
+        mem[0xFFFF0000] = 0x1234
+        self.assertEqual(0x1234, mem[0x00030000])
+        self.assertEqual(0x1234, mem.read_pages[0xFFFF][0])
+
+    # page tables
+
+    def test_pages_without_subscribers_are_views_of_the_data(self):
+        mem = PagedMemory()
+
+        mem.write_pages[0xC0][0x01] = 0xAB
+        self.assertEqual(0xAB, mem[0xC001])
+        self.assertTrue(isinstance(mem.read_pages[0xC0], memoryview))
+
+    def test_pages_with_subscribers_call_them(self):
+        mem = PagedMemory()
+
+        def read_subscriber(address):
+            return 0xAB
+        mem.subscribe_to_read([0xC001], read_subscriber)
+
+        self.assertEqual(0xAB, mem.read_pages[0xC0][0x01])
+        self.assertEqual(0x00, mem.read_pages[0xC0][0x02])
+        self.assertTrue(isinstance(mem.write_pages[0xC0], memoryview))
+
+    def test_page_tables_have_an_entry_wrapping_around(self):
+        mem = PagedMemory()
+
+        mem[0x0000] = 0xAB
+        self.assertEqual(257, len(mem.read_pages))
+        self.assertEqual(0xAB, mem.read_pages[0x100][0x00])
+
+    # slices
+
+    def test_slices_read_and_write_the_data(self):
+        mem = PagedMemory()
+
+        mem[0xFFFE:0x10000] = [0x01, 0x02]
+        self.assertEqual([0x01, 0x02], mem[-2:])
+        self.assertEqual([0x01, 0x02], mem[0xFFFE:])
+
+    def test_slices_call_subscribers_in_their_range(self):
+        mem = PagedMemory()
+
+        written = []
+
+        def write_subscriber(address, value):
+            written.append(address)
+            return value + 1
+        mem.subscribe_to_write([0xC001], write_subscriber)
+
+        mem[0xC000:0xC003] = [0x01, 0x02, 0x03]
+        self.assertEqual([0xC001], written)
+        self.assertEqual([0x01, 0x03, 0x03], mem[0xC000:0xC003])
+
+    # write
+
+    def test_write_directly_writes_values_to_data(self):
+        mem = PagedMemory()
+
+        def write_subscriber(address, value):
+            return 0xFF
+        mem.subscribe_to_write([0xC000, 0xC001], write_subscriber)
+
+        mem.write(0xC000, [0x01, 0x02])
+        self.assertEqual([0x01, 0x02], mem[0xC000:0xC002])
+
+    def test_write_wraps_around_end_of_memory(self):
+        mem = PagedMemory()
+
+        mem.write(0xFFFF, [0x01, 0x02])
+        self.assertEqual(0x01, mem[0xFFFF])
+        self.assertEqual(0x02, mem[0x0000])
+        self.assertEqual(0x10000, len(mem))
+
+    # protect
+
+    def test_protected_pages_discard_writes_without_a_call(self):
+        mem = PagedMemory()
+        mem.write(0xF000, [0x01])
+        mem.protect(range(0xF000, 0x10000))
+        mem.write_pages[0xF0][0x00] = 0xAB
+        mem[0xF001] = 0xAB
+        self.assertEqual([0x01, 0x00], mem[0xF000:0xF002])
+        self.assertTrue(isinstance(mem.write_pages[0xF0], memoryview))
+        self.assertFalse(mem.write_pages[0xF0] is mem.read_pages[0xF0])
+
+    def test_partly_protected_pages_protect_only_their_range(self):
+        mem = PagedMemory()
+        mem.protect(range(0xF080, 0x10000))
+        mem.write_pages[0xF0][0x7F] = 0x01
+        mem.write_pages[0xF0][0x80] = 0x02
+        self.assertEqual([0x01, 0x00], mem[0xF07F:0xF081])
+
+    def test_protect_calls_on_write_with_writes_ignored(self):
+        mem = PagedMemory()
+        writes = []
+        mem.protect(range(0xF000, 0x10000),
+                    lambda address, value: writes.append((address, value)))
+        mem.write_pages[0xFF][0xFC] = 0xAB
+        self.assertEqual([(0xFFFC, 0xAB)], writes)
+        self.assertEqual(0x00, mem[0xFFFC])
+
+    def test_unprotect_maps_the_page_to_the_data_again(self):
+        mem = PagedMemory()
+        mem.protect(range(0xF000, 0x10000))
+        mem.unprotect(range(0xF000, 0x10000))
+        mem.write_pages[0xF0][0x00] = 0x01
+        self.assertEqual(0x01, mem[0xF000])
+        self.assertTrue(mem.write_pages[0xF0] is mem.read_pages[0xF0])
+
+    def test_fork_copies_protection(self):
+        mem = PagedMemory()
+        mem.protect(range(0xF000, 0x10000))
+
+        fork = mem.fork()
+        fork[0xF000] = 0x01
+        self.assertEqual(0x00, fork[0xF000])
+
+    # snapshot, restore and fork
+
+    def test_restore_returns_to_contents_at_snapshot(self):
+        mem = PagedMemory()
+        mem[0xC000] = 0x01
+
+        snapshot = mem.snapshot()
+        mem[0xC000] = 0x02
+        mem.write_pages[0xD0][0x00] = 0x03
+        mem.restore(snapshot)
+        self.assertEqual(0x01, mem[0xC000])
+        self.assertEqual(0x00, mem[0xD000])
+
+    def test_restore_only_changes_pages_written_to(self):
+        mem = PagedMemory()
+
+        snapshot = mem.snapshot()
+        mem[0xC000] = 0x01
+        read_pages = list(mem.read_pages)
+        mem.restore(snapshot)
+        changed = [page for page, entry in enumerate(mem.read_pages)
+                   if entry is not read_pages[page]]
+        self.assertEqual([0xC0], changed)
+
+    def test_snapshot_can_be_restored_more_than_once(self):
+        mem = PagedMemory()
+
+        snapshot = mem.snapshot()
+        for value in (0x01, 0x02):
+            mem[0xC000] = value
+            mem.restore(snapshot)
+            self.assertEqual(0x00, mem[0xC000])
+
+    def test_fork_is_independent(self):
+        mem = PagedMemory()
+        mem[0xC000] = 0x01
+
+        fork = mem.fork()
+        fork[0xC000] = 0x02
+        mem.write_pages[0xC0][0x01] = 0x03
+        self.assertEqual([0x01, 0x03], mem[0xC000:0xC002])
+        self.assertEqual([0x02, 0x00], fork[0xC000:0xC002])
+
+    def test_fork_shares_unmodified_pages(self):
+        mem = PagedMemory()
+
+        fork = mem.fork()
+        fork[0xC000] = 0x01
+        self.assertTrue(fork.read_pages[0xD0] is mem.read_pages[0xD0])
+        self.assertFalse(fork.read_pages[0xC0] is mem.read_pages[0xC0])
+
+    def test_fork_copies_subscriptions(self):
+        mem = PagedMemory()
+        mem.subscribe_to_read([0xC000], lambda address: 0xAB)
+
+        fork = mem.fork()
+        mem.unsubscribe_from_read([0xC000])
+        self.assertEqual(0xAB, fork.read_pages[0xC0][0x00])
+        self.assertEqual(0x00, mem.read_pages[0xC0][0x00])
+
+    # pickling
+
+    def test_pickle_keeps_contents_and_subscriptions(self):
+        mem = PagedMemory()
+        mem[0xC000] = 0xAB
+        device = Device()
+        mem.subscribe_to_write([0xF001], device.write)
+        mem.protect(range(0xE000, 0xF000))
+        mem.dirty_pages = DirtyPages()
+
+        data = pickle.dumps((mem, device))
+        self.assertTrue(len(data) < 0x10000 + 1024)
+        copy, device = pickle.loads(data)
+        self.assertEqual(0xAB, copy[0xC000])
+        copy.write_pages[0xF0][0x01] = 0x02
+        self.assertEqual([(0xF001, 0x02)], device.writes)
+        copy[0xE000] = 0x01
+        self.assertEqual(0x00, copy[0xE000])
+        self.assertEqual([0xF0], copy.dirty_pages.dirty())
+
+    # MPU
+
+    def test_mpu_calls_subscribers_of_observed_pages(self):
+        mem = PagedMemory()
+        mem.subscribe_to_read([0xF004], lambda address: 0x41)
+        output = []
+        mem.subscribe_to_write([0xF001],
+                               lambda address, value: output.append(value))
+        # $0000 LDA $F004
+        # $0003 STA $F001
+        # $0006 STA $0200
+        mem.write(0x0000, [0xAD, 0x04, 0xF0, 0x8D, 0x01, 0xF0,
+                           0x8D, 0x00, 0x02])
+        mpu = MPU(memory=mem)
+        mpu.run(max_instructions=3)
+        self.assertEqual([0x41], output)
+        self.assertEqual(0x41, mem[0x0200])
+
+    def test_mpu_does_not_change_protected_memory(self):
+        mem = PagedMemory()
+        # $F000 LDA #$AB
+        # $F002 STA $F000
+        # $F005 STA $0200
+        mem.write(0xF000, [0xA9, 0xAB, 0x8D, 0x00, 0xF0, 0x8D, 0x00, 0x02])
+        mem.protect(range(0xF000, 0x10000))
+        mpu = MPU(memory=mem, pc=0xF000)
+        mpu.run(max_instructions=3)
+        self.assertEqual(0xA9, mem[0xF000])
+        self.assertEqual(0xAB, mem[0x0200])
+
+class SparseMemoryTests(unittest.TestCase):
+
+    def test_pages_not_written_to_read_as_zero(self):
+        mem = SparseMemory()
+        self.assertEqual(0x0000, mem[0xFFFF0000])
+        self.assertEqual([0x0000] * 4, mem[0x12345678:0x1234567C])
+        self.assertEqual(0, len(mem._ram_pages))
+
+    def test_writing_allocates_only_the_page_written_to(self):
+        mem = SparseMemory()
+        mem[0xFFFF1234] = 0xABCD
+        self.assertEqual(0xABCD, mem[0xFFFF1234])
+        self.assertEqual(0x0000, mem[0x00001234])
+        self.assertEqual([0xFFFF], list(mem._ram_pages))
+
+    def test_addresses_cover_the_whole_address_space(self):
+        mem = SparseMemory()
+        mem[0x00040000] = 0x0001
+        self.assertEqual(0x0000, mem[0x00000000])
+        self.assertEqual(0x100000000, len(mem))
+
+    def test_write_pages_allocate_a_page_when_written_to(self):
+        mem = SparseMemory()
+        mem.write_pages[0x8000][0x0010] = 0x1234
+        self.assertEqual(0x1234, mem[0x80000010])
+        self.assertEqual(0x1234, mem.read_pages[0x8000][0x0010])
+
+    def test_writes_to_protected_pages_do_not_allocate_them(self):
+        mem = SparseMemory()
+        mem.protect(range(0xFFFF0000, 0x100000000))
+        mem.write_pages[0xFFFF][0x0000] = 0x1234
+        mem[0xFFFF0001] = 0x1234
+        self.assertEqual([0x0000, 0x0000], mem[0xFFFF0000:0xFFFF0002])
+        self.assertEqual(0, len(mem._ram_pages))
+
+    def test_page_tables_have_an_entry_wrapping_around(self):
+        mem = SparseMemory()
+        mem.write_pages[0x10000][0x0001] = 0x0002
+        self.assertEqual(0x0002, mem[0x00000001])
+        self.assertTrue(mem.read_pages[0x10000] is mem.read_pages[0x0000])
+
+    def test_subscribers_of_a_page_not_written_to_are_called(self):
+        mem = SparseMemory()
+        mem.subscribe_to_read([0xFFFFF000], lambda address: 0x4142)
+        writes = []
+        mem.subscribe_to_write([0x7FFF0000],
+                               lambda address, value: writes.append(value))
+        self.assertEqual(0x4142, mem.read_pages[0xFFFF][0xF000])
+        mem.write_pages[0x7FFF][0x0000] = 0x0043
+        self.assertEqual([0x0043], writes)
+
+    def test_restore_frees_pages_allocated_since_the_snapshot(self):
+        mem = SparseMemory()
+        mem[0x00010000] = 0x0001
+
+        snapshot = mem.snapshot()
+        mem[0x00010000] = 0x0002
+        mem[0x00020000] = 0x0003
+        mem.restore(snapshot)
+        self.assertEqual(0x0001, mem[0x00010000])
+        self.assertEqual(0x0000, mem[0x00020000])
+        self.assertEqual([0x0001], list(mem._ram_pages))
+
+    def test_fork_is_independent(self):
+        mem = SparseMemory()
+        mem[0x00010000] = 0x0001
+
+        fork = mem.fork()
+        fork[0x00010000] = 0x0002
+        fork[0x00020000] = 0x0003
+        mem.write_pages[0x0001][0x0001] = 0x0004
+        self.assertEqual([0x0001, 0x0004], mem[0x00010000:0x00010002])
+        self.assertEqual([0x0002, 0x0000], fork[0x00010000:0x00010002])
+        self.assertEqual(0x0000, mem[0x00020000])
+
+    def test_pickle_keeps_only_the_pages_allocated(self):
+        mem = SparseMemory()
+        mem[0x12340000] = 0x1234
+
+        data = pickle.dumps(mem)
+        self.assertTrue(len(data) < 0x20000 + 1024)
+        copy = pickle.loads(data)
+        self.assertEqual(0x1234, copy[0x12340000])
+        self.assertEqual([0x1234], list(copy._ram_pages))
+
+    def test_8_bit_bytes(self):
+        mem = SparseMemory(addrWidth=16, byteWidth=8, page_bits=8)
+        mem[0xC000] = 0xAB
+        self.assertEqual(0xAB, mem[0xC000])
+        self.assertEqual([0xC0], list(mem._ram_pages))
+
+    # MPU
+
+    def test_65org16_mpu_uses_the_whole_address_space_by_default(self):
+        mpu = py65.devices.mpu65org16.MPU()
+        self.assertTrue(isinstance(mpu.memory, SparseMemory))
+        # $FFFF0000 LDA #$1234
+        # $FFFF0002 STA $12340000
+        # $FFFF0004 PHA
+        mpu.memory.write(0xFFFF0000, [0x00A9, 0x1234, 0x008D, 0x0000,
+                                      0x1234, 0x0048])
+        mpu.pc = 0xFFFF0000
+        mpu.run(max_instructions=3)
+        self.assertEqual(0x1234, mpu.memory[0x12340000])
+        self.assertEqual(0x1234, mpu.memory[0x0001FFFF])
+        self.assertEqual(0x0000, mpu.memory[0x00000000])
+        self.assertEqual([0x0001, 0x1234, 0xFFFF],
+                         sorted(mpu.memory._ram_pages))
+
+
+class Device:
+    """Device recording the offsets it is accessed at"""
+
+    def __init__(self):
+        self.reads = []
+        self.writes = []
+
+    def read(self, offset):
+        self.reads.append(offset)
+        return 0x42
+
+    def write(self, offset, value):
+        self.writes.append((offset, value))
+
+
+class BusTests(unittest.TestCase):
+
+    # mapping
+
+    def test_unmapped_pages_read_zero_and_ignore_writes(self):
+        bus = Bus()
+
+        bus[0xC000] = 0xAB
+        self.assertEqual(0x00, bus[0xC000])
+
+    def test_map_ram_reads_and_writes_its_buffer(self):
+        bus = Bus()
+
+        ram = bus.map_ram(range(0x0200, 0x0400), [0x01, 0x02])
+        bus[0x0300] = 0xAB
+        self.assertEqual(0x01, bus[0x0200])
+        self.assertEqual(0x02, bus[0x0201])
+        self.assertEqual(0xAB, ram[0x0100])
+        self.assertEqual(0x0200, len(ram))
+
+    def test_map_rom_ignores_writes(self):
+        bus = Bus()
+
+        bus.map_rom(range(0xF000, 0x10000), [0x01, 0x02])
+        bus[0xF000] = 0xAB
+        self.assertEqual(0x01, bus[0xF000])
+        self.assertEqual([0x01, 0x02, 0x00], bus[0xF000:0xF003])
+
+    def test_map_rom_calls_on_write_with_writes_ignored(self):
+        bus = Bus()
+
+        writes = []
+        bus.map_rom(range(0xF000, 0x10000), [0x01],
+                    lambda address, value: writes.append((address, value)))
+        bus[0xF000] = 0xAB
+        bus.write_pages[0xFF][0xFC] = 0xCD
+        self.assertEqual([(0xF000, 0xAB), (0xFFFC, 0xCD)], writes)
+        self.assertEqual(0x01, bus[0xF000])
+
+    def test_map_device_passes_offset_within_window(self):
+        bus = Bus()
+
+        device = Device()
+        bus.map_device(range(0xD000, 0xD200), device)
+        self.assertEqual(0x42, bus[0xD105])
+        bus[0xD001] = 0xAB
+        self.assertEqual([0x0105], device.reads)
+        self.assertEqual([(0x0001, 0xAB)], device.writes)
+
+    def test_unmap_removes_a_mapping(self):
+        bus = Bus()
+
+        bus.map_ram(range(0x0000, 0x10000))
+        bus[0x8000] = 0xAB
+        bus.unmap(range(0x8000, 0x8100))
+        self.assertEqual(0x00, bus[0x8000])
+
+    def test_map_banks_switches_the_bank_in_the_window(self):
+        bus = Bus()
+
+        banks = bus.map_banks(range(0x8000, 0xC000), 4,
+                              [[0x01], [0x02], [0x03]])
+        self.assertEqual(0x01, bus[0x8000])
+        bus[0xBFFF] = 0xAB
+        banks.select(2)
+        self.assertEqual(0x03, bus[0x8000])
+        self.assertEqual(0x00, bus[0xBFFF])
+        banks.select(0)
+        self.assertEqual(0xAB, bus[0xBFFF])
+        self.assertEqual(0xAB, banks.buffers[0][0x3FFF])
+        self.assertEqual(4, len(banks))
+
+    def test_map_banks_selects_with_writes_to_the_bank_register(self):
+        bus = Bus()
+
+        banks = bus.map_banks(range(0x8000, 0xC000), 4, [[0x01], [0x02]])
+        bus.map_device(range(0xDF00, 0xE000), banks)
+        bus[0xDF00] = 0x05
+        self.assertEqual(1, banks.selected)
+        self.assertEqual(0x01, bus[0xDF00])
+        self.assertEqual(0x02, bus[0x8000])
+
+    def test_map_banks_of_rom_ignore_writes(self):
+        bus = Bus()
+
+        banks = bus.map_banks(range(0x8000, 0xC000), 2, [[0x01], [0x02]],
+                              rom=True)
+        bus[0x8000] = 0xAB
+        banks.select(1)
+        bus[0x8000] = 0xAB
+        self.assertEqual(0x02, bus[0x8000])
+        banks.select(0)
+        self.assertEqual(0x01, bus[0x8000])
+
+    def test_map_banks_pages_are_views_of_the_bank(self):
+        bus = Bus()
+
+        banks = bus.map_banks(range(0x0000, 0x4000), 2)
+        banks.select(1)
+        bus.write_pages[0x01][0x00] = 0xAB
+        self.assertEqual(0xAB, banks.buffers[1][0x0100])
+        bus.write(0x0002, [0xCD])
+        self.assertEqual(0xCD, banks.buffers[1][0x0002])
+        self.assertTrue(bus.read_pages[-1] is bus.read_pages[0x00])
+
+    def test_map_banks_raises_for_more_data_than_banks(self):
+        bus = Bus()
+
+        self.assertRaises(ValueError, bus.map_banks,
+                          range(0x8000, 0xC000), 1, [[0x01], [0x02]])
+
+    def test_map_with_configured_page_size(self):
+        bus = Bus(page_bits=4)
+
+        device = Device()
+        bus.map_device(range(0xD010, 0xD020), device)
+        bus[0xD01F] = 0xAB
+        self.assertEqual(0x00, bus[0xD020])
+        self.assertEqual([(0x000F, 0xAB)], device.writes)
+
+    def test_map_raises_for_ranges_that_are_not_whole_pages(self):
+        bus = Bus()
+
+        for r in (range(0xD001, 0xD100), range(0xD000, 0xD0FF),
+                  range(0xD000, 0xD000), range(0xD000, 0xD200, 2),
+                  range(0xFF00, 0x10100)):
+            self.assertRaises(ValueError, bus.map_ram, r)
+
+    def test_map_raises_for_data_larger_than_window(self):
+        bus = Bus()
+
+        self.assertRaises(ValueError, bus.map_rom, range(0xFF00, 0x10000),
+                          bytes(0x101))
+
+    def test_16_bit_bytes_in_wide_address_space(self):
+        bus = Bus(addrWidth=32, byteWidth=16)
+
+        bus.map_ram(range(0xFFFF0000, 0x100000000))
+        bus[0xFFFF1234] = 0xABCD
+        self.assertEqual(0xABCD, bus[0xFFFF1234])
+        self.assertEqual(0x00, bus[0x00001234])
+
+    # page tables
+
+    def test_page_tables_have_an_entry_wrapping_around(self):
+        bus = Bus()
+
+        bus.map_ram(range(0x0000, 0x0100), [0xAB])
+        self.assertEqual(257, len(bus.read_pages))
+        self.assertEqual(0xAB, bus.read_pages[0x100][0x00])
+
+    def test_accesses_do_not_grow_the_bus(self):
+        bus = Bus()
+
+        bus.map_ram(range(0x0000, 0x10000))
+        tables = (list(bus.read_pages), list(bus.write_pages))
+        for address in range(0x10000):
+            bus[address] = bus[address]
+        self.assertEqual(tables, (bus.read_pages, bus.write_pages))
+
+    # files
+
+    def test_map_rom_file_maps_file_without_copying(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                f.write(bytes(range(256)) * 2 + bytes([0xAB]))
+
+            bus = Bus()
+            bus.map_rom_file(range(0xF000, 0x10000), f.name)
+            self.assertEqual(0x01, bus[0xF001])
+            self.assertEqual([0xFF, 0x00], bus[0xF0FF:0xF101])
+            self.assertEqual([0xAB, 0x00], bus[0xF200:0xF202])
+            self.assertEqual(0x00, bus[0xFFFF])
+            self.assertEqual('mmap', type(bus.read_pages[0xF0].obj).__name__)
+            bus[0xF000] = 0x42
+            self.assertEqual(0x00, bus[0xF000])
+        finally:
+            os.unlink(f.name)
+
+    def test_map_rom_file_reads_big_endian_words(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                f.write(bytes([0x12, 0x34, 0xAB, 0xCD]))
+
+            bus = Bus(addrWidth=32, byteWidth=16)
+            bus.map_rom_file(range(0x10000, 0x20000), f.name,
+                             byteorder='big')
+            self.assertEqual([0x1234, 0xABCD, 0x0000],
+                             bus[0x10000:0x10003])
+        finally:
+            os.unlink(f.name)
+
+    def test_map_rom_file_maps_native_words_without_copying(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                f.write(array('H', [0x1234] * 0x10000).tobytes())
+
+            bus = Bus(addrWidth=32, byteWidth=16)
+            bus.map_rom_file(range(0x10000, 0x20000), f.name)
+            self.assertEqual([0x1234, 0x1234], bus[0x1FFFE:0x20000])
+            self.assertEqual('mmap',
+                             type(bus.read_pages[0x0001].obj).__name__)
+        finally:
+            os.unlink(f.name)
+
+    def test_map_rom_file_raises_for_unknown_byteorder(self):
+        bus = Bus(addrWidth=32, byteWidth=16)
+        self.assertRaises(ValueError, bus.map_rom_file,
+                          range(0x10000, 0x20000), 'rom.bin',
+                          byteorder='middle')
+
+    def test_map_rom_file_raises_for_file_larger_than_window(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                f.write(bytes(0x101))
+
+            bus = Bus()
+            self.assertRaises(ValueError, bus.map_rom_file,
+                              range(0xFF00, 0x10000), f.name)
+        finally:
+            os.unlink(f.name)
+
+    def test_map_ram_file_persists_contents(self):
+        filename = tempfile.mktemp()
+        try:
+            bus = Bus()
+            bus.map_ram_file(range(0x6000, 0x8000), filename)
+            bus[0x6001] = 0xAB
+            bus.flush()
+            self.assertEqual(0x2000, os.path.getsize(filename))
+
+            bus = Bus()
+            bus.map_ram_file(range(0x6000, 0x8000), filename)
+            self.assertEqual([0x00, 0xAB], bus[0x6000:0x6002])
+            del bus
+        finally:
+            os.unlink(filename)
+
+    def test_map_ram_file_with_16_bit_bytes(self):
+        filename = tempfile.mktemp()
+        try:
+            bus = Bus(addrWidth=32, byteWidth=16)
+            bus.map_ram_file(range(0x10000, 0x20000), filename)
+            bus[0x10001] = 0xABCD
+            self.assertEqual(0xABCD, bus.read_pages[0x0001][0x0001])
+            self.assertEqual(0x20000, os.path.getsize(filename))
+            del bus
+        finally:
+            os.unlink(filename)
+
+    def test_map_ram_file_raises_for_other_byteorder(self):
+        other = 'little' if sys.byteorder == 'big' else 'big'
+        bus = Bus(addrWidth=32, byteWidth=16)
+        self.assertRaises(ValueError, bus.map_ram_file,
+                          range(0x10000, 0x20000), 'ram.bin',
+                          byteorder=other)
+
+    # snapshot, restore and fork
+
+    def test_restore_returns_to_contents_and_banks_at_snapshot(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        banks = bus.map_banks(range(0x8000, 0xC000), 2)
+        bus.map_rom(range(0xF000, 0x10000), [0x01])
+        snapshot = bus.snapshot()
+        bus[0x0000] = 0x01
+        bus[0x8000] = 0x02
+        banks.select(1)
+        bus[0x8000] = 0x03
+        bus.write(0xF000, [0x04])
+        bus.restore(snapshot)
+        self.assertEqual(0, banks.selected)
+        self.assertEqual([0x00, 0x00, 0x01],
+                         [bus[0x0000], bus[0x8000], bus[0xF000]])
+        banks.select(1)
+        self.assertEqual(0x00, bus[0x8000])
+
+    def test_snapshot_and_restore_do_not_access_devices(self):
+        bus = Bus()
+        device = Device()
+        bus.map_device(range(0xD000, 0xD100), device)
+        bus.restore(bus.snapshot())
+        self.assertEqual(([], []), (device.reads, device.writes))
+
+    def test_snapshot_of_16_bit_bytes(self):
+        bus = Bus(addrWidth=32, byteWidth=16)
+        bus.map_ram(range(0x10000, 0x20000))
+        bus[0x10000] = 0xABCD
+        snapshot = bus.snapshot()
+        bus[0x10000] = 0x1234
+        bus.restore(snapshot)
+        self.assertEqual(0xABCD, bus[0x10000])
+
+    def test_fork_is_independent_and_keeps_the_mapping(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        banks = bus.map_banks(range(0x8000, 0xC000), 2, [[0x01], [0x02]])
+        bus.map_device(range(0xDF00, 0xE000), banks)
+        device = Device()
+        bus.map_device(range(0xD000, 0xD100), device)
+        bus.map_rom(range(0xF000, 0x10000), [0x03])
+        banks.select(1)
+
+        fork = bus.fork()
+        fork[0x0000] = 0x04
+        fork[0xF000] = 0x05
+        self.assertEqual([0x04, 0x02, 0x42, 0x03],
+                         [fork[0x0000], fork[0x8000], fork[0xD000],
+                          fork[0xF000]])
+        fork[0xDF00] = 0
+        self.assertEqual([0x01, 0x02], [fork[0x8000], bus[0x8000]])
+        self.assertEqual([0x00, 1], [bus[0x0000], banks.selected])
+
+    # pickling
+
+    def test_pickle_keeps_contents_banks_and_mapping(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                f.write(bytes([0xAB]))
+
+            bus = Bus()
+            bus.map_ram(range(0x0000, 0x8000), [0x01])
+            banks = bus.map_banks(range(0x8000, 0xC000), 2, [[0x02], [0x03]])
+            bus.map_device(range(0xDF00, 0xE000), banks)
+            bus.map_rom_file(range(0xF000, 0x10000), f.name)
+            banks.select(1)
+            copy = pickle.loads(pickle.dumps(bus))
+        finally:
+            os.unlink(f.name)
+        self.assertEqual([0x01, 0x03, 0xAB],
+                         [copy[0x0000], copy[0x8000], copy[0xF000]])
+        copy[0xF000] = 0x00
+        copy[0xDF00] = 0
+        self.assertEqual([0x02, 0xAB], [copy[0x8000], copy[0xF000]])
+        self.assertEqual(1, banks.selected)
+
+    # write
+
+    def test_write_loads_ram_and_rom(self):
+        bus = Bus()
+
+        bus.map_ram(range(0x0000, 0x0100))
+        bus.map_rom(range(0x0100, 0x0200), [])
+        bus.write(0x00FF, [0x01, 0x02, 0x03])
+        self.assertEqual([0x01, 0x02, 0x03], bus[0x00FF:0x0102])
+
+    def test_dirty_pages_marks_pages_written_to(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x10000))
+        bus.dirty_pages = DirtyPages()
+
+        bus[0xC012] = 0xAB
+        bus.write(0xE0FF, [0x01, 0x02])
+        self.assertEqual([0xC0, 0xE0, 0xE1], bus.dirty_pages.dirty())
+
+    def test_dirty_pages_marks_pages_remapped(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        banks = bus.map_banks(range(0x8000, 0x8200), 2)
+        bus.dirty_pages = DirtyPages()
+
+        banks.select(1)
+        bus.unmap(range(0x7000, 0x7100))
+        self.assertEqual([0x70, 0x80, 0x81], bus.dirty_pages.dirty())
+
+    def test_mpu_gives_dirty_pages_to_bus(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x10000))
+        mpu = MPU(memory=bus)
+        mpu.dirty_pages = DirtyPages()
+
+        bus[0xC012] = 0xAB
+        self.assertTrue(bus.dirty_pages is mpu.dirty_pages)
+        self.assertEqual([0xC0], mpu.dirty_pages.dirty())
+
+    # MPU
+
+    def test_mpu_accesses_ram_rom_and_devices(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        device = Device()
+        bus.map_device(range(0xD000, 0xD100), device)
+        # $F000 LDA $D010
+        # $F003 STA $D011
+        # $F006 STA $0200
+        bus.map_rom(range(0xF000, 0x10000), [0xAD, 0x10, 0xD0, 0x8D, 0x11,
+                                             0xD0, 0x8D, 0x00, 0x02])
+        mpu = MPU(memory=bus, pc=0xF000)
+        mpu.run(max_instructions=3)
+        self.assertEqual([0x10], device.reads)
+        self.assertEqual([(0x11, 0x42)], device.writes)
+        self.assertEqual(0x42, bus[0x0200])
+
+    def test_mpu_reads_the_bank_selected(self):
+        bus = Bus()
+
+        bus.map_ram(range(0x0000, 0x8000))
+        banks = bus.map_banks(range(0x8000, 0xC000), 2, [[0x01], [0x02]])
+        bus.map_device(range(0xDF00, 0xE000), banks)
+        # $F000 LDA $8000
+        # $F003 STA $0200
+        # $F006 INC $DF00
+        # $F009 LDA $8000
+        # $F00C STA $0201
+        bus.map_rom(range(0xF000, 0x10000), [0xAD, 0x00, 0x80, 0x8D, 0x00,
+                                             0x02, 0xEE, 0x00, 0xDF, 0xAD,
+                                             0x00, 0x80, 0x8D, 0x01, 0x02])
+        mpu = MPU(memory=bus, pc=0xF000)
+        mpu.run(max_instructions=5)
+        self.assertEqual([0x01, 0x02], bus[0x0200:0x0202])
+
+    def test_mpu_fork_keeps_devices_and_rom(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        device = Device()
+        bus.map_device(range(0xD000, 0xD100), device)
+        # $F000 STA $D011
+        # $F003 STA $F000
+        bus.map_rom(range(0xF000, 0x10000), [0x8D, 0x11, 0xD0, 0x8D, 0x00,
+                                             0xF0])
+        mpu = MPU(memory=bus, pc=0xF000)
+        fork = mpu.fork()
+        self.assertEqual(Bus, type(fork.memory))
+        fork.run(max_instructions=2)
+        self.assertEqual([(0x11, 0x00)], device.writes)
+        self.assertEqual(0x8D, fork.memory[0xF000])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1239,6 +1239,39 @@ class MonitorTests(unittest.TestCase):
         finally:
             os.unlink(f.name)
 
+    def test_argv_rom_is_read_only(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                rom = bytearray(4096)
+                rom[0]  = 0xea          # f000 nop
+                f.write(rom)
+
+            argv = ['py65mon', '--rom', f.name]
+            stdout = StringIO()
+            mon = Monitor(argv=argv, stdout=stdout)
+            mon._mpu.memory[0xf000] = 0x00
+            mon._mpu.memory[0xefff] = 0x01
+            self.assertEqual([0x01, 0xea], mon._mpu.memory[0xefff:0xf001])
+        finally:
+            os.unlink(f.name)
+
+    def test_argv_rom_can_be_patched_by_fill_and_assemble(self):
+        try:
+            with tempfile.NamedTemporaryFile('wb+', delete=False) as f:
+                f.write(bytearray(4096))
+
+            argv = ['py65mon', '--rom', f.name]
+            stdout = StringIO()
+            mon = Monitor(argv=argv, stdout=stdout)
+            mon.do_fill('f000 ea')
+            mon.do_assemble('f001 lda #$ff')
+            self.assertEqual([0xea, 0xa9, 0xff],
+                             mon._mpu.memory[0xf000:0xf003])
+            mon._mpu.memory[0xf000] = 0x00
+            self.assertEqual(0xea, mon._mpu.memory[0xf000])
+        finally:
+            os.unlink(f.name)
+
     def test_argv_input(self):
         argv = ['py65mon', '--input', 'abcd']
         stdout = StringIO()
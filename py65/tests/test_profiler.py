@@ -0,0 +1,144 @@
+import sys
+import unittest
+from py65.devices.mpu6502 import MPU
+from py65.devices.mpu65org16 import MPU as V65Org16
+from py65.profiler import Profile
+from py65.utils.addressing import AddressParser
+
+try:
+    from StringIO import StringIO
+except ImportError: # Python 3
+    from io import StringIO
+
+
+class ProfileTests(unittest.TestCase):
+
+    def test_counts_instructions_and_cycles_per_address(self):
+        mpu = self._make_mpu()
+        mpu.run(stop_opcodes=[0x00])
+        profile = mpu.profile
+        self.assertEqual(3, profile.instructions[0xC002])
+        self.assertEqual(18, profile.cycles[0xC002])
+        self.assertEqual(6, profile.instructions[0xC200])
+        self.assertEqual(46, profile.executed)
+        self.assertEqual(mpu.processorCycles,
+                         sum(cycles for _, _, cycles in profile.addresses()))
+
+    def test_step_counts_instructions(self):
+        mpu = self._make_mpu()
+        mpu.step()
+        mpu.step()
+        self.assertEqual([(0xC002, 1, 6), (0xC000, 1, 2)],
+                         mpu.profile.addresses())
+
+    def test_branch_cycles_are_attributed_to_the_branch(self):
+        mpu = self._make_mpu()
+        mpu.run(stop_opcodes=[0x00])
+        # taken twice (3 cycles), not taken once (2 cycles)
+        self.assertEqual(8, mpu.profile.cycles[0xC006])
+
+    def test_subroutines_roll_up_per_jsr_target(self):
+        mpu = self._make_mpu()
+        mpu.run(stop_opcodes=[0x00])
+        self.assertEqual(
+            [(None, 0, 10, 34, 46, 169),
+             (0xC100, 3, 24, 87, 36, 135),
+             (0xC200, 6, 12, 48, 12, 48)],
+            mpu.profile.subroutines())
+
+    def test_rts_without_jsr_is_ignored(self):
+        profile = Profile()
+        profile.ret(1, 6)
+        self.assertEqual({}, profile.calls)
+
+    def test_entry_points_start_subroutines(self):
+        profile = Profile()
+        profile.entry_points.add(0xC000)
+        self.assertEqual(0xC000, profile.subroutine_of(0xC005))
+        self.assertEqual(None, profile.subroutine_of(0xB000))
+
+    def test_clear(self):
+        mpu = self._make_mpu()
+        mpu.run(stop_opcodes=[0x00])
+        mpu.profile.clear()
+        self.assertEqual([], mpu.profile.addresses())
+        self.assertEqual([], mpu.profile.subroutines())
+
+    def test_write_flat_lists_costliest_addresses_first(self):
+        mpu = self._make_mpu()
+        mpu.run(stop_opcodes=[0x00])
+        f = StringIO()
+        mpu.profile.write_flat(f, mpu, limit=1)
+        lines = f.getvalue().splitlines()
+        self.assertEqual('          36  21.30             6  $c102  JSR $c200',
+                         lines[3])
+        self.assertEqual('         169 100.00            34             0'
+                         '  (outside subroutines)', lines[8])
+
+    def test_write_callgrind(self):
+        mpu = self._make_mpu()
+        mpu.run(stop_opcodes=[0x00])
+        address_parser = AddressParser(labels={'outer': 0xC100})
+        f = StringIO()
+        mpu.profile.write_callgrind(f, mpu, address_parser)
+        text = f.getvalue()
+        self.assertTrue(text.startswith('# callgrind format\n'))
+        self.assertTrue('events: Instructions Cycles\n' in text)
+        self.assertTrue('summary: 46 169\n' in text)
+        self.assertTrue('fn=(outside subroutines)\n0xc000 1 2\n' in text)
+        self.assertTrue('cfn=outer\ncalls=3 0xc100\n0xc002 36 135\n' in text)
+        self.assertTrue('fn=$c200\n0xc200 6 12\n0xc201 6 36\n' in text)
+
+    def test_65org16_counts_in_a_dict(self):
+        mpu = V65Org16()
+        # $FFFF0000 LDA #$1234
+        mpu.memory.write(0xFFFF0000, [0x00A9, 0x1234])
+        mpu.pc = 0xFFFF0000
+        mpu.profile = Profile()
+        mpu.step()
+        self.assertEqual(32, mpu.profile.addrWidth)
+        self.assertEqual([(0xFFFF0000, 1, 2)], mpu.profile.addresses())
+
+    def test_raises_for_addresses_wider_than_the_profile(self):
+        mpu = V65Org16()
+        mpu.profile = Profile(16)
+        self.assertRaises(ValueError, mpu.step)
+        self.assertEqual(0, mpu.profile.executed)
+
+    def test_counts_are_sized_for_the_mpu(self):
+        mpu = self._make_mpu()
+        self.assertEqual(None, mpu.profile.addrWidth)
+        mpu.step()
+        self.assertEqual(16, mpu.profile.addrWidth)
+        self.assertEqual(0x10000, len(mpu.profile.instructions))
+
+    # Test Helpers
+
+    def _make_mpu(self):
+        mpu = MPU(pc=0xC000)
+        # $C000 LDX #$03
+        # $C002 JSR $C100
+        # $C005 DEX
+        # $C006 BNE $C002
+        # $C008 BRK
+        mpu.memory[0xC000:0xC009] = [0xA2, 0x03, 0x20, 0x00, 0xC1, 0xCA,
+                                     0xD0, 0xFA, 0x00]
+        # $C100 LDY #$02
+        # $C102 JSR $C200
+        # $C105 DEY
+        # $C106 BNE $C102
+        # $C108 RTS
+        mpu.memory[0xC100:0xC109] = [0xA0, 0x02, 0x20, 0x00, 0xC2, 0x88,
+                                     0xD0, 0xFA, 0x60]
+        # $C200 NOP
+        # $C201 RTS
+        mpu.memory[0xC200:0xC202] = [0xEA, 0x60]
+        mpu.profile = Profile()
+        return mpu
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
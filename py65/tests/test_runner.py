@@ -0,0 +1,159 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from py65.devices.mpu65org16 import MPU as V65Org16
+from py65.runner import Machine, Worker, main, read_image, run_cases
+
+try:
+    from StringIO import StringIO
+except ImportError: # Python 3
+    from io import StringIO
+
+
+# $C000 CLC
+# $C001 ADC $10
+# $C003 STA $0200
+# $C006 RTS
+PROGRAM = [0x18, 0x65, 0x10, 0x8D, 0x00, 0x02, 0x60]
+
+
+class MachineTests(unittest.TestCase):
+
+    def test_build_loads_images_and_protects_roms(self):
+        machine = Machine(images=[(0xC000, PROGRAM)],
+                          roms=[(0xFFFC, [0x00, 0xC0])], max_instructions=1)
+        mpu = machine.build()
+        self.assertEqual(0xC000, mpu.pc)
+        self.assertEqual(PROGRAM, mpu.memory[0xC000:0xC007])
+        mpu.memory[0xFFFC] = 0xFF
+        self.assertEqual(0x00, mpu.memory[0xFFFC])
+
+    def test_build_65org16_covers_the_whole_address_space(self):
+        machine = Machine(V65Org16, images=[(0xFFFF0000, [0x1234])],
+                          max_instructions=1)
+        mpu = machine.build()
+        self.assertEqual(0x1234, mpu.memory[0xFFFF0000])
+
+    def test_raises_without_a_stop_condition(self):
+        self.assertRaises(ValueError, Machine)
+
+
+class WorkerTests(unittest.TestCase):
+
+    def test_run_applies_the_case_and_returns_the_result(self):
+        worker = Worker(self._make_machine())
+        result = worker.run({'a': 0x01, 'memory': {0x0010: [0x02]}})
+        self.assertEqual('stop_opcode', result['reason'])
+        self.assertEqual(0xC006, result['pc'])
+        self.assertEqual(0x03, result['a'])
+        self.assertEqual(9, result['cycles'])
+        self.assertEqual({0x0200: [0x03]}, result['memory'])
+
+    def test_run_starts_each_case_from_the_initial_state(self):
+        worker = Worker(self._make_machine())
+        worker.run({'a': 0x01, 'memory': {0x0010: [0x02]}})
+        result = worker.run({'a': 0x05})
+        self.assertEqual(0x05, result['a'])
+        self.assertEqual(9, result['cycles'])
+
+    def test_run_raises_for_unknown_fields(self):
+        worker = Worker(self._make_machine())
+        self.assertRaises(ValueError, worker.run, {'q': 1})
+
+    def _make_machine(self):
+        return Machine(images=[(0xC000, PROGRAM)], pc=0xC000,
+                       stop_opcodes=[0x60], dumps=[(0x0200, 0x0201)])
+
+
+class RunCasesTests(unittest.TestCase):
+
+    def test_results_are_in_the_order_of_the_cases(self):
+        machine = Machine(images=[(0xC000, PROGRAM)], pc=0xC000,
+                          stop_opcodes=[0x60])
+        cases = [{'a': n, 'memory': {0x0010: [n]}} for n in range(40)]
+        for processes in (1, 2):
+            results = run_cases(machine, iter(cases), processes, chunksize=3)
+            self.assertEqual([(n * 2) & 0xFF for n in range(40)],
+                             [result['a'] for result in results])
+
+
+class MainTests(unittest.TestCase):
+
+    def test_runs_cases_from_stdin_and_writes_results(self):
+        with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+            f.write(bytearray(PROGRAM))
+        try:
+            argv = ['py65run', '-j', '1', '--load', f.name + '@c000',
+                    '-g', 'c000', '-b', '60', '-d', '0200:0201']
+            stdin = StringIO('{"a": 1, "memory": {"0010": [2]}}\n\n'
+                             '{"a": 3}\n')
+            stdout = StringIO()
+            self.assertEqual(0, main(argv, stdin, stdout))
+        finally:
+            os.unlink(f.name)
+        results = [json.loads(line) for line in
+                   stdout.getvalue().splitlines()]
+        self.assertEqual([0x03, 0x03], [result['a'] for result in results])
+        self.assertEqual({'0200': [0x03, 0x00]}, results[0]['memory'])
+
+    def test_fails_without_a_stop_condition(self):
+        stdout = StringIO()
+        self.assertEqual(1, main(['py65run'], StringIO(''), stdout))
+        self.assertTrue(stdout.getvalue().startswith('Fatal:'))
+
+    def test_fails_for_an_unknown_mpu(self):
+        stdout = StringIO()
+        self.assertEqual(1, main(['py65run', '-m', 'z80'], StringIO(''),
+                                 stdout))
+        self.assertTrue('Available MPUs' in stdout.getvalue())
+
+    def test_fails_for_a_missing_cases_file(self):
+        stdout = StringIO()
+        argv = ['py65run', '-b', '60', '/nonexistent/cases.jsonl']
+        self.assertEqual(1, main(argv, StringIO(''), stdout))
+        self.assertTrue(stdout.getvalue().startswith(
+            'Fatal: cannot read cases: [2]'))
+
+    def test_fails_for_a_missing_image(self):
+        stdout = StringIO()
+        argv = ['py65run', '-b', '60', '--load', '/nonexistent/image.bin']
+        self.assertEqual(1, main(argv, StringIO(''), stdout))
+        self.assertTrue(stdout.getvalue().startswith(
+            'Fatal: cannot load file: [2]'))
+
+    def test_fails_for_a_bad_case_with_its_line_number(self):
+        for case in ('{"a": ', '{"memory": {"zz": [1]}}', '{"q": 1}'):
+            stdout = StringIO()
+            stdin = StringIO('{"a": 1}\n\n%s\n{"a": 2}\n' % case)
+            argv = ['py65run', '-j', '1', '-n', '1']
+            self.assertEqual(1, main(argv, stdin, stdout))
+            lines = stdout.getvalue().splitlines()
+            self.assertEqual(2, len(lines))
+            self.assertEqual(1, json.loads(lines[0])['a'])
+            self.assertTrue(lines[1].startswith('Fatal: bad case on line 3:'))
+
+    def test_fails_for_a_bad_case_run_on_a_pool(self):
+        stdout = StringIO()
+        stdin = StringIO('{"a": 1}\n{"q": 1}\n')
+        argv = ['py65run', '-j', '2', '-n', '1']
+        self.assertEqual(1, main(argv, stdin, stdout))
+        self.assertTrue(stdout.getvalue().splitlines()[-1].startswith(
+            "Fatal: bad case on line 2: unknown case field: 'q'"))
+
+    def test_read_image_reads_big_endian_words(self):
+        with tempfile.NamedTemporaryFile('wb', delete=False) as f:
+            f.write(bytearray([0x12, 0x34, 0x56, 0x78]))
+        try:
+            self.assertEqual([0x1234, 0x5678], read_image(f.name, 16))
+            self.assertEqual([0x12, 0x34, 0x56, 0x78], read_image(f.name))
+        finally:
+            os.unlink(f.name)
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,113 @@
+import sys
+import unittest
+from py65.devices.mpu6502 import MPU
+from py65.memory import PagedMemory
+from py65.scheduler import NEVER, Scheduler
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def test_events_are_called_at_the_first_boundary_after_their_cycle(self):
+        mpu = self._make_mpu()
+        scheduler = Scheduler(mpu)
+        calls = []
+        scheduler.schedule_at(5, lambda mpu, cycle:
+                              calls.append((cycle, mpu.processorCycles)))
+        mpu.run(max_instructions=4) # NOPs of 2 cycles
+        self.assertEqual([(5, 6)], calls)
+
+    def test_events_are_called_in_order(self):
+        mpu = self._make_mpu()
+        scheduler = Scheduler(mpu)
+        calls = []
+        for cycle, name in ((4, 'b'), (2, 'a'), (4, 'c')):
+            scheduler.schedule_at(cycle, lambda mpu, cycle, name=name:
+                                  calls.append(name))
+        mpu.run(max_instructions=4)
+        self.assertEqual(['a', 'b', 'c'], calls)
+
+    def test_deadline_is_the_cycle_of_the_earliest_event(self):
+        scheduler = Scheduler(self._make_mpu())
+        self.assertEqual(NEVER, scheduler.deadline)
+        later = scheduler.schedule(20, _ignore)
+        sooner = scheduler.schedule(10, _ignore)
+        self.assertEqual(10, scheduler.deadline)
+        scheduler.cancel(sooner)
+        self.assertEqual(20, scheduler.deadline)
+        self.assertEqual([(20, _ignore)], scheduler.events())
+        scheduler.cancel(later)
+        self.assertEqual(NEVER, scheduler.deadline)
+        self.assertEqual(0, len(scheduler))
+
+    def test_cancelled_event_is_not_called(self):
+        mpu = self._make_mpu()
+        scheduler = Scheduler(mpu)
+        calls = []
+        event = scheduler.schedule(2, lambda mpu, cycle: calls.append(cycle))
+        scheduler.schedule(4, _ignore)
+        scheduler.cancel(event)
+        mpu.run(max_instructions=4)
+        self.assertEqual([], calls)
+
+    def test_periodic_event_reschedules_itself(self):
+        mpu = self._make_mpu()
+        scheduler = Scheduler(mpu)
+        calls = []
+        def tick(mpu, cycle):
+            calls.append(cycle)
+            scheduler.schedule_at(cycle + 3, tick)
+        scheduler.schedule(3, tick)
+        mpu.run(max_cycles=12)
+        self.assertEqual([3, 6, 9], calls)
+
+    def test_step_calls_events(self):
+        mpu = self._make_mpu()
+        scheduler = Scheduler(mpu)
+        calls = []
+        scheduler.schedule(2, lambda mpu, cycle: calls.append(cycle))
+        mpu.step()
+        self.assertEqual([], calls)
+        mpu.step()
+        self.assertEqual([2], calls)
+
+    def test_event_can_raise_irq(self):
+        mpu = self._make_mpu()
+        mpu.memory[0xFFFE:0x10000] = [0x00, 0xC0]
+        mpu.memory[0xC000] = 0xEA # NOP
+        mpu.p &= ~MPU.INTERRUPT
+        scheduler = Scheduler(mpu)
+        scheduler.schedule(4, lambda mpu, cycle: mpu.irq())
+        mpu.run(max_instructions=3)
+        self.assertEqual(0xC001, mpu.pc)
+        self.assertEqual(0x0002, mpu.WordAt(0x01FE))
+
+    def test_devices_schedule_from_the_cycle_of_the_instruction(self):
+        memory = PagedMemory()
+        mpu = MPU(memory=memory)
+        # $0000 NOP
+        # $0001 STA $D000
+        memory.write(0x0000, [0xEA, 0x8D, 0x00, 0xD0])
+        scheduler = Scheduler(mpu)
+        def start_timer(address, value):
+            scheduler.schedule(10, _ignore)
+        memory.subscribe_to_write([0xD000], start_timer)
+        mpu.run(max_instructions=2)
+        self.assertEqual([(12, _ignore)], scheduler.events())
+
+    # Test Helpers
+
+    def _make_mpu(self):
+        mpu = MPU()
+        mpu.memory[0x0000:0x0010] = [0xEA] * 0x10 # NOP
+        return mpu
+
+
+def _ignore(mpu, cycle):
+    pass
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
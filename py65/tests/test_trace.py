@@ -0,0 +1,71 @@
+import sys
+import unittest
+from py65.devices.mpu6502 import MPU
+from py65.devices.mpu65org16 import MPU as V65Org16
+from py65.trace import TraceBuffer
+
+
+class TraceBufferTests(unittest.TestCase):
+
+    def test_append_keeps_the_last_records(self):
+        trace = TraceBuffer(3)
+        for n in range(5):
+            trace.append(n, 0xEA, 0, 0, 0, 0xFF, 0x30, n * 2)
+        self.assertEqual(5, trace.count)
+        self.assertEqual(3, len(trace))
+        self.assertEqual([2, 3, 4], [record[0] for record in trace.records()])
+
+    def test_records_before_buffer_is_full(self):
+        trace = TraceBuffer(3)
+        trace.append(0xC000, 0xEA, 0x01, 0x02, 0x03, 0xFF, 0x30, 7)
+        self.assertEqual([(0xC000, 0xEA, 0x01, 0x02, 0x03, 0xFF, 0x30, 7)],
+                         trace.records())
+
+    def test_clear(self):
+        trace = TraceBuffer(3)
+        trace.append(0xC000, 0xEA, 0x01, 0x02, 0x03, 0xFF, 0x30, 7)
+        trace.clear()
+        self.assertEqual([], trace.records())
+
+    def test_raises_for_empty_buffer(self):
+        self.assertRaises(ValueError, TraceBuffer, 0)
+
+    def test_decode_disassembles_records(self):
+        mpu = MPU()
+        # $C000 LDA #$01
+        # $C002 STA $0200
+        mpu.memory[0xC000:0xC005] = [0xA9, 0x01, 0x8D, 0x00, 0x02]
+        mpu.pc = 0xC000
+        mpu.trace = TraceBuffer()
+        mpu.run(max_instructions=2)
+        self.assertEqual(
+            ['$c000  LDA #$01          A=00 X=00 Y=00 SP=ff P=00110000  0',
+             '$c002  STA $0200         A=01 X=00 Y=00 SP=ff P=00110000  2'],
+            mpu.trace.decode(mpu))
+
+    def test_decode_marks_instructions_no_longer_in_memory(self):
+        mpu = MPU()
+        mpu.memory[0xC000:0xC002] = [0xA9, 0x01]
+        mpu.pc = 0xC000
+        mpu.trace = TraceBuffer()
+        mpu.step()
+        mpu.memory[0xC000] = 0xEA
+        self.assertTrue(mpu.trace.decode(mpu)[0].startswith('$c000  LDA ?'))
+
+    def test_65org16_records_16_bit_registers(self):
+        mpu = V65Org16()
+        # $FFFF0000 LDA #$1234
+        mpu.memory.write(0xFFFF0000, [0x00A9, 0x1234])
+        mpu.pc = 0xFFFF0000
+        mpu.trace = TraceBuffer()
+        mpu.step()
+        mpu.step()
+        pc, opcode, a = mpu.trace.records()[1][:3]
+        self.assertEqual((0xFFFF0002, 0x1234), (pc, a))
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
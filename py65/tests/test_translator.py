@@ -0,0 +1,236 @@
+import unittest
+import sys
+from py65.devices.mpu6502 import MPU
+from py65.memory import Bus, ObservableMemory, PagedMemory
+from py65.translator import BlockTranslator
+
+
+class BlockTranslatorTests(unittest.TestCase):
+
+    # translation
+
+    def test_straight_line_code_is_translated_into_one_block(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$01
+        # $0002 TAX
+        # $0003 INX
+        # $0004 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xA9, 0x01, 0xAA, 0xE8,
+                                         0x4C, 0x00, 0x00))
+        mpu.run(max_instructions=4)
+        block = mpu.translator.blocks[0x0000]
+        self.assertEqual((0x0000, 0x0002, 0x0003, 0x0004), block.addresses)
+        self.assertEqual(0x0007, block.end)
+        self.assertEqual(0x0000, mpu.pc)
+        self.assertEqual(0x02, mpu.x)
+        self.assertEqual(2 + 2 + 2 + 3, mpu.processorCycles)
+
+    def test_block_ends_at_branch(self):
+        mpu = self._make_mpu()
+        # $0000 DEX
+        # $0001 BNE $0000
+        # $0003 NOP
+        self._write(mpu.memory, 0x0000, (0xCA, 0xD0, 0xFD, 0xEA))
+        mpu.step()
+        self.assertEqual(0x0003, mpu.translator.blocks[0x0000].end)
+
+    def test_step_executes_one_instruction_of_a_block(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        # $0001 INX
+        self._write(mpu.memory, 0x0000, (0xE8, 0xE8))
+        mpu.step()
+        self.assertEqual(0x0001, mpu.pc)
+        self.assertEqual(0x01, mpu.x)
+        self.assertEqual(2, mpu.processorCycles)
+
+    def test_run_matches_untranslated_run(self):
+        # $0000 LDY #$00
+        # $0002 LDA ($10),Y
+        # $0004 STA $0300,Y
+        # $0007 INY
+        # $0008 BNE $0002
+        # $000A JMP $0000
+        program = (0xA0, 0x00, 0xB1, 0x10, 0x99, 0x00, 0x03, 0xC8,
+                   0xD0, 0xF8, 0x4C, 0x00, 0x00)
+        plain = self._make_mpu()
+        plain.translator = None
+        translated = self._make_mpu()
+        for mpu in (plain, translated):
+            self._write(mpu.memory, 0x0000, program)
+            self._write(mpu.memory, 0x0010, (0xF0, 0x02))
+            mpu.run(max_instructions=5000)
+        self.assertEqual(repr(plain), repr(translated))
+        self.assertEqual(plain.processorCycles, translated.processorCycles)
+        self.assertEqual(plain.memory, translated.memory)
+
+    # stop conditions
+
+    def test_run_stops_at_stop_pc_inside_a_block(self):
+        mpu = self._make_mpu()
+        # $0000 INX
+        # $0001 INX
+        # $0002 INX
+        # $0003 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xE8, 0xE8, 0xE8, 0x4C, 0x00, 0x00))
+        reason = mpu.run(stop_pcs=[0x0002])
+        self.assertEqual(mpu.RUN_STOP_PC, reason)
+        self.assertEqual(0x0002, mpu.pc)
+        self.assertEqual(0x02, mpu.x)
+
+    def test_run_stops_at_max_cycles_inside_a_block(self):
+        mpu = self._make_mpu()
+        self._write(mpu.memory, 0x0000, (0xE8, 0xE8, 0xE8, 0x4C, 0x00, 0x00))
+        reason = mpu.run(max_cycles=3)
+        self.assertEqual(mpu.RUN_MAX_CYCLES, reason)
+        self.assertEqual(0x0002, mpu.pc)
+        self.assertEqual(4, mpu.processorCycles)
+
+    # self-modifying code
+
+    def test_write_into_rest_of_block_takes_effect(self):
+        mpu = self._make_mpu()
+        # $0000 LDA #$42
+        # $0002 STA $0006
+        # $0005 LDX #$00
+        # $0007 JMP $0007
+        self._write(mpu.memory, 0x0000, (0xA9, 0x42, 0x8D, 0x06, 0x00,
+                                         0xA2, 0x00, 0x4C, 0x07, 0x00))
+        mpu.run(max_instructions=4)
+        self.assertEqual(0x42, mpu.x)
+        self.assertEqual(0x0007, mpu.pc)
+        self.assertEqual(2 + 4 + 2 + 3, mpu.processorCycles)
+
+    def test_changed_code_is_translated_again(self):
+        mpu = self._make_mpu()
+        # $0000 LDX #$01
+        # $0002 JMP $0000
+        self._write(mpu.memory, 0x0000, (0xA2, 0x01, 0x4C, 0x00, 0x00))
+        mpu.run(max_instructions=2)
+        self.assertEqual(0x01, mpu.x)
+        mpu.memory[0x0001] = 0x02
+        mpu.run(max_instructions=2)
+        self.assertEqual(0x02, mpu.x)
+
+    def test_opcode_written_by_the_mpu_is_translated_again(self):
+        mpu = self._make_mpu(PagedMemory())
+        # $0000 LDA #$E8 (INX)
+        # $0002 INY
+        # $0003 STA $0002
+        # $0006 JMP $0002
+        mpu.memory.write(0x0000, [0xA9, 0xE8, 0xC8, 0x8D, 0x02, 0x00,
+                                  0x4C, 0x02, 0x00])
+        mpu.run(max_instructions=5)
+        self.assertEqual((0x01, 0x01), (mpu.x, mpu.y))
+        self.assertEqual([], mpu.dirty_pages.dirty())
+        self.assertEqual(0xE8, mpu.translator.blocks[0x0002].opcodes[0])
+
+    def test_blocks_are_checked_only_after_writes_to_their_pages(self):
+        mpu = self._make_mpu(PagedMemory())
+        # $0000 INX
+        # $0001 STA $0200
+        # $0004 JMP $0000
+        mpu.memory.write(0x0000, [0xE8, 0x8D, 0x00, 0x02, 0x4C, 0x00, 0x00])
+        mpu.step()
+        block = mpu.translator.blocks[0x0000]
+        mpu.run(max_instructions=30)
+        self.assertTrue(mpu.translator.blocks[0x0000] is block)
+        self.assertEqual([0x02], mpu.dirty_pages.dirty())
+
+    def test_code_is_read_without_read_callbacks(self):
+        memory = ObservableMemory()
+        mpu = self._make_mpu(memory)
+        # $0000 INX
+        # $0001 JMP $0000
+        memory.write(0x0000, [0xE8, 0x4C, 0x00, 0x00])
+        reads = []
+        memory.subscribe_to_read([0x0000], reads.append)
+        mpu.run(max_instructions=10)
+        self.assertEqual(5, mpu.x)
+        self.assertEqual([], reads)
+
+    def test_code_of_a_device_is_executed_untranslated(self):
+        class NOPs:
+            def read(self, offset):
+                return 0xEA
+            def write(self, offset, value):
+                pass
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        bus.map_device(range(0xD000, 0xD100), NOPs())
+        mpu = self._make_mpu(bus)
+        mpu.pc = 0xD000
+        mpu.run(max_instructions=3)
+        self.assertEqual(0xD003, mpu.pc)
+        self.assertEqual(6, mpu.processorCycles)
+        self.assertEqual({}, mpu.translator.blocks)
+
+    def test_bank_switched_code_is_translated_again(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        # $8000 LDA #$11 in bank 0, LDX #$22 in bank 1
+        banks = bus.map_banks(range(0x8000, 0xC000), 2,
+                              [[0xA9, 0x11], [0xA2, 0x22]])
+        mpu = self._make_mpu(bus)
+        mpu.pc = 0x8000
+        mpu.step()
+        banks.select(1)
+        mpu.a = 0x00
+        mpu.pc = 0x8000
+        mpu.step()
+        self.assertEqual((0x00, 0x22), (mpu.a, mpu.x))
+
+    def test_remapped_code_is_translated_again(self):
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000), [0xE8]) # INX
+        mpu = self._make_mpu(bus)
+        mpu.step()
+        bus.map_ram(range(0x0000, 0x8000), [0xC8]) # INY
+        mpu.pc = 0x0000
+        mpu.step()
+        self.assertEqual((0x01, 0x01), (mpu.x, mpu.y))
+
+    def test_removing_hooks_restores_the_shared_instructions(self):
+        mpu = self._make_mpu()
+        self._write(mpu.memory, 0x0000, (0xEA, 0xEA, 0x00))
+        mpu.add_hook([0xEA], lambda mpu, address, opcode: None)
+        mpu.run(max_instructions=2)
+        mpu.remove_hooks()
+        other = self._make_mpu()
+        other.run(max_instructions=2)
+        self.assertTrue(mpu._instruct is other._instruct)
+
+    def test_restore_discards_blocks(self):
+        mpu = self._make_mpu()
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        snapshot = mpu.snapshot()
+        mpu.step()
+        mpu.restore(snapshot)
+        self.assertEqual({}, mpu.translator.blocks)
+
+    def test_invalidate_discards_overlapping_blocks(self):
+        mpu = self._make_mpu()
+        self._write(mpu.memory, 0x0000, (0xE8, 0x4C, 0x00, 0x00))
+        mpu.step()
+        translator = mpu.translator
+        translator.invalidate(0x0004, 0x0010)
+        self.assertTrue(0x0000 in translator.blocks)
+        translator.invalidate(0x0003)
+        self.assertFalse(0x0000 in translator.blocks)
+
+    # Test Helpers
+
+    def _write(self, memory, start_address, bytes):
+        memory[start_address:start_address + len(bytes)] = bytes
+
+    def _make_mpu(self, memory=None):
+        mpu = MPU(memory=memory)
+        mpu.translator = BlockTranslator()
+        return mpu
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
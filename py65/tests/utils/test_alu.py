@@ -0,0 +1,75 @@
+import sys
+import unittest
+from py65.utils import alu
+
+
+class NZTableTests(unittest.TestCase):
+
+    def test_8_bit_table_has_flags_for_every_byte(self):
+        table = alu.nz_table(8)
+        self.assertEqual(257, len(table))
+        self.assertEqual(alu.ZERO, table[0x00])
+        self.assertEqual(0, table[0x7F])
+        self.assertEqual(alu.NEGATIVE, table[0x80])
+        self.assertEqual(alu.NEGATIVE | alu.ZERO, table[0x100])
+
+    def test_16_bit_table_uses_bit_15_as_negative(self):
+        table = alu.nz_table(16)
+        self.assertEqual(0x10001, len(table))
+        self.assertEqual(alu.ZERO, table[0x0000])
+        self.assertEqual(0, table[0x0080])
+        self.assertEqual(0x8000, table[0x8000])
+
+    def test_tables_are_shared(self):
+        self.assertTrue(alu.nz_table(8) is alu.nz_table(8))
+
+    def test_values_give_the_flags_they_are_indexed_by(self):
+        for width in (8, 16):
+            table = alu.nz_table(width)
+            values = alu.nz_values(width)
+            mask = (1 << (width - 1)) | alu.ZERO
+            for flags in (0, alu.ZERO, mask ^ alu.ZERO, mask, mask | 1):
+                self.assertEqual(flags & mask, table[values[flags]])
+
+
+class ALUTablesTests(unittest.TestCase):
+
+    def test_tables_are_built_on_first_access(self):
+        tables = alu.ALUTables()
+        self.assertFalse('cmp' in tables.__dict__)
+        table = tables.cmp
+        self.assertTrue(tables.__dict__['cmp'] is table)
+
+    def test_unknown_table_raises_attribute_error(self):
+        tables = alu.ALUTables()
+        self.assertRaises(AttributeError, getattr, tables, 'foo')
+
+    def test_adc_binary_entry_has_result_and_flags(self):
+        # $7F + $01 + carry = $81, overflow and negative
+        entry = alu.tables.adc_binary[(1 << 16) | (0x7F << 8) | 0x01]
+        self.assertEqual(0x81, entry & 0xFF)
+        self.assertEqual(alu.OVERFLOW | alu.NEGATIVE, entry >> 8)
+
+    def test_adc_decimal_entry_has_result_and_flags(self):
+        # $99 + $01 = $00 with carry in decimal mode
+        entry = alu.tables.adc_decimal[(0x99 << 8) | 0x01]
+        self.assertEqual(0x00, entry & 0xFF)
+        self.assertEqual(alu.CARRY, (entry >> 8) & alu.CARRY)
+
+    def test_sbc_decimal_entry_has_result_and_flags(self):
+        # $10 - $01 with carry set (no borrow) = $09
+        entry = alu.tables.sbc_decimal[(1 << 16) | (0x10 << 8) | 0x01]
+        self.assertEqual(0x09, entry & 0xFF)
+        self.assertEqual(alu.CARRY, (entry >> 8) & alu.CARRY)
+
+    def test_cmp_entry_has_flags(self):
+        self.assertEqual(alu.CARRY | alu.ZERO, alu.tables.cmp[0x4242])
+        self.assertEqual(alu.CARRY, alu.tables.cmp[0x4241])
+        self.assertEqual(alu.NEGATIVE, alu.tables.cmp[0x4243])
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,214 @@
+import random
+import sys
+import unittest
+import py65.devices.mpu6502
+import py65.devices.mpu65c02
+import py65.devices.mpu65org16
+import py65.memory
+from py65.utils import codegen
+
+
+class Memory(dict):
+    """Sparse memory whose unwritten addresses read as a fixed pattern"""
+
+    def __init__(self, seed, byteMask):
+        dict.__init__(self)
+        self.seed = seed
+        self.byteMask = byteMask
+
+    def __missing__(self, address):
+        value = (address + self.seed) * 2654435761
+        return (value ^ (value >> 13)) & self.byteMask
+
+
+class Pages:
+    """Page tables over a Memory, like those of py65.memory.PagedMemory"""
+
+    def __init__(self, memory, page_bits, addrMask):
+        self.memory = memory
+        self.page_bits = page_bits
+        self.addrMask = addrMask
+
+    def __getitem__(self, page):
+        return Page(self.memory, (page << self.page_bits) & self.addrMask)
+
+
+class Page:
+
+    def __init__(self, memory, base):
+        self.memory = memory
+        self.base = base
+
+    def __getitem__(self, offset):
+        return self.memory[self.base + offset]
+
+    def __setitem__(self, offset, value):
+        self.memory[self.base + offset] = value
+
+
+class FusedHandlerTests(unittest.TestCase):
+
+    def test_6502_handlers_are_fused(self):
+        klass = py65.devices.mpu6502.MPU
+        self.assertTrue(hasattr(klass.instruct[0x01], 'fused'))
+        self.assertFalse(hasattr(klass.inst_0x01, 'fused'))
+
+    def test_65c02_keeps_handlers_that_override_6502_behavior(self):
+        klass = py65.devices.mpu65c02.MPU
+        self.assertTrue(klass.instruct[0x00] is klass.inst_0x00)
+        self.assertTrue(klass.instruct[0x6c] is klass.inst_0x6c)
+        self.assertTrue(hasattr(klass.instruct[0x12], 'fused'))
+
+    def test_65org16_handlers_use_its_own_constants(self):
+        klass = py65.devices.mpu65org16.MPU
+        self.assertTrue(hasattr(klass.instruct[0x10], 'fused'))
+        self.assertFalse(
+            klass.instruct[0x10] is py65.devices.mpu6502.MPU.instruct[0x10])
+
+    def test_subclass_overriding_an_operation_keeps_decorated_handlers(self):
+        class MPU(py65.devices.mpu6502.MPU):
+            def opORA(self, x):
+                self.a = 0x42
+        self.assertTrue(MPU.instruct[0x09] is MPU.inst_0x09)
+        mpu = MPU()
+        mpu.memory[0:2] = [0x09, 0x00]
+        mpu.step()
+        self.assertEqual(0x42, mpu.a)
+
+    def test_6502_fused_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu6502.MPU)
+
+    def test_65c02_fused_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65c02.MPU)
+
+    def test_65org16_fused_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65org16.MPU)
+
+    def test_6502_lazy_flags_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu6502.MPU, True)
+
+    def test_65c02_lazy_flags_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65c02.MPU, True)
+
+    def test_65org16_lazy_flags_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65org16.MPU, True)
+
+    def test_6502_inexact_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu6502.MPU,
+                                           cycle_exact=False)
+
+    def test_65c02_inexact_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65c02.MPU,
+                                           cycle_exact=False)
+
+    def test_6502_paged_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu6502.MPU,
+                                           page_bits=8)
+
+    def test_65c02_paged_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65c02.MPU,
+                                           page_bits=8)
+
+    def test_65org16_paged_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65org16.MPU,
+                                           page_bits=16)
+
+    def test_6502_dirty_tracking_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu6502.MPU,
+                                           dirty_bits=8)
+
+    def test_65org16_dirty_tracking_handlers_match_decorated_methods(self):
+        self._assert_fused_match_decorated(py65.devices.mpu65org16.MPU,
+                                           dirty_bits=16)
+
+    def test_dirty_tracking_handlers_mark_each_write(self):
+        klass = py65.devices.mpu65c02.MPU
+        instruct = codegen.variant_instructions(klass, page_bits=8,
+                                                dirty_bits=8)
+        for handler in instruct:
+            if hasattr(handler, 'fused'):
+                source = handler.source
+                self.assertEqual(source.count('wp['), source.count('dirty['),
+                                 source)
+
+    def test_paged_handlers_index_the_page_tables(self):
+        klass = py65.devices.mpu6502.MPU
+        handler = codegen.variant_instructions(klass, page_bits=8)[0xEE]
+        self.assertFalse('memory' in handler.source)
+        self.assertTrue('wp[addr >> 8][addr & 255]' in handler.source)
+
+    def test_inexact_branch_does_not_count_cycles(self):
+        klass = py65.devices.mpu6502.MPU
+        handler = codegen.variant_instructions(klass, cycle_exact=False)[0xD0]
+        self.assertFalse('excycles' in handler.source)
+
+    # Test Helpers
+
+    def _assert_fused_match_decorated(self, klass, lazy_flags=False,
+                                      cycle_exact=True, page_bits=None,
+                                      dirty_bits=None, trials=40):
+        rand = random.Random(6502)
+        instruct = codegen.variant_instructions(klass, lazy_flags,
+                                                cycle_exact, page_bits,
+                                                dirty_bits)
+        for opcode, handler in enumerate(instruct):
+            if not hasattr(handler, 'fused'):
+                continue
+            decorated = getattr(klass, handler.__name__)
+            for trial in range(trials):
+                seed = rand.randint(0, 1 << 30)
+                fused_mpu = self._make_mpu(klass, seed, page_bits)
+                fused_mpu.lazy_flags = lazy_flags
+                if dirty_bits is not None:
+                    fused_mpu.dirty_pages = py65.memory.DirtyPages(
+                        klass.ADDR_WIDTH, dirty_bits)
+                decorated_mpu = self._make_mpu(klass, seed)
+                self._execute(fused_mpu, opcode, handler)
+                self._execute(decorated_mpu, opcode, decorated)
+                msg = "%s $%02x %r" % (klass.__module__, opcode,
+                                       handler.fused)
+                if not cycle_exact:
+                    fused_mpu.excycles = decorated_mpu.excycles
+                self.assertEqual(self._state(decorated_mpu),
+                                 self._state(fused_mpu), msg)
+                if dirty_bits is not None:
+                    self.assertEqual(
+                        sorted(set(address >> dirty_bits
+                                   for address in fused_mpu.memory)),
+                        fused_mpu.dirty_pages.dirty(), msg)
+
+    def _make_mpu(self, klass, seed, page_bits=None):
+        rand = random.Random(seed)
+        byteMask = (1 << klass.BYTE_WIDTH) - 1
+        memory = Memory(seed, byteMask)
+        if page_bits is not None:
+            addrMask = (1 << klass.ADDR_WIDTH) - 1
+            memory.page_bits = page_bits
+            memory.read_pages = memory.write_pages = Pages(memory, page_bits,
+                                                           addrMask)
+        mpu = klass(memory=memory)
+        mpu.pc = rand.randint(0, mpu.addrMask - 4)
+        mpu.a = rand.randint(0, mpu.byteMask)
+        mpu.x = rand.randint(0, mpu.byteMask)
+        mpu.y = rand.randint(0, mpu.byteMask)
+        mpu.sp = rand.randint(0, mpu.byteMask)
+        mpu.p = rand.randint(0, mpu.byteMask) | mpu.BREAK | mpu.UNUSED
+        return mpu
+
+    def _execute(self, mpu, opcode, handler):
+        mpu.pc = (mpu.pc + 1) & mpu.addrMask
+        mpu.excycles = 0
+        mpu.addcycles = mpu.extracycles[opcode]
+        handler(mpu)
+        mpu.pc &= mpu.addrMask
+
+    def _state(self, mpu):
+        return (mpu.pc, mpu.a, mpu.x, mpu.y, mpu.sp, mpu.p, mpu.excycles,
+                sorted(mpu.memory.items()))
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,94 @@
+import pickle
+import sys
+import unittest
+from py65.devices.mpu6502 import MPU
+from py65.memory import Bus, PagedMemory
+from py65.utils.serialization import dumps, loads
+
+
+class Terminal:
+    """Device that cannot be pickled"""
+
+    def __init__(self):
+        self.output = []
+        self.stream = open(__file__)
+        self.stream.close()
+
+    def putc(self, address, value):
+        self.output.append(value)
+
+    def read(self, offset):
+        return 0x41
+
+    def write(self, offset, value):
+        self.output.append(value)
+
+
+class SerializationTests(unittest.TestCase):
+
+    def test_devices_are_reattached_by_name(self):
+        terminal = Terminal()
+        mem = PagedMemory()
+        mem.subscribe_to_write([0xF001], terminal.putc)
+        mem.subscribe_to_read([0xF004], _return_0x41)
+        mpu = MPU(memory=mem)
+        # $0000 LDA $F004
+        # $0003 STA $F001
+        mem.write(0x0000, [0xAD, 0x04, 0xF0, 0x8D, 0x01, 0xF0])
+
+        data = dumps(mpu, {'terminal': terminal})
+        other = Terminal()
+        copy = loads(data, {'terminal': other})
+        copy.run(max_instructions=2)
+        self.assertEqual([0x41], other.output)
+        self.assertEqual([], terminal.output)
+
+    def test_mpu_on_a_banked_bus_with_a_named_device(self):
+        terminal = Terminal()
+        bus = Bus()
+        bus.map_ram(range(0x0000, 0x8000))
+        banks = bus.map_banks(range(0x8000, 0xC000), 2, [[0x01], [0x02]])
+        bus.map_device(range(0xDF00, 0xE000), banks)
+        bus.map_device(range(0xD000, 0xD100), terminal)
+        # $F000 LDA $D000
+        # $F003 STA $D001
+        # $F006 INC $DF00
+        # $F009 LDA $8000
+        bus.map_rom(range(0xF000, 0x10000), [0xAD, 0x00, 0xD0, 0x8D, 0x01,
+                                             0xD0, 0xEE, 0x00, 0xDF, 0xAD,
+                                             0x00, 0x80])
+        mpu = MPU(memory=bus, pc=0xF000)
+        mpu.step()
+
+        data = dumps(mpu, {'terminal': terminal})
+        other = Terminal()
+        copy = loads(data, {'terminal': other})
+        self.assertEqual(0x41, copy.a)
+        copy.run(max_instructions=3)
+        self.assertEqual([0x41], other.output)
+        self.assertEqual(0x02, copy.a)
+        self.assertEqual(1, copy.memory._banks[0].selected)
+        self.assertEqual([], terminal.output)
+        self.assertEqual(0, banks.selected)
+
+    def test_device_objects_are_reattached_by_name(self):
+        terminal = Terminal()
+        data = dumps([terminal, terminal], {'terminal': terminal})
+        other = Terminal()
+        self.assertEqual([other, other], loads(data, {'terminal': other}))
+
+    def test_loads_raises_for_unknown_device(self):
+        terminal = Terminal()
+        data = dumps(terminal.putc, {'terminal': terminal})
+        self.assertRaises(pickle.UnpicklingError, loads, data)
+
+
+def _return_0x41(address):
+    return 0x41
+
+
+def test_suite():
+    return unittest.findTestCases(sys.modules[__name__])
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,84 @@
+"""Binary trace of the last instructions executed by an MPU.
+
+Assigning a TraceBuffer to mpu.trace makes step() and run() append a
+fixed-size record of each instruction to it before executing it: the
+PC, the opcode, the registers and the cycle count.  The records are
+packed into a bytearray allocated once, which the oldest records are
+overwritten in when it is full, so a program can be traced for hours
+and the last instructions looked at when it goes wrong:
+
+  mpu.trace = TraceBuffer(10000)
+  mpu.run(max_cycles=10 ** 9)
+  print('\\n'.join(mpu.trace.decode(mpu)))
+
+With mpu.trace set to None, the default, nothing is recorded and only
+step() pays for a check that it is None.  Like the translator,
+instructions are not traced while mpu.cycle_exact is false.
+"""
+
+import struct
+
+from py65.disassembler import Disassembler
+from py65.utils.conversions import itoa
+
+
+class TraceBuffer:
+    """Ring buffer of the last size instructions executed"""
+
+    # pc, opcode, a, x, y, sp, p and processorCycles before the
+    # instruction, wide enough for the 65Org16
+    RECORD = struct.Struct('<IHHHHHHQ')
+
+    def __init__(self, size=4096):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.buffer = bytearray(self.RECORD.size * size)
+        self.count = 0 # records appended, including those overwritten
+        self._pack_into = self.RECORD.pack_into
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, pc, opcode, a, x, y, sp, p, cycles):
+        """Append the record of an instruction, overwriting the oldest
+        record if the buffer is full"""
+        count = self.count
+        self._pack_into(self.buffer, (count % self.size) * self.RECORD.size,
+                        pc, opcode, a, x, y, sp, p, cycles)
+        self.count = count + 1
+
+    def clear(self):
+        self.count = 0
+
+    def records(self):
+        """The records in the buffer as (pc, opcode, a, x, y, sp, p,
+        cycles) tuples, oldest first"""
+        records = list(self.RECORD.iter_unpack(self.buffer))
+        if self.count <= self.size:
+            return records[:self.count]
+        first = self.count % self.size
+        return records[first:] + records[:first]
+
+    def decode(self, mpu, address_parser=None):
+        """The records as lines of text, oldest first, each with the
+        instruction disassembled and the registers before it.  The
+        operands are those in the memory of mpu now; an instruction
+        whose opcode is no longer at its address shows only its
+        mnemonic, followed by '?'."""
+        disassembler = Disassembler(mpu, address_parser)
+        addrFmt = mpu.ADDR_FORMAT
+        byteFmt = mpu.BYTE_FORMAT
+        registers = ('A=%s X=%s Y=%s SP=%s' %
+                     (byteFmt, byteFmt, byteFmt, byteFmt))
+        lines = []
+        for pc, opcode, a, x, y, sp, p, cycles in self.records():
+            if mpu.ByteAt(pc) == opcode:
+                length, disasm = disassembler.instruction_at(pc)
+            else:
+                disasm = mpu.disassemble[opcode][0] + ' ?'
+            flags = itoa(p, 2).rjust(mpu.BYTE_WIDTH, '0')
+            lines.append('$%s  %-16s  %s P=%s  %d' % (
+                addrFmt % pc, disasm, registers % (a, x, y, sp), flags,
+                cycles))
+        return lines
@@ -0,0 +1,343 @@
+"""Basic block translation for the MPU classes.
+
+A straight-line run of instructions ending at a branch, jump, call,
+return, or interrupt is decoded once into a Python function that calls
+each instruction handler in turn.  The function is cached by its start
+address and reused until the code it was translated from changes.
+
+Enable it on an MPU instance with:
+
+    mpu.translator = BlockTranslator()
+
+Changes to the code are found through the mpu.dirty_pages of the MPU,
+which the translator attaches a DirtyPages to if it has none: a block is
+only checked again, against its code read from the storage of the
+memory rather than through its callbacks, after a page it is on has
+been written to, or remapped on a Bus (e.g. by Banks.select()), and the
+translator then marks the page clean.  Writes
+that memory does not mark, such as those made to a plain list outside
+of the MPU, need invalidate(); MPU.restore() calls it.  Code of a device
+of py65.memory.Bus is not translated.
+"""
+
+from py65.memory import Bus, DirtyPages, ObservableMemory, PagedMemory
+
+# bytes following the opcode for each addressing mode
+OPERAND_LENGTHS = {
+    'acc': 0, 'imp': 0,
+    'imm': 1, 'zpg': 1, 'zpx': 1, 'zpy': 1, 'inx': 1, 'iny': 1, 'zpi': 1,
+    'rel': 1,
+    'abs': 2, 'abx': 2, 'aby': 2, 'ind': 2, 'iax': 2,
+    }
+
+# instructions that change the flow of control end a block
+TERMINATORS = frozenset([
+    'BCC', 'BCS', 'BEQ', 'BMI', 'BNE', 'BPL', 'BVC', 'BVS', 'BRA',
+    'JMP', 'JSR', 'RTS', 'RTI', 'BRK', 'WAI', '???',
+    ])
+
+# instructions known not to write memory; anything else may modify the
+# block that is executing it, so the block is left if a page it is on has
+# been written to
+NON_WRITING = frozenset([
+    'LDA', 'LDX', 'LDY', 'ADC', 'SBC', 'AND', 'ORA', 'EOR', 'CMP', 'CPX',
+    'CPY', 'BIT', 'TAX', 'TAY', 'TXA', 'TYA', 'TSX', 'TXS', 'INX', 'INY',
+    'DEX', 'DEY', 'CLC', 'CLD', 'CLI', 'CLV', 'SEC', 'SED', 'SEI', 'NOP',
+    'PLA', 'PLP', 'PLX', 'PLY',
+    ])
+
+
+class Block:
+    """A translated run of instructions"""
+
+    def __init__(self, start, end, code, addresses, opcodes, maxcycles,
+                 first_page, last_page, function):
+        self.start = start
+        self.end = end
+        self.code = code            # values at start to end when translated
+        self.addresses = addresses  # start address of each instruction
+        self.opcodes = opcodes
+        self.maxcycles = maxcycles  # including all possible extra cycles
+        self.first_page = first_page  # dirty pages of start and end - 1
+        self.last_page = last_page
+        self.function = function    # function(mpu, limit) -> executed
+
+
+class BlockTranslator:
+    max_block_length = 64
+
+    def __init__(self):
+        self.blocks = {}
+        self._instruct = None
+        self._memory = None
+        self._dirty_pages = None
+        self._read = None # see _storage_reader()
+        self._page_blocks = {} # dirty page: start of each block on it
+
+    def invalidate(self, start=None, end=None):
+        """Discard translated blocks overlapping [start, end), or all of
+        them when no range is given."""
+        if start is None:
+            self.blocks.clear()
+            self._page_blocks.clear()
+            return
+        if end is None:
+            end = start + 1
+        for address, block in list(self.blocks.items()):
+            if block.start < end and start < block.end:
+                self._discard(block)
+
+    def _discard(self, block):
+        del self.blocks[block.start]
+        for page in (block.first_page, block.last_page):
+            self._page_blocks[page].discard(block.start)
+
+    def _attach(self, mpu):
+        # translate for the handlers, the memory and the dirty pages of
+        # mpu, discarding the blocks translated for others
+        if mpu.dirty_pages is None:
+            mpu.dirty_pages = DirtyPages(mpu.ADDR_WIDTH)
+        if (mpu._instruct is not self._instruct or
+                mpu.memory is not self._memory or
+                mpu.dirty_pages is not self._dirty_pages):
+            self.invalidate()
+            self._instruct = mpu._instruct
+            self._memory = mpu.memory
+            self._dirty_pages = mpu.dirty_pages
+            self._read = _storage_reader(mpu.memory, mpu.addrMask)
+
+    def _clean(self, first_page, last_page):
+        # discard the blocks on the pages whose code has changed, then
+        # mark the pages clean
+        read = self._read
+        bitmap = self._dirty_pages.bitmap
+        for page in (first_page, last_page):
+            for start in list(self._page_blocks.get(page, ())):
+                block = self.blocks[start]
+                if [read(address) for address
+                        in range(block.start, block.end)] != block.code:
+                    self._discard(block)
+        bitmap[first_page] = bitmap[last_page] = 0
+
+    def step(self, mpu):
+        self.run(mpu, max_instructions=1)
+        return mpu
+
+    def run(self, mpu, max_cycles=None, max_instructions=None,
+            stop_pcs=None, stop_opcodes=None):
+        """Same as MPU.run() but executes translated blocks"""
+        if max_cycles is None:
+            cycles_limit = None
+        else:
+            cycles_limit = mpu.processorCycles + max_cycles
+        if max_instructions is None:
+            max_instructions = -1
+        stop_pcs = frozenset(stop_pcs or ())
+        stop_opcodes = frozenset(stop_opcodes or ())
+
+        self._attach(mpu)
+        blocks = self.blocks
+        dirty = self._dirty_pages.bitmap
+        count = 0
+
+        while True:
+            if count == max_instructions:
+                return mpu.RUN_MAX_INSTRUCTIONS
+            if cycles_limit is not None and \
+                    mpu.processorCycles >= cycles_limit:
+                return mpu.RUN_MAX_CYCLES
+
+            if mpu.interrupt_pending:
+                mpu.interrupts.service(mpu)
+                if mpu._instruct is not self._instruct:
+                    # hooks were added or removed
+                    self._attach(mpu)
+            if mpu.waiting:
+                mpu.processorCycles += 1
+                count += 1
+                continue
+
+            pc = mpu.pc
+            block = blocks.get(pc)
+            if block is not None and (dirty[block.first_page] or
+                                      dirty[block.last_page]):
+                self._clean(block.first_page, block.last_page)
+                block = blocks.get(pc)
+            if block is None:
+                block = self._translate(mpu, pc)
+                if block is None:
+                    # the code of a device, executed as by MPU.step()
+                    self._execute(mpu)
+                    count += 1
+                    block = _UNTRANSLATED
+                else:
+                    self._clean(block.first_page, block.last_page)
+                    blocks[pc] = block
+                    for page in (block.first_page, block.last_page):
+                        self._page_blocks.setdefault(page, set()).add(pc)
+
+            if block is not _UNTRANSLATED:
+                limit = len(block.opcodes)
+                if max_instructions != -1:
+                    limit = min(limit, max_instructions - count)
+                if cycles_limit is not None and \
+                        mpu.processorCycles + block.maxcycles >= cycles_limit:
+                    limit = 1
+                if limit > 1 and (stop_pcs or stop_opcodes):
+                    for i in range(1, limit):
+                        if block.addresses[i] in stop_pcs or \
+                                block.opcodes[i] in stop_opcodes:
+                            limit = i
+                            break
+
+                count += block.function(mpu, limit)
+
+            pc = mpu.pc
+            if stop_opcodes and mpu.memory[pc] in stop_opcodes:
+                return mpu.RUN_STOP_OPCODE
+            if pc in stop_pcs:
+                return mpu.RUN_STOP_PC
+
+    def _execute(self, mpu):
+        # execute one instruction without translating it
+        instructCode = mpu.memory[mpu.pc]
+        mpu.pc = (mpu.pc + 1) & mpu.addrMask
+        mpu.excycles = 0
+        mpu.addcycles = mpu.extracycles[instructCode]
+        mpu._instruct[instructCode](mpu)
+        mpu.pc &= mpu.addrMask
+        mpu.processorCycles += mpu.cycletime[instructCode] + mpu.excycles
+
+    def _translate(self, mpu, start):
+        # the Block of the code at start, or None if it is not in storage
+        # that _storage_reader() reads
+        read = self._read
+        instruct = mpu._instruct
+        disassemble = mpu.disassemble
+        cycletime = mpu.cycletime
+        extracycles = mpu.extracycles
+        addrMask = mpu.addrMask
+        page_bits = self._dirty_pages.page_bits
+
+        # decode
+        addresses = []
+        opcodes = []
+        code = []
+        address = start
+        while True:
+            opcode = read(address)
+            if opcode is None:
+                break
+            name, mode = disassemble[opcode]
+            length = 1 + OPERAND_LENGTHS.get(mode, 0)
+            values = [read(address + i) for i in range(length)]
+            if None in values:
+                break
+            addresses.append(address)
+            opcodes.append(opcode)
+            code.extend(values)
+            address += length
+            if (name in TERMINATORS or address > addrMask or
+                    len(opcodes) == self.max_block_length):
+                break
+        if not opcodes:
+            return None
+        end = address
+        first_page = start >> page_bits
+        last_page = ((end - 1) & addrMask) >> page_bits
+
+        # generate
+        namespace = {'dirty': self._dirty_pages.bitmap}
+        lines = ['def block(mpu, limit):']
+        lines.append('    exc = 0')
+        if first_page == last_page:
+            written = '    if dirty[%d]:' % first_page
+        else:
+            written = '    if dirty[%d] or dirty[%d]:' % (first_page,
+                                                          last_page)
+
+        cycles = 0
+        maxcycles = 0
+        addcycles = None
+        excycles_stale = True
+        last = len(opcodes) - 1
+        for i, (address, opcode) in enumerate(zip(addresses, opcodes)):
+            name = disassemble[opcode][0]
+            extra = extracycles[opcode]
+            # the final instruction may do anything with the cycle counts
+            tracked = extra or i == last
+            namespace['h%d' % i] = instruct[opcode]
+
+            lines.append('    mpu.pc = %d' % ((address + 1) & addrMask))
+            if tracked or excycles_stale:
+                lines.append('    mpu.excycles = 0')
+                excycles_stale = False
+            if extra != addcycles:
+                lines.append('    mpu.addcycles = %r' % extra)
+                addcycles = extra
+            lines.append('    h%d(mpu)' % i)
+            if tracked:
+                lines.append('    exc += mpu.excycles')
+                excycles_stale = True
+            cycles += cycletime[opcode]
+            maxcycles += cycletime[opcode] + extra
+
+            exit = ['        mpu.processorCycles += %d + exc' % cycles,
+                    '        return %d' % (i + 1)]
+            if i == last:
+                lines.append('    mpu.pc &= %d' % addrMask)
+                lines.extend(line[4:] for line in exit)
+                break
+
+            lines.append('    if limit == %d:' % (i + 1))
+            lines.extend(exit)
+
+            if name not in NON_WRITING:
+                # the instruction may have rewritten the rest of the block,
+                # which is checked again from the next instruction on
+                lines.append(written)
+                lines.extend(exit)
+
+        exec('\n'.join(lines), namespace)
+        return Block(start, end, code, tuple(addresses), tuple(opcodes),
+                     maxcycles, first_page, last_page, namespace['block'])
+
+
+# the block of an instruction executed without translation
+_UNTRANSLATED = object()
+
+
+def _storage_reader(memory, addrMask):
+    """A function reading the value at an address of memory from the
+    storage of its values, without calling the callbacks subscribed to
+    ObservableMemory and PagedMemory, or returning None at an address of
+    a device of Bus"""
+    if isinstance(memory, ObservableMemory):
+        subject_read = _storage_reader(memory._subject, memory.physMask)
+        return lambda address: subject_read(address & addrMask)
+
+    if isinstance(memory, PagedMemory):
+        ram_pages = memory._ram_pages
+        physMask = memory.physMask
+        page_bits = memory.page_bits
+        offset_mask = (1 << page_bits) - 1
+
+        def read(address):
+            address &= addrMask & physMask
+            return ram_pages[address >> page_bits][address & offset_mask]
+        return read
+
+    if isinstance(memory, Bus):
+        read_pages = memory.read_pages
+        page_bits = memory.page_bits
+        offset_mask = (1 << page_bits) - 1
+
+        def read(address):
+            address &= addrMask & memory.addrMask
+            page = read_pages[address >> page_bits]
+            if type(page) is not memoryview:
+                return None
+            return page[address & offset_mask]
+        return read
+
+    return lambda address: memory[address & addrMask]
@@ -0,0 +1,118 @@
+"""Lookup tables for the arithmetic and flag computations of the MPUs.
+
+nz_table(width) is indexed by a byte value and holds the N and Z flags
+for it.  Its extra last entry, at 1 << width, has both flags set, which
+no byte value gives.  nz_values(width) is the reverse: indexed by flags,
+it holds a value that nz_table maps to the same N and Z.  The other tables are for 8-bit MPUs only and are built from the
+6502's own opADC, opSBC and opCMPR the first time they are used:
+
+    tables.adc_binary, tables.adc_decimal, tables.sbc_binary,
+    tables.sbc_decimal -- indexed by (carry << 16) | (a << 8) | operand,
+        each entry is the result | (C, Z, V, N flags << 8)
+
+    tables.cmp -- indexed by (register << 8) | operand, each entry is the
+        C, Z and N flags
+"""
+
+from array import array
+
+NEGATIVE = 128
+OVERFLOW = 64
+DECIMAL = 8
+ZERO = 2
+CARRY = 1
+
+ARITHMETIC_FLAGS = CARRY | ZERO | OVERFLOW | NEGATIVE
+
+_nz_tables = {}
+_nz_values = {}
+
+
+def nz_table(width):
+    table = _nz_tables.get(width)
+    if table is None:
+        negative = 1 << (width - 1)
+        table = array('B' if width == 8 else 'H', [ZERO])
+        table.extend(value & negative for value in range(1, 1 << width))
+        table.append(negative | ZERO)
+        _nz_tables[width] = table
+    return table
+
+
+def nz_values(width):
+    values = _nz_values.get(width)
+    if values is None:
+        negative = 1 << (width - 1)
+        by_flags = {0: 1, ZERO: 0, negative: negative,
+                    negative | ZERO: 1 << width}
+        values = [by_flags[flags & (negative | ZERO)]
+                  for flags in range(1 << width)]
+        _nz_values[width] = values
+    return values
+
+
+def _make_mpu():
+    # imported here because the MPU module uses this one
+    from py65.devices.mpu6502 import MPU
+    return MPU(memory=[0x00])
+
+
+def build_arithmetic_table(operation, decimal):
+    """Build an ADC or SBC ("opADC" or "opSBC") result and flags table"""
+    mpu = _make_mpu()
+    op = getattr(mpu, operation)
+    operand = mpu.ProgramCounter
+    mpu.pc = 0
+    memory = mpu.memory
+    table = array('H')
+    for carry in (0, CARRY):
+        p = carry
+        if decimal:
+            p |= DECIMAL
+        for a in range(256):
+            for data in range(256):
+                memory[0] = data
+                mpu.a = a
+                mpu.p = p
+                op(operand)
+                table.append(mpu.a | ((mpu.p & ARITHMETIC_FLAGS) << 8))
+    return table
+
+
+def build_compare_table():
+    mpu = _make_mpu()
+    operand = mpu.ProgramCounter
+    mpu.pc = 0
+    memory = mpu.memory
+    table = bytearray()
+    for register in range(256):
+        for data in range(256):
+            memory[0] = data
+            mpu.p = 0
+            mpu.opCMPR(operand, register)
+            table.append(mpu.p)
+    return bytes(table)
+
+
+class ALUTables:
+    """Tables built on first access"""
+
+    builders = {
+        'adc_binary': lambda: build_arithmetic_table('opADC', False),
+        'adc_decimal': lambda: build_arithmetic_table('opADC', True),
+        'sbc_binary': lambda: build_arithmetic_table('opSBC', False),
+        'sbc_decimal': lambda: build_arithmetic_table('opSBC', True),
+        'cmp': build_compare_table,
+        }
+
+    def __getattr__(self, name):
+        try:
+            builder = self.builders[name]
+        except KeyError:
+            raise AttributeError(name)
+        table = builder()
+        setattr(self, name, table)
+        return table
+
+
+tables = ALUTables()
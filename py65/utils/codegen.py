@@ -0,0 +1,702 @@
+"""Generate fused instruction handlers for the MPU classes.
+
+The handlers written in the MPU classes call a generic operation with a
+bound addressing mode method, e.g. self.opORA(self.IndirectXAddr).  The
+functions generated here do the same work with the addressing mode and
+operation inlined, using the name and mode recorded by the @instruction
+decorator and the constants of the class they are generated for.
+
+The handlers use "_p", which holds the processor status behind the
+"p" property of the MPU.  With lazy_flags, they instead record the last
+value that the N and Z flags are computed from in "_nz" and keep only
+the other flags in "_p" (see MPU.lazy_flags).  Templates that set self.p
+go through the property and are correct either way, so only the common
+cases are written specially.
+
+For memory with page tables (see py65.memory.PagedMemory), each access
+memory[address] is rewritten to index the page tables the MPU keeps in
+"_read_pages" and "_write_pages" instead.  When the MPU tracks dirty
+pages, each write is followed by marking its page in the bitmap "_dirty".
+"""
+
+import re
+
+from py65.utils import alu
+
+# lines computing "addr" from "pc" (which points just past the opcode)
+# and the number of operand bytes for each addressing mode
+ADDRESSING = {
+    'imm': (["addr = pc"], 1),
+    'zpg': (["addr = memory[pc]"], 1),
+    'zpx': (["addr = (self.x + memory[pc]) & {BM}"], 1),
+    'zpy': (["addr = (self.y + memory[pc]) & {BM}"], 1),
+    'abs': (["addr = memory[pc] + (memory[pc + 1] << {BW})"], 2),
+    'abx': (["base = memory[pc] + (memory[pc + 1] << {BW})",
+             "addr = (base + self.x) & {AM}"], 2),
+    'aby': (["base = memory[pc] + (memory[pc + 1] << {BW})",
+             "addr = (base + self.y) & {AM}"], 2),
+    'inx': (["zp = (memory[pc] + self.x) & {BM}",
+             "addr = memory[zp] + (memory[(zp + 1) & {BM}] << {BW})"], 1),
+    'iny': (["zp = memory[pc]",
+             "base = memory[zp] + (memory[(zp + 1) & {BM}] << {BW})",
+             "addr = (base + self.y) & {AM}"], 1),
+    'zpi': (["zp = memory[pc] & 255",
+             "addr = memory[zp] + (memory[zp + 1] << {BW})"], 1),
+    }
+
+# addressing modes that add a cycle when indexing crosses a page
+PAGE_CROSSING = ('abx', 'aby', 'iny')
+
+
+def nz(value):
+    return ["p = (p & {NOTNZ}) | NZ[%s]" % value]
+
+
+_NZ_LINE = re.compile(r"^p = \(p & \{NOTNZ\}\) \| NZ\[(.*)\]$")
+
+
+def lazy_nz(line):
+    """Rewrite a line made by nz() to record the value instead"""
+    match = _NZ_LINE.match(line)
+    if match is None:
+        return line
+    return "self._nz = %s" % match.group(1)
+
+
+# how the lines of an operation use the local "p":
+NZ_ONLY = 'nz'  # sets N and Z with nz() only
+NZ_AND_OTHERS = 'nzc'  # also uses other flags, but not N and Z directly
+ALL_FLAGS = 'all'  # reads or sets N or Z directly
+
+
+def with_flags(lines, uses_p, lazy_flags=False):
+    """Surround operation lines working on a local "p" with the loading
+    and storing of the processor status"""
+    if not uses_p:
+        return lines
+    if not lazy_flags:
+        return ["p = self._p"] + lines + ["self._p = p"]
+    if uses_p == ALL_FLAGS:
+        return (["p = self._p | NZ[self._nz]"] + lines +
+                ["self._p = p & {NOTNZ}",
+                 "self._nz = NZVALUE[p & {NZMASK}]"])
+    lines = [lazy_nz(line) for line in lines]
+    if uses_p == NZ_ONLY:
+        return lines
+    return ["p = self._p"] + lines + ["self._p = p"]
+
+
+def push(value):
+    return ["sp = self.sp",
+            "memory[sp + {SP}] = %s & {BM}" % value,
+            "self.sp = (sp - 1) & {BM}"]
+
+
+def pop(target):
+    return ["sp = (self.sp + 1) & {BM}",
+            "self.sp = sp",
+            "%s = memory[sp + {SP}]" % target]
+
+
+def _closing_bracket(text, start):
+    """Index of the "]" matching the "[" at text[start]"""
+    depth = 0
+    for index in range(start, len(text)):
+        if text[index] == '[':
+            depth += 1
+        elif text[index] == ']':
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ValueError("unbalanced brackets: %r" % text)
+
+
+def _paged_access(table, address):
+    if not address.isidentifier():
+        address = "(%s)" % address
+    return "%s[%s >> {PS}][%s & {PM}]" % (table, address, address)
+
+
+def _paged_reads(text):
+    while True:
+        start = text.find("memory[")
+        if start == -1:
+            return text
+        end = _closing_bracket(text, start + 6)
+        address = _paged_reads(text[start + 7:end])
+        text = text[:start] + _paged_access("rp", address) + text[end + 1:]
+
+
+def paged(lines):
+    """Rewrite the accesses to "memory" in lines to use the page tables
+    "rp" and "wp" instead"""
+    result = []
+    for line in lines:
+        code = line.lstrip()
+        indent = line[:len(line) - len(code)]
+        if code == "memory = self._memory":
+            result += [indent + "rp = self._read_pages",
+                       indent + "wp = self._write_pages"]
+        elif code.startswith("memory["):
+            # a write, possibly with an augmented assignment
+            end = _closing_bracket(code, 6)
+            address = _paged_reads(code[7:end])
+            operator, value = code[end + 1:].split("=", 1)
+            value = _paged_reads(value.strip())
+            if operator.strip():
+                value = "%s %s %s" % (_paged_access("rp", address),
+                                      operator.strip(), value)
+            result.append("%s%s = %s" % (
+                indent, _paged_access("wp", address), value))
+        else:
+            result.append(indent + _paged_reads(code))
+    # drop the page table that is not used
+    for table in ("rp", "wp"):
+        if not any((table + "[") in line for line in result):
+            result = [line for line in result
+                      if not line.lstrip().startswith(table + " = ")]
+    return result
+
+
+def dirty_tracking(lines):
+    """Add marking the page written to in the bitmap "dirty" after each
+    write to "memory" in lines"""
+    result = []
+    for line in lines:
+        result.append(line)
+        code = line.lstrip()
+        indent = line[:len(line) - len(code)]
+        if code == "memory = self._memory":
+            result.append(indent + "dirty = self._dirty")
+        elif code.startswith("memory["):
+            address = code[7:_closing_bracket(code, 6)]
+            if not address.isidentifier():
+                address = "(%s)" % address
+            result.append("%sdirty[%s >> {DS}] = 1" % (indent, address))
+    return result
+
+
+# operations on the value at "addr"
+
+def op_logical(operator):
+    return (["a = self.a %s memory[addr]" % operator,
+             "self.a = a"] + nz("a"), NZ_ONLY)
+
+
+def op_load(register):
+    return (["value = memory[addr]",
+             "self.%s = value" % register] + nz("value"), NZ_ONLY)
+
+
+def op_store(register):
+    return (["memory[addr] = self.%s" % register], False)
+
+
+def op_compare(register):
+    return (["tbyte = memory[addr]",
+             "value = self.%s" % register,
+             "p &= {NOTC}",
+             "if value >= tbyte:",
+             "    p |= {C}"] + nz("(value - tbyte) & {BM}"), NZ_AND_OTHERS)
+
+
+# ADC, SBC and compare using the tables in py65.utils.alu (8-bit only)
+
+def op_arithmetic_table(operation, lazy_flags=False):
+    lines = ["data = memory[addr]",
+             "if p & {D}:",
+             "    table = alu.%s_decimal" % operation,
+             "else:",
+             "    table = alu.%s_binary" % operation,
+             "result = table[((p & {C}) << 16) | (self.a << 8) | data]",
+             "self.a = result & 255"]
+    if lazy_flags:
+        return (lines + ["p = (p & {NOTCV}) | ((result >> 8) & ({C} | {V}))",
+                         "self._nz = NZVALUE[result >> 8]"], NZ_AND_OTHERS)
+    return lines + ["p = (p & {NOTCVNZ}) | (result >> 8)"], ALL_FLAGS
+
+
+def op_compare_table(register):
+    return (["p = (p & {NOTCZN}) | "
+             "alu.cmp[(self.%s << 8) | memory[addr]]" % register], ALL_FLAGS)
+
+
+TABLE_OPERATIONS = {
+    'ADC': op_arithmetic_table('adc'),
+    'SBC': op_arithmetic_table('sbc'),
+    'CMP': op_compare_table('a'),
+    'CPX': op_compare_table('x'),
+    'CPY': op_compare_table('y'),
+    }
+
+# ADC and SBC with lazy flags; the compare operations use OPERATIONS
+# then, since setting N and Z with nz() is faster than a flags table
+LAZY_TABLE_OPERATIONS = {
+    'ADC': op_arithmetic_table('adc', lazy_flags=True),
+    'SBC': op_arithmetic_table('sbc', lazy_flags=True),
+    }
+
+OP_ADC = [
+    "data = memory[addr]",
+    "a = self.a",
+    "if p & {D}:",
+    "    halfcarry = 0",
+    "    decimalcarry = 0",
+    "    adjust0 = 0",
+    "    adjust1 = 0",
+    "    nibble0 = (data & 0xf) + (a & 0xf) + (p & {C})",
+    "    if nibble0 > 9:",
+    "        adjust0 = 6",
+    "        halfcarry = 1",
+    "    nibble1 = ((data >> 4) & 0xf) + ((a >> 4) & 0xf) + halfcarry",
+    "    if nibble1 > 9:",
+    "        adjust1 = 6",
+    "        decimalcarry = 1",
+    "    nibble0 = nibble0 & 0xf",
+    "    nibble1 = nibble1 & 0xf",
+    "    aluresult = (nibble1 << 4) + nibble0",
+    "    nibble0 = (nibble0 + adjust0) & 0xf",
+    "    nibble1 = (nibble1 + adjust1) & 0xf",
+    "    p &= {NOTCVNZ}",
+    "    if aluresult == 0:",
+    "        p |= {Z}",
+    "    else:",
+    "        p |= aluresult & {N}",
+    "    if decimalcarry == 1:",
+    "        p |= {C}",
+    "    if (~(a ^ data) & (a ^ aluresult)) & {N}:",
+    "        p |= {V}",
+    "    self.a = (nibble1 << 4) + nibble0",
+    "else:",
+    "    result = data + a + (p & {C})",
+    "    p &= {NOTCVNZ}",
+    "    if (~(a ^ data) & (a ^ result)) & {N}:",
+    "        p |= {V}",
+    "    if result > {BM}:",
+    "        p |= {C}",
+    "        result &= {BM}",
+    "    if result == 0:",
+    "        p |= {Z}",
+    "    else:",
+    "        p |= result & {N}",
+    "    self.a = result",
+    ]
+
+OP_SBC = [
+    "data = memory[addr]",
+    "a = self.a",
+    "if p & {D}:",
+    "    halfcarry = 1",
+    "    decimalcarry = 0",
+    "    adjust0 = 0",
+    "    adjust1 = 0",
+    "    nibble0 = (a & 0xf) + (~data & 0xf) + (p & {C})",
+    "    if nibble0 <= 0xf:",
+    "        halfcarry = 0",
+    "        adjust0 = 10",
+    "    nibble1 = ((a >> 4) & 0xf) + ((~data >> 4) & 0xf) + halfcarry",
+    "    if nibble1 <= 0xf:",
+    "        adjust1 = 10 << 4",
+    "    aluresult = a + (~data & {BM}) + (p & {C})",
+    "    if aluresult > {BM}:",
+    "        decimalcarry = 1",
+    "    aluresult &= {BM}",
+    "    nibble0 = (aluresult + adjust0) & 0xf",
+    "    nibble1 = ((aluresult + adjust1) >> 4) & 0xf",
+    "    p &= {NOTCVNZ}",
+    "    if aluresult == 0:",
+    "        p |= {Z}",
+    "    else:",
+    "        p |= aluresult & {N}",
+    "    if decimalcarry == 1:",
+    "        p |= {C}",
+    "    if ((a ^ data) & (a ^ aluresult)) & {N}:",
+    "        p |= {V}",
+    "    self.a = (nibble1 << 4) + nibble0",
+    "else:",
+    "    result = a + (~data & {BM}) + (p & {C})",
+    "    p &= {NOTCVNZ}",
+    "    if ((a ^ data) & (a ^ result)) & {N}:",
+    "        p |= {V}",
+    "    data = result & {BM}",
+    "    if data == 0:",
+    "        p |= {Z}",
+    "    if result > {BM}:",
+    "        p |= {C}",
+    "    p |= data & {N}",
+    "    self.a = data",
+    ]
+
+# read-modify-write operations on "tbyte"
+RMW = {
+    'ASL': (["p &= {NOTC}",
+             "if tbyte & {N}:",
+             "    p |= {C}",
+             "tbyte = (tbyte << 1) & {BM}"] + nz("tbyte"), NZ_AND_OTHERS),
+    'LSR': (["p = (p & {NOTC}) | (tbyte & 1)",
+             "tbyte = tbyte >> 1"] + nz("tbyte"), NZ_AND_OTHERS),
+    'ROL': (["carry = p & {C}",
+             "p &= {NOTC}",
+             "if tbyte & {N}:",
+             "    p |= {C}",
+             "tbyte = ((tbyte << 1) | carry) & {BM}"] + nz("tbyte"),
+            NZ_AND_OTHERS),
+    'ROR': (["carry = p & {C}",
+             "p = (p & {NOTC}) | (tbyte & 1)",
+             "tbyte = tbyte >> 1",
+             "if carry:",
+             "    tbyte |= {N}"] + nz("tbyte"), NZ_AND_OTHERS),
+    'INC': (["tbyte = (tbyte + 1) & {BM}"] + nz("tbyte"), NZ_ONLY),
+    'DEC': (["tbyte = (tbyte - 1) & {BM}"] + nz("tbyte"), NZ_ONLY),
+    }
+
+OPERATIONS = {
+    'ORA': op_logical('|'),
+    'AND': op_logical('&'),
+    'EOR': op_logical('^'),
+    'LDA': op_load('a'),
+    'LDX': op_load('x'),
+    'LDY': op_load('y'),
+    'STA': op_store('a'),
+    'STX': op_store('x'),
+    'STY': op_store('y'),
+    'STZ': (["memory[addr] = 0"], False),
+    'CMP': op_compare('a'),
+    'CPX': op_compare('x'),
+    'CPY': op_compare('y'),
+    'ADC': (OP_ADC, ALL_FLAGS),
+    'SBC': (OP_SBC, ALL_FLAGS),
+    'BIT': (["tbyte = memory[addr]",
+             "p &= {NOTZNV}",
+             "if (self.a & tbyte) == 0:",
+             "    p |= {Z}",
+             "p |= tbyte & ({N} | {V})"], ALL_FLAGS),
+    'TSB': (["m = memory[addr]",
+             "p &= {NOTZ}",
+             "if (m & self.a) == 0:",
+             "    p |= {Z}",
+             "memory[addr] = m | self.a"], ALL_FLAGS),
+    'TRB': (["m = memory[addr]",
+             "p &= {NOTZ}",
+             "if (m & self.a) == 0:",
+             "    p |= {Z}",
+             "memory[addr] = m & ~self.a"], ALL_FLAGS),
+    }
+
+for _bit in range(8):
+    OPERATIONS['RMB%d' % _bit] = (
+        ["memory[addr] &= %d" % (0xFF & ~(1 << _bit))], False)
+    OPERATIONS['SMB%d' % _bit] = (
+        ["memory[addr] |= %d" % (1 << _bit)], False)
+
+# (lines, use of the local p) for instructions without an operand;
+# {PVALUE} is an expression for the whole processor status
+IMPLIED = {
+    'NOP': ([], False),
+    'CLC': (["self._p &= {NOTC}"], False),
+    'CLD': (["self._p &= {NOTD}"], False),
+    'CLI': (["self._p &= {NOTI}"], False),
+    'CLV': (["self._p &= {NOTV}"], False),
+    'SEC': (["self._p |= {C}"], False),
+    'SED': (["self._p |= {D}"], False),
+    'SEI': (["self._p |= {I}"], False),
+    'TAX': (["value = self.x = self.a"] + nz("value"), NZ_ONLY),
+    'TAY': (["value = self.y = self.a"] + nz("value"), NZ_ONLY),
+    'TXA': (["value = self.a = self.x"] + nz("value"), NZ_ONLY),
+    'TYA': (["value = self.a = self.y"] + nz("value"), NZ_ONLY),
+    'TSX': (["value = self.x = self.sp"] + nz("value"), NZ_ONLY),
+    'TXS': (["self.sp = self.x"], False),
+    'INX': (["value = self.x = (self.x + 1) & {BM}"] + nz("value"), NZ_ONLY),
+    'INY': (["value = self.y = (self.y + 1) & {BM}"] + nz("value"), NZ_ONLY),
+    'DEX': (["value = self.x = (self.x - 1) & {BM}"] + nz("value"), NZ_ONLY),
+    'DEY': (["value = self.y = (self.y - 1) & {BM}"] + nz("value"), NZ_ONLY),
+    'PHA': (["memory = self._memory"] + push("self.a"), False),
+    'PHX': (["memory = self._memory"] + push("self.x"), False),
+    'PHY': (["memory = self._memory"] + push("self.y"), False),
+    'PHP': (["memory = self._memory"] + push("{PVALUE} | {B} | {U}"), False),
+    'PLA': (["memory = self._memory"] + pop("value") +
+            ["self.a = value"] + nz("value"), NZ_ONLY),
+    'PLX': (["memory = self._memory"] + pop("value") +
+            ["self.x = value"] + nz("value"), NZ_ONLY),
+    'PLY': (["memory = self._memory"] + pop("value") +
+            ["self.y = value"] + nz("value"), NZ_ONLY),
+    'PLP': (["memory = self._memory"] + pop("value") +
+            ["self.p = value | {B} | {U}"], False),
+    'RTS': (["memory = self._memory"] + pop("low") + pop("high") +
+            ["self.pc = low + (high << {BW}) + 1"], False),
+    'RTI': (["memory = self._memory"] + pop("value") +
+            ["self.p = value | {B} | {U}"] + pop("low") + pop("high") +
+            ["self.pc = low + (high << {BW})"], False),
+    'BRK': (["memory = self._memory",
+             "pc = (self.pc + 1) & {AM}"] +
+            push("pc >> {BW}") + push("pc") +
+            ["self._p |= {B}"] + push("{PVALUE} | {B} | {U}") +
+            ["self._p |= {I}",
+             "self.pc = memory[{IRQ}] + (memory[{IRQ} + 1] << {BW})"],
+            False),
+    }
+
+BRANCHES = {
+    'BPL': ('N', False), 'BMI': ('N', True),
+    'BVC': ('V', False), 'BVS': ('V', True),
+    'BCC': ('C', False), 'BCS': ('C', True),
+    'BNE': ('Z', False), 'BEQ': ('Z', True),
+    }
+
+
+
+def branch(cycle_exact=True):
+    lines = ["memory = self._memory",
+             "pc = self.pc",
+             "offset = memory[pc]",
+             "pc += 1",
+             "if offset & {N}:",
+             "    target = pc - (offset ^ {BM}) - 1",
+             "else:",
+             "    target = pc + offset"]
+    if cycle_exact:
+        lines += ["if (pc ^ target) & {AHM}:",
+                  "    self.excycles += 2",
+                  "else:",
+                  "    self.excycles += 1"]
+    return lines + ["self.pc = target & {AM}"]
+
+
+def constants_for(cls, lazy_flags=False, page_bits=None, dirty_bits=None):
+    """Values substituted into the handler source for an MPU class"""
+    byteMask = (1 << cls.BYTE_WIDTH) - 1
+    addrMask = (1 << cls.ADDR_WIDTH) - 1
+    flags = {'N': cls.NEGATIVE, 'V': cls.OVERFLOW, 'U': cls.UNUSED,
+             'B': cls.BREAK, 'D': cls.DECIMAL, 'I': cls.INTERRUPT,
+             'Z': cls.ZERO, 'C': cls.CARRY}
+    consts = dict(flags)
+    for name, value in flags.items():
+        consts['NOT' + name] = ~value
+    consts.update({
+        'NZMASK': cls.NEGATIVE | cls.ZERO,
+        'NOTNZ': ~(cls.NEGATIVE | cls.ZERO),
+        'NOTCZN': ~(cls.CARRY | cls.ZERO | cls.NEGATIVE),
+        'NOTCV': ~(cls.CARRY | cls.OVERFLOW),
+        'NOTCVNZ': ~(cls.CARRY | cls.OVERFLOW | cls.NEGATIVE | cls.ZERO),
+        'NOTZNV': ~(cls.ZERO | cls.NEGATIVE | cls.OVERFLOW),
+        'BW': cls.BYTE_WIDTH,
+        'BM': byteMask,
+        'AM': addrMask,
+        'AHM': byteMask << cls.BYTE_WIDTH,
+        'SP': 1 << cls.BYTE_WIDTH,
+        'IRQ': cls.IRQ,
+        })
+    if lazy_flags:
+        consts['PVALUE'] = '(self._p | NZ[self._nz])'
+    else:
+        consts['PVALUE'] = 'self._p'
+    if page_bits is not None:
+        consts['PS'] = page_bits
+        consts['PM'] = (1 << page_bits) - 1
+    if dirty_bits is not None:
+        consts['DS'] = dirty_bits
+    return consts
+
+
+def handler_body(name, mode, extracycles, byte_width=8, lazy_flags=False,
+                 cycle_exact=True):
+    """Return the lines of a fused handler, or None if the instruction
+    is not one that can be generated.  Unless cycle_exact, the handler
+    does not count the extra cycles of branches and page crossings."""
+    if name in BRANCHES:
+        flag, taken_if_set = BRANCHES[name]
+        if lazy_flags and flag in 'NZ':
+            test = "NZ[self._nz] & {%s}" % flag
+        else:
+            test = "self._p & {%s}" % flag
+        if not taken_if_set:
+            test = "not " + test
+        return (["if %s:" % test] +
+                ["    " + line for line in branch(cycle_exact)] +
+                ["else:",
+                 "    self.pc += 1"])
+
+    if name == 'BRA' and mode == 'rel':
+        return branch(cycle_exact)
+
+    if name == 'JMP' and mode == 'abs':
+        return ["memory = self._memory",
+                "pc = self.pc",
+                "self.pc = memory[pc] + (memory[pc + 1] << {BW})"]
+
+    if name == 'JMP' and mode == 'ind':
+        return ["memory = self._memory",
+                "pc = self.pc",
+                "ta = memory[pc] + (memory[pc + 1] << {BW})",
+                "self.pc = memory[ta] + "
+                "(memory[(ta & {AHM}) + ((ta + 1) & {BM})] << {BW})"]
+
+    if name == 'JMP' and mode == 'iax':
+        return ["memory = self._memory",
+                "pc = self.pc",
+                "ta = (memory[pc] + (memory[pc + 1] << {BW}) + self.x) & {AM}",
+                "self.pc = memory[ta] + (memory[ta + 1] << {BW})"]
+
+    if name == 'JSR' and mode == 'abs':
+        return (["memory = self._memory",
+                 "pc = self.pc",
+                 "ret = (pc + 1) & {AM}"] +
+                push("ret >> {BW}") + push("ret") +
+                ["self.pc = memory[pc] + (memory[pc + 1] << {BW})"])
+
+    if name == 'BIT' and mode == 'imm':
+        # in the immediate mode, BIT only affects the Z flag
+        return ["memory = self._memory",
+                "pc = self.pc",
+                "if (self.a & memory[pc]) == 0:",
+                "    self.p |= {Z}",
+                "else:",
+                "    self.p &= {NOTZ}",
+                "self.pc = pc + 1"]
+
+    if mode in ('imp', 'acc') and name in IMPLIED and name not in RMW:
+        lines, uses_p = IMPLIED[name]
+        return with_flags(lines, uses_p, lazy_flags) or ["pass"]
+
+    if mode == 'acc' and name in RMW:
+        operation, uses_p = RMW[name]
+        return (["tbyte = self.a"] +
+                with_flags(operation, uses_p, lazy_flags) +
+                ["self.a = tbyte"])
+
+    if mode not in ADDRESSING:
+        return None
+    addressing, length = ADDRESSING[mode]
+    lines = ["memory = self._memory", "pc = self.pc"] + addressing
+    if extracycles and cycle_exact and mode in PAGE_CROSSING:
+        lines += ["if (base ^ addr) & {AHM}:",
+                  "    self.excycles += 1"]
+
+    if name in RMW:
+        operation, uses_p = RMW[name]
+        lines += (["tbyte = memory[addr]"] +
+                  with_flags(operation, uses_p, lazy_flags) +
+                  ["memory[addr] = tbyte"])
+    elif byte_width == 8 and lazy_flags and name in LAZY_TABLE_OPERATIONS:
+        operation, uses_p = LAZY_TABLE_OPERATIONS[name]
+        lines += with_flags(operation, uses_p, lazy_flags)
+    elif byte_width == 8 and not lazy_flags and name in TABLE_OPERATIONS:
+        operation, uses_p = TABLE_OPERATIONS[name]
+        lines += with_flags(operation, uses_p, lazy_flags)
+    elif name in OPERATIONS:
+        operation, uses_p = OPERATIONS[name]
+        lines += with_flags(operation, uses_p, lazy_flags)
+    else:
+        return None
+
+    lines.append("self.pc = pc + %d" % length)
+    return lines
+
+
+# methods the decorated handlers are built from; a class overriding any
+# of them keeps its decorated handlers so that the override is honored
+HELPERS = ('ByteAt', 'WordAt', 'WrapAt', 'ProgramCounter', 'ImmediateByte',
+           'BranchRelAddr', 'stPush', 'stPop', 'stPushWord', 'stPopWord',
+           'FlagsNZ')
+
+_compiled = {}
+
+
+def make_handler(cls, opcode, consts=None, lazy_flags=False,
+                 cycle_exact=True, page_bits=None, dirty_bits=None):
+    """Generate the fused handler for an opcode of an MPU class"""
+    name, mode = cls.disassemble[opcode]
+    lines = handler_body(name, mode, cls.extracycles[opcode],
+                         cls.BYTE_WIDTH, lazy_flags, cycle_exact)
+    if lines is None:
+        return None
+    if dirty_bits is not None:
+        lines = dirty_tracking(lines)
+    if page_bits is not None:
+        lines = paged(lines)
+    if consts is None:
+        consts = constants_for(cls, lazy_flags, page_bits, dirty_bits)
+
+    funcname = 'inst_0x%02x' % opcode
+    source = "def %s(self):\n%s\n" % (
+        funcname,
+        "\n".join("    " + line.format(**consts) for line in lines))
+    key = (cls.BYTE_WIDTH, source)
+    handler = _compiled.get(key)
+    if handler is None:
+        namespace = {'NZ': alu.nz_table(cls.BYTE_WIDTH),
+                     'NZVALUE': alu.nz_values(cls.BYTE_WIDTH),
+                     'alu': alu.tables}
+        exec(compile(source, '<fused %s %s>' % (name, mode), 'exec'),
+             namespace)
+        handler = _compiled[key] = namespace[funcname]
+        handler.fused = (name, mode)
+        handler.source = source
+    return handler
+
+
+def overrides_helpers(cls, root):
+    """True if cls replaces any method the decorated handlers of root
+    are built from"""
+    names = [name for name in dir(root)
+             if name.startswith('op') or name.endswith('Addr') or
+             name in HELPERS]
+    return any(getattr(cls, name) is not getattr(root, name)
+               for name in names)
+
+
+def fuse_instructions(cls, parent=None):
+    """Return a copy of cls.instruct with fused handlers in place of the
+    decorated methods.
+
+    Handlers inherited from parent (already fused, possibly for other
+    constants) are regenerated.  A method decorated in cls for an opcode
+    that parent already implemented is an override with its own behavior
+    and is kept as it is.
+    """
+    consts = constants_for(cls)
+    instruct = list(cls.instruct)
+    for opcode, handler in enumerate(instruct):
+        if cls.disassemble[opcode][0] == '???':
+            continue
+        if not hasattr(handler, 'fused'):
+            overridden = (parent is not None and
+                          parent.disassemble[opcode][0] != '???')
+            if overridden:
+                continue
+        fused = make_handler(cls, opcode, consts)
+        if fused is not None:
+            instruct[opcode] = fused
+    return instruct
+
+
+def unfuse_instructions(cls):
+    """Return a copy of cls.instruct with the decorated methods in place
+    of any fused handlers"""
+    instruct = list(cls.instruct)
+    for opcode, handler in enumerate(instruct):
+        if hasattr(handler, 'fused'):
+            instruct[opcode] = getattr(cls, handler.__name__)
+    return instruct
+
+
+_variants = {}
+
+
+def variant_instructions(cls, lazy_flags=False, cycle_exact=True,
+                         page_bits=None, dirty_bits=None):
+    """Return a copy of cls.instruct with its fused handlers generated
+    again for the given options.  Other handlers are kept; they only use
+    the public attributes of the MPU, which work with any options."""
+    key = (cls, lazy_flags, cycle_exact, page_bits, dirty_bits)
+    instruct = _variants.get(key)
+    if instruct is None:
+        consts = constants_for(cls, lazy_flags, page_bits, dirty_bits)
+        instruct = list(cls.instruct)
+        for opcode, handler in enumerate(instruct):
+            if hasattr(handler, 'fused'):
+                instruct[opcode] = make_handler(cls, opcode, consts,
+                                                lazy_flags, cycle_exact,
+                                                page_bits, dirty_bits)
+        _variants[key] = instruct
+    return instruct
@@ -0,0 +1,73 @@
+"""Pickling of MPUs and memory whose devices are re-attached by name.
+
+The MPU and memory classes pickle compactly by themselves, but the
+callbacks subscribed to memory are often closures or bound methods of
+devices that hold files or terminals, which cannot be pickled.  dumps()
+records each of the devices given to it, and each bound method of one,
+by its name instead, and loads() attaches the devices given to it under
+the same names in their place:
+
+  data = dumps(mpu, {'console': console})
+  ...
+  mpu = loads(data, {'console': Console()})
+"""
+
+import io
+import pickle
+import types
+
+
+class Pickler(pickle.Pickler):
+    """Pickler recording the objects of devices, a dict of name to
+    object, and their bound methods by name"""
+
+    def __init__(self, file, devices=None, protocol=pickle.HIGHEST_PROTOCOL):
+        pickle.Pickler.__init__(self, file, protocol)
+        self.devices = dict(devices or {})
+        self._names = dict((id(device), name)
+                           for name, device in self.devices.items())
+
+    def persistent_id(self, obj):
+        name = self._names.get(id(obj))
+        if name is not None:
+            return name
+        if type(obj) is types.MethodType:
+            name = self._names.get(id(obj.__self__))
+            if name is not None:
+                return (name, obj.__func__.__name__)
+        return None
+
+
+class Unpickler(pickle.Unpickler):
+    """Unpickler attaching the objects of devices, a dict of name to
+    object, in place of those pickled by name"""
+
+    def __init__(self, file, devices=None):
+        pickle.Unpickler.__init__(self, file)
+        self.devices = dict(devices or {})
+
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple):
+            name, method = pid
+        else:
+            name, method = pid, None
+        if name not in self.devices:
+            raise pickle.UnpicklingError("no device named %r" % (name,))
+        device = self.devices[name]
+        if method is None:
+            return device
+        return getattr(device, method)
+
+
+def dumps(obj, devices=None, protocol=pickle.HIGHEST_PROTOCOL):
+    """Pickle obj, recording the devices (a dict of name to object) and
+    their bound methods by name"""
+    f = io.BytesIO()
+    Pickler(f, devices, protocol).dump(obj)
+    return f.getvalue()
+
+
+def loads(data, devices=None):
+    """Unpickle data from dumps(), attaching the devices (a dict of name
+    to object) in place of those pickled by the same names"""
+    return Unpickler(io.BytesIO(data), devices).load()